@@ -33,11 +33,20 @@ import pandas as pd
 
 
 #AGNfitter IMPORTS
-from functions import  MCMC_AGNfitter, PLOTandWRITE_AGNfitter
+from functions import  MCMC_AGNfitter, PLOTandWRITE_AGNfitter, BATCH_AGNfitter
+import functions.SCHEDULER_AGNfitter as scheduler
+import functions.LEASES_AGNfitter as leases
+import functions.COSTS_AGNfitter as costs
+import functions.RESOURCES_AGNfitter as resources
 import functions.PARAMETERSPACE_AGNfitter as parspace
+import functions.API_AGNfitter as api
+import functions.SERVICE_AGNfitter as service
+import functions.CATALOGS_AGNfitter as catalogs
 from functions.DATA_AGNfitter import DATA, DATA_all
 from functions.MODEL_AGNfitter import MODELS
-from functions.DICTIONARIES_AGNfitter import MODELSDICT
+from functions.DICTIONARIES_AGNfitter import MODELSDICT, load_filterset
+from functions.SAMPLERS_AGNfitter import get_sampler
+from functions.MANIFEST_AGNfitter import MANIFEST, manifest_name
 from astropy import units as u
 from types import *
 
@@ -81,7 +90,16 @@ def MAKE_model_dictionary(cat_settings, filters_settings, models_settings, clobb
         print ('_______________________')
         os.system('rm -rf '+ modelsdict_name)
   
-    if not os.path.lexists(modelsdict_name): ## If model dictionary does not exist yet
+    mydict = None
+    if os.path.lexists(modelsdict_name):
+        mydict = pd.read_pickle(open(modelsdict_name, 'rb'))
+        if not mydict.up_to_date():
+            ## filtered with an older filtering_models (DICTIONARIES_AGNfitter.FILTERING_VERSION)
+            print ("> The model dictionary "+modelsdict_name+" was filtered with an older method, constructing it again")
+            os.remove(modelsdict_name)
+            mydict = None
+
+    if mydict is None: ## If model dictionary does not exist yet
 
         print ( '> Constructing new MODELS DICTIONARY:')
         print ( 'SAVED AS : ', modelsdict_name)
@@ -103,45 +121,27 @@ def MAKE_model_dictionary(cat_settings, filters_settings, models_settings, clobb
 
     else: ## If model dictionary exists and you want to reuseit
 
-        mydict = pd.read_pickle(open(modelsdict_name, 'rb'))
-
         print ( '________________________')
         print ( 'MODELS DICTIONARY currently in use:')
         print ( 'SAVED AS : ', mydict.filename)
         print ( 'FILTERSET USED : ', mydict.filterset_name)
         
-        test_settingschanges= [mydict.filters_list[i]==filters_settings[i]  for i in filters_settings.keys() if  type(filters_settings[i]) is BooleanType]
-
-        if False in test_settingschanges : ##  compare nr of data bands with n of model filters
+        ## the dictionary records its filters: bands added or removed in the settings
+        ## are merged into it, without building it again (MODELSDICT.update_filters)
+        fo = load_filterset(filters_settings, cat_settings['path'])
+        if list(mydict.fo.filternames) != list(fo.filternames) or not np.array_equal(mydict.fo.central_nu_array, fo.central_nu_array):
+            added, removed = mydict.update_filters(fo)
+            mydict.filters_list = filters_settings
+            f = open(mydict.filename, 'wb')
+            pickle.dump(mydict, f, protocol=2)
+            f.close()
             print ( '________________________')
-            print ( '*** WARNING ***'  )
-            print ( 'You have changed entries in your FILTER_settings without updating the filterset name.')
-            print ( 'The MODEL DICTIONARY will NOT be updated correctly.')
-            print ( '')
-            py3 = sys.version_info[0] > 2 #creates boolean value for test that Python major version > 2
-            if py3:
-              response = input(">> You want to continue with the old model dictionary nevertheless? (yes/no)")
-            else:
-              response = raw_input(">> You want to continue with the old model dictionary nevertheless? (yes/no)")
-            while True:
-                if response== 'no':
-                    sys.exit('\nTo update the MODEL DICTIONARY , you have these options: \n\
-                        * change the filterset name (filters["filterset"]), or \n\
-                        * run the code in model-overwriting mode (-o)')
-                elif response== 'yes':
-                    print ( '________________________')
-                    print ( 'MODELS DICTIONARY currently in use:')
-                    print ( 'SAVED AS : ', mydict.filename)
-                    print ( 'FILTERSET USED : ', mydict.filterset_name)
-                    break
-                else:
-                    print ( "Please answer (yes/no)")
-                    break
+            print ( 'MODELS DICTIONARY updated to the filters of the settings: %d bands added, %d removed' % (len(added), len(removed)))
 
     Modelsdict = mydict.MD ## MD is the model dictionary saved as a class of the method MODELSDICT
 
     bands_in_cat =len(cat_settings['freq/wl_list'])
-    bands_in_dict = len(Modelsdict[Modelsdict.keys()[0]][1][Modelsdict[Modelsdict.keys()[0]][1].keys()[0]][0])
+    bands_in_dict = len(mydict.fo.central_nu_array)
 
     if bands_in_cat!= bands_in_dict :
 
@@ -153,102 +153,189 @@ def MAKE_model_dictionary(cat_settings, filters_settings, models_settings, clobb
     return mydict
 
 
-def RUN_AGNfitter_onesource_independent( line, data_obj, filtersz, models_settings, mc_settings, clobbermodel=False):
+def RUN_AGNfitter_onesource_independent( line, data_obj, filtersz, models_settings, mc_settings, out_settings, clobbermodel=False):
     """
     Main function for fitting a single source in line and create it's modelsdict independently.
+    The source is fitted with the settings given explicitly (API_AGNfitter.fit_source).
     """
-    
-    mc = MCMC_settings()
-    out = OUTPUT_settings()
-    data = DATA(data_obj,line)
-    models = MODELS(data.z, models_settings, mc_settings)
-
-    print ( '')
-    print ( '________________________'    )
-    print ( 'Fitting sources from catalog: ', data.catalog )
-    print ( '- Sourceline: ', line)
-    print ( '- Sourcename: ', data.name)
+    settings = dict(cat=data_obj.cat, filters=filtersz, models=models_settings, mc=mc_settings, out=out_settings)
+    return api.fit_source(line, data_obj, settings, clobbermodel)
 
+    
+def PREPARE_source(line, data_obj, filtersz, models_settings, mc_settings, clobbermodel=False):
+    """
+    Load (or construct) the model dictionary of the source in line, for the batched fits (-m).
+    output
+        data, models, P
+    """
+    settings = dict(cat=data_obj.cat, filters=filtersz, models=models_settings, mc=mc_settings)
+    return api.prepare_source(line, data_obj, settings, clobbermodel)
 
-    ## 0. CONSTRUCT DICTIONARY for this redshift
-    t0= time.time()
-
-    ## needs a list/array of z
-    filtersz['dict_zarray'] = [data.z]
 
-    ## save the dictionary for this source in the OUTPUT folder for this source
-    ## create this source output folder if it doesn't exist
-    if not os.path.lexists(cat_settings['output_folder']+str(data.name)):
-        os.system('mkdir -p ' + cat_settings['output_folder'] +str(data.name))
+def RUN_AGNfitter_batch(lines, data_obj, filtersz, models_settings, mc_settings, out_settings, clobbermodel=False):
+    """
+    Fit the sources in lines together with the batched likelihood engine (BATCH_AGNfitter.py),
+    and write the output of each source. Sources already done are only written.
+    """
+    t1 = time.time()
+    manifest = MANIFEST(manifest_name(data_obj.cat))
+    fithash = api.fit_settings_hash(filtersz, models_settings, mc_settings)
+    lines = [line for line in lines if clobbermodel or not manifest.is_done(line, fithash)]
+    sources = []
+    for line in lines:
+        try:
+            data, models, P = PREPARE_source(line, data_obj, filtersz, models_settings, mc_settings, clobbermodel)
+        except EOFError:
+            print ( 'Line ',line,' cannot be fitted.')
+            continue
+        if not get_sampler(mc_settings).is_done(data_obj.cat['output_folder'] +str(data.name)):
+            sources.append((data, models, P))
 
-    dictz = cat_settings['output_folder'] +str(data.name) +'/MODELSDICT_' + str(data.name) 
-    ## remove this source modelsdict if it already exists and we want to remove it
-    if clobbermodel and os.path.lexists(dictz):
-        os.system('rm -rf '+dictz)
-        print ( "removing source model dictionary "+dictz )
-    
-    if os.path.lexists(cat_settings['output_folder'] +str(data.name) +'/samples_mcmc.sav') or os.path.lexists(cat_settings['output_folder'] +str(data.name) +'/ultranest/chains/weighted_post.txt'):           
-        print('Done')
-        dictz = str.encode(dictz)  
-        with open(dictz, 'rb') as f:
-            zdict = pd.read_pickle(f)
-        Modelsdictz = zdict
-        models.DICTS(filtersz, Modelsdictz)
-        P = parspace.Pdict (data, models)
-        PLOTandWRITE_AGNfitter.main(data,  models, P,  out, models_settings, mc_settings)
-        
-    else:
+    if len(sources) > 0:
+        BATCH_AGNfitter.fit_batch(sources, mc_settings)
 
-        try:  
-            if not os.path.lexists(dictz):
-                zdict = MODELSDICT(dictz, cat_settings['path'], filtersz, models_settings, data.nRADdata, data.nXRaysdata)
-                zdict.build()
-                f = open(zdict.filename, 'wb')
-                pickle.dump(zdict, f, protocol=2)
-                f.close()
-                print ( '_____________________________________________________')
-                print ( 'For this dictionary creation %.2g min elapsed'% ((time.time() - t0)/60.) )
-            else:
-                dictz = str.encode(dictz)
-                with open(dictz, 'rb') as f:
-                    zdict = pd.read_pickle(f)
-            
-            Modelsdictz = zdict
+    for line in lines:
+        RUN_AGNfitter_onesource_independent(line, data_obj, filtersz, models_settings, mc_settings, out_settings)
 
-            models.DICTS(filtersz, Modelsdictz)
+    print ( '_____________________________________________________')
+    print ( 'For this batch of %i sources %.2g min elapsed'% (len(lines), (time.time() - t1)/60.))
 
-            P = parspace.Pdict (data, models)   # Dictionary with all parameter space specifications.
-                                        	# From PARAMETERSPACE_AGNfitter.py
 
+## Inputs of the fits, given once to every processor of a pool (attach_worker)
+WORKER = dict()
 
-            t1= time.time()
+def attach_worker(catalog_folder, cat, filters, models_settings, mc_settings, out_settings, clobbermodel=False):
+    """
+    Pool initializer: maps the shared catalog arrays (DATA_all.SHARE) into memory,
+    and keeps the settings, so that the tasks of the pool only carry the source lines.
+    """
+    data_obj = DATA_all(cat, filters)
+    data_obj.ATTACH(catalog_folder)
+    if 'threads' in mc_settings:
+        resources.limit_threads(mc_settings['threads'])
+    WORKER.update(data_obj=data_obj, catalog_folder=catalog_folder, cat=cat, filters=filters, models_settings=models_settings, \
+                  mc_settings=mc_settings, clobbermodel=clobbermodel, out_settings=out_settings)
+
+def RUN_AGNfitter_onesource_worker(line):
+    """
+    Fit the source in line with the inputs of this processor (attach_worker).
+    """
+    return RUN_AGNfitter_onesource_independent(line, WORKER['data_obj'], WORKER['filters'], WORKER['models_settings'], WORKER['mc_settings'], \
+                                               WORKER['out_settings'], WORKER['clobbermodel'])
 
-            try:            
-                PLOTandWRITE_AGNfitter.main(data, models,  P,  out, models_settings, mc_settings)
-                print ( 'Done already'  )      
-            except:
-                print ( 'Not done yet')
-                MCMC_AGNfitter.main(data, models, P, mc) 
-                PLOTandWRITE_AGNfitter.main(data, models, P, out, models_settings, mc_settings)        
+def RUN_AGNfitter_chunk_worker(line, catalog_folder):
+    """
+    Fit the source in line of the chunk of the catalog shared in catalog_folder (RUN_AGNfitter_stream),
+    with the inputs of this processor (attach_worker). The chunk is mapped into memory once per processor.
+    """
+    if WORKER['catalog_folder'] != catalog_folder:
+        data_obj = DATA_all(WORKER['cat'], WORKER['filters'])
+        data_obj.ATTACH(catalog_folder)
+        WORKER.update(data_obj=data_obj, catalog_folder=catalog_folder)
+    return RUN_AGNfitter_onesource_worker(line)
 
-            print ( '_____________________________________________________')
-            print ( 'For this fit %.2g min elapsed'% ((time.time() - t1)/60.))
+def RUN_AGNfitter_batch_worker(lines):
+    """
+    Fit the batch of sources in lines with the inputs of this processor (attach_worker).
+    """
+    return RUN_AGNfitter_batch(lines, WORKER['data_obj'], WORKER['filters'], WORKER['models_settings'], WORKER['mc_settings'], \
+                               WORKER['out_settings'], WORKER['clobbermodel'])
 
-        except EOFError: 
-            print ( 'Line ',line,' cannot be fitted.')
+def RUN_AGNfitter_distributed_worker(catalog_folder, cat, filters, models_settings, mc_settings, out_settings, clobbermodel=False):
+    """
+    One process of a distributed run (-d): claims and fits sources until none are left.
+    """
+    attach_worker(catalog_folder, cat, filters, models_settings, mc_settings, out_settings, clobbermodel)
+    leases.run_worker(RUN_AGNfitter_onesource_worker, range(cat['nsources']), (), mc_settings, cat['output_folder']+'LEASES/', \
+                      cat['workingpath']+'error.log', names=WORKER['data_obj'].name)
 
-    
 def multi_run_wrapper_indep(args):
     """
     wrapper to allow calling RUN_AGNfitter_onesource in pool.map
     """
     return RUN_AGNfitter_onesource_independent(*args)
 
-def RUN_AGNfitter_multiprocessing(processors, data_obj, models_settings, mc_settings, indep_bool=False, filters='None'):
+def RENDER_diagnostics(processors, data_obj, sourcenumber=-1, clobber=False):
+    """
+    Render the UltraNest diagnostic plots (run, trace and corner) of sources
+    fitted in headless batch mode (-b). Runs for all sources of the catalog, 
+    or only for the source in line sourcenumber.
+    """
+    nsources = data_obj.cat['nsources']
+    lines = [sourcenumber] if sourcenumber >= 0 else range(nsources)
+    log_dirs = [data_obj.output_folder+str(data_obj.name[i])+'/ultranest' for i in lines]
+    log_dirs = [d for d in log_dirs if os.path.lexists(d+'/diagnostics.sav')]
+
+    print ( "rendering diagnostic plots of {0:d} sources with {1:d} cpus".format(len(log_dirs), processors))
+
+    if processors > 1:
+        pool = mp.Pool(processes = processors)
+        rendered = pool.starmap(MCMC_AGNfitter.render_diagnostics, zip(log_dirs, itertools.repeat(clobber)))
+        pool.close()
+        pool.join()
+    else:
+        rendered = [MCMC_AGNfitter.render_diagnostics(d, clobber) for d in log_dirs]
+
+    print ( '- {0:d} sources rendered, {1:d} already up to date'.format(sum(rendered), len(rendered)-sum(rendered)))
+
+
+def RUN_AGNfitter_multisource(processors, data_obj, filters, models_settings, mc_settings, out_settings, sourcenumber=-1, clobbermodel=False):
+    """
+    Main function for fitting a catalog with the batched likelihood engine (-m).
+    The sources are split in batches of mc['batch_size'], which are
+    distributed over the chosen number of processors.
+    """
+    if mc_settings['sampling_algorithm'] != 'emcee':
+        sys.exit('The batched fits (-m) are only available with the emcee algorithm (mc["sampling_algorithm"]).')
+
+    nsources = data_obj.cat['nsources']
+    lines = [sourcenumber] if sourcenumber >= 0 else list(range(nsources))
+    if mc_settings.get('cost_ordering', True):
+        ## most expensive sources first, and sources of similar cost in the same batch
+        lines = costs.order_by_cost(data_obj, lines, models_settings, MANIFEST(manifest_name(data_obj.cat)))
+    batches = [lines[i:i+mc_settings['batch_size']] for i in range(0, len(lines), mc_settings['batch_size'])]
+
+    print ( "processing {0:d} sources in {1:d} batches with {2:d} cpus".format(len(lines), len(batches), processors))
+
+    if processors > 1:
+        catalog_folder = data_obj.SHARE(data_obj.cat['output_folder']+'SHARED_CATALOG/')
+        pool = mp.Pool(processes = processors, initializer = attach_worker, \
+                       initargs = (catalog_folder, data_obj.cat, filters, models_settings, mc_settings, out_settings, clobbermodel))
+        pool.map(RUN_AGNfitter_batch_worker, batches)
+        pool.close()
+        pool.join()
+    else:
+        for batch in batches:
+            RUN_AGNfitter_batch(batch, data_obj, filters, models_settings, mc_settings, out_settings, clobbermodel)
+
+
+def RUN_AGNfitter_distributed(processors, data_obj, filters, models_settings, mc_settings, out_settings, clobbermodel=False):
+    """
+    Main function for fitting a catalog with several independent runs (-d),
+    e.g. on different nodes sharing the output folder. Every run claims the sources
+    with lease files (LEASES_AGNfitter.py), with the chosen number of processors.
+    """
+    catalog_folder = data_obj.SHARE(data_obj.cat['output_folder']+'SHARED_CATALOG/')
+    initargs = (catalog_folder, data_obj.cat, filters, models_settings, mc_settings, out_settings, clobbermodel)
+
+    print ( "claiming sources of the catalog with {0:d} cpus".format(processors))
+
+    if processors > 1:
+        workers = [mp.Process(target = RUN_AGNfitter_distributed_worker, args = initargs) for i in range(processors)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    else:
+        RUN_AGNfitter_distributed_worker(*initargs)
+
+
+def RUN_AGNfitter_multiprocessing(processors, data_obj, models_settings, mc_settings, out_settings, indep_bool=False, filters='None', clobbermodel=False, lines=None):
     """
     Main function for fitting all sources in a large catalog.
     Splits the job of running the large number of sources
     into a chosen number of processors.
+    Only the sources in lines are fitted, if given.
     """
     
     if indep_bool==False:
@@ -262,13 +349,88 @@ def RUN_AGNfitter_multiprocessing(processors, data_obj, models_settings, mc_sett
         pool.join() 
     else:
         nsources = data_obj.cat['nsources']
+        if lines is None:
+            lines = data_obj.LINES()
+        if mc_settings.get('cost_ordering', True):
+            ## most expensive sources first (COSTS_AGNfitter.py)
+            lines = costs.order_by_cost(data_obj, lines, models_settings, MANIFEST(manifest_name(data_obj.cat)))
+        groups = None
+        if mc_settings.get('source_groups', True):
+            ## sources of the same models and valid bands are fitted by the same processor, in order of redshift (COSTS_AGNfitter.py)
+            groups = costs.group_sources(data_obj, lines, models_settings, processors)
         
-        print ( "processing all {0:d} sources with {1:d} cpus".format(nsources, processors) )
+        print ( "processing {0:d} of {1:d} sources with {2:d} cpus".format(len(lines), nsources, processors) )
         
-        pool = mp.Pool(processes = processors)
-        catalog_fitting = pool.map(multi_run_wrapper_indep, zip(range(nsources), itertools.repeat(data_obj), itertools.repeat(filters), itertools.repeat(models_settings), itertools.repeat(mc_settings) ))
-        pool.close()
-        pool.join()
+        ## work queue: unordered completion, wall-time limits and retries (SCHEDULER_AGNfitter.py)
+        ## failures are recorded in error.log of the working path
+        if processors > 1:
+            ## the catalog is shared through memory-mapped files, the tasks only carry the source lines
+            catalog_folder = data_obj.SHARE(data_obj.cat['output_folder']+'SHARED_CATALOG/')
+            catalog_fitting = scheduler.run_catalog(RUN_AGNfitter_onesource_worker, lines, (), processors, mc_settings, \
+                                                    data_obj.cat['workingpath']+'error.log', names=data_obj.NAMES(), initializer=attach_worker, \
+                                                    initargs=(catalog_folder, data_obj.cat, filters, models_settings, mc_settings, out_settings, clobbermodel), groups=groups)
+        else:
+            catalog_fitting = scheduler.run_catalog(RUN_AGNfitter_onesource_independent, lines, (data_obj, filters, models_settings, mc_settings, out_settings, clobbermodel), \
+                                                    processors, mc_settings, data_obj.cat['workingpath']+'error.log', names=data_obj.NAMES(), groups=groups)
+
+
+def RUN_AGNfitter_stream(processors, data_obj, filters, models_settings, mc_settings, out_settings, clobbermodel=False):
+    """
+    Main function for fitting catalogs larger than the memory (cat['stream_chunksize']).
+    The catalog is read in chunks (DATA_all.STREAM), which are fitted by one pool of processors:
+    the next chunk is read while the current one is fitted, and its sources are queued behind 
+    the sources of the current chunk (SCHEDULER_AGNfitter.run_stream).
+    """
+    chunksize = data_obj.cat['stream_chunksize']
+    print ( "reading the catalog in chunks of {0:d} sources".format(chunksize))
+
+    stream = data_obj.STREAM(chunksize)
+    first = next(stream, None)
+    if first is None:
+        return
+    if mc_settings.get('resource_planner', True):
+        processors = PLAN_resources(processors, first, len(first.z), models_settings, mc_settings)
+
+    def chunks():
+        for chunk in itertools.chain([first], stream):
+            lines = chunk.LINES()
+            if mc_settings.get('cost_ordering', True):
+                ## most expensive sources first (COSTS_AGNfitter.py)
+                lines = costs.order_by_cost(chunk, lines, models_settings, MANIFEST(manifest_name(chunk.cat)))
+            groups = None
+            if mc_settings.get('source_groups', True):
+                groups = costs.group_sources(chunk, lines, models_settings, processors)
+            if processors > 1:
+                ## the processors map the chunk from its shared files (RUN_AGNfitter_chunk_worker)
+                args = (chunk.SHARE(chunk.cat['output_folder']+'SHARED_CATALOG/'),)
+            else:
+                args = (chunk, filters, models_settings, mc_settings, out_settings, clobbermodel)
+            yield lines, args, chunk.NAMES(), groups
+
+    print ( "processing the chunks with {0:d} cpus".format(processors) )
+    logfile = data_obj.cat['workingpath']+'error.log'
+    if processors > 1:
+        catalog_folder = first.SHARE(first.cat['output_folder']+'SHARED_CATALOG/')
+        scheduler.run_stream(RUN_AGNfitter_chunk_worker, chunks(), processors, mc_settings, logfile, initializer=attach_worker, \
+                             initargs=(catalog_folder, first.cat, filters, models_settings, mc_settings, out_settings, clobbermodel))
+    else:
+        scheduler.run_stream(RUN_AGNfitter_onesource_independent, chunks(), processors, mc_settings, logfile)
+
+
+def PLAN_resources(ncpu, data_obj, nfits, models_settings, mc_settings):
+    """
+    Split the cores between sources fitted at the same time, evaluators of each source
+    and threads of the numerical libraries (RESOURCES_AGNfitter.py).
+    output
+        number of sources fitted at the same time
+    """
+    ndim = int(np.median(costs.source_features(data_obj, data_obj.LINES(), models_settings)[0]))
+    plan = resources.plan(ncpu, nfits, ndim, mc_settings)
+    mc_settings['evaluators'], mc_settings['threads'] = plan['evaluators'], plan['threads']
+    resources.limit_threads(plan['threads'])
+    print ( '> {0:d} cpus: {1:d} sources at a time, {2:d} evaluators per source, {3:d} threads per process'.format(\
+            ncpu, plan['processes'], plan['evaluators'], plan['threads']))
+    return plan['processes']
 
 
 
@@ -282,31 +444,61 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--sourcenumber", type=int, default=-1, help="specify a single source number to run (this is the line number in hte catalogue not the source id/name)")
     parser.add_argument("-i","--independent", action="store_true", help="run independently per source, i.e. do not create a global model dictionary")
     parser.add_argument("-o","--overwrite", action="store_true", help="overwrite model files")
+    parser.add_argument("-b","--headless", action="store_true", help="batch mode: only write the chains, defer the UltraNest diagnostic plots to -r")
+    parser.add_argument("-r","--render", action="store_true", help="only render the deferred UltraNest diagnostic plots of sources fitted with -b")
+    parser.add_argument("-m","--multisource", action="store_true", help="fit batches of mc['batch_size'] sources together with the batched likelihood engine (emcee only)")
+    parser.add_argument("-s","--status", action="store_true", help="only print the state of the sources of the catalog (run manifest)")
+    parser.add_argument("--redo-failed", action="store_true", help="fit again only the sources which failed (run manifest)")
+    parser.add_argument("-d","--distributed", action="store_true", help="claim sources with lease files, to share a catalog between several runs/nodes")
+    parser.add_argument("--serve", type=str, metavar="SOCKET", help="run as a fit service, taking the photometry of sources on the Unix socket SOCKET")
+    parser.add_argument("--serve-settings", type=str, nargs="+", default=[], metavar="FILE", help="other settings files offered by the fit service (--serve)")
     
     
     
     args = parser.parse_args()
     
-    #py2 execfile(args.AGNfitterSettings)
-    exec (compile(open(args.AGNfitterSettings).read(), args.AGNfitterSettings, 'exec'))
+    settings = api.load_settings(args.AGNfitterSettings)
     
     if args.overwrite:
         clobbermodel = True
     else:
         clobbermodel = False
     
-    try:
-        cat_settings = CATALOG_settings()
-        filters_settings= FILTERS_settings()
-        models_settings= MODELS_settings()
-        mc_settings= MCMC_settings()
-    except NameError:
-        print ( "Something is wrong with your setting file")
-        sys.exit(1)
+    cat_settings = settings['cat']
+    filters_settings= settings['filters']
+    models_settings= settings['models']
+    mc_settings= settings['mc']
+    out_settings= settings['out']
+
+    if args.serve:
+        ## the settings are named after their files, e.g. 'SETTINGS_AGNfitter'
+        offered = dict((os.path.splitext(os.path.basename(f))[0], api.load_settings(f)) for f in [args.AGNfitterSettings]+args.serve_settings)
+        service.serve(args.serve, offered)
+        sys.exit(0)
+
+    if args.headless:
+        mc_settings['diagnostic_plots'] = False
         
 
-    data_ALL = DATA_all(cat_settings, filters_settings)
-    data_ALL.PROPS()
+    ## catalogs larger than the memory are read and fitted in chunks
+    if cat_settings.get('stream_chunksize', 0) > 0 and (args.redo_failed or args.multisource or args.distributed):
+        print ( "Warning: cat['stream_chunksize'] is ignored with -m, -d and --redo-failed, the whole catalog is read into memory." )
+    if cat_settings.get('stream_chunksize', 0) > 0 and args.sourcenumber < 0 and not \
+       (args.render or args.status or args.redo_failed or args.multisource or args.distributed):
+        if not os.path.isdir(cat_settings['output_folder']):
+            os.system('mkdir -p '+os.path.abspath(cat_settings['output_folder']))
+        RUN_AGNfitter_stream(args.ncpu, DATA_all(cat_settings, filters_settings), filters_settings, models_settings, mc_settings, \
+                             clobbermodel=clobbermodel, out_settings=out_settings)
+        print ( '======= : =======')
+        print ( 'Process finished.')
+        sys.exit(0)
+
+    ## columnar catalogs are read only in the row of the source fitted (option -n)
+    if cat_settings['filetype'] in catalogs.COLUMNAR and args.sourcenumber >= 0 and not \
+       (args.render or args.status or args.redo_failed or args.multisource or args.distributed):
+        data_ALL = DATA_all(cat_settings, filters_settings).ROWS(args.sourcenumber, args.sourcenumber+1)
+    else:
+        data_ALL = api.load_catalog(settings)
     nsources = data_ALL.cat['nsources']
 
     ## make sure the output paths exist
@@ -318,32 +510,74 @@ if __name__ == "__main__":
 
     if not os.path.isdir(mpath):
         os.system('mkdir -p '+os.path.abspath(mpath))
+
+    if args.render:
+        RENDER_diagnostics(args.ncpu, data_ALL, args.sourcenumber, clobber=clobbermodel)
+        print ( '======= : =======')
+        print ( 'Process finished.')
+        sys.exit(0)
     
 
+    if args.status:
+        MANIFEST(manifest_name(cat_settings)).status(nsources, api.fit_settings_hash(filters_settings, models_settings, mc_settings))
+        sys.exit(0)
+
+    if args.redo_failed:
+        failed = MANIFEST(manifest_name(cat_settings)).lines('failed')
+
+    ## split the cores between sources fitted at the same time, evaluators of each source
+    ## and threads of the numerical libraries (RESOURCES_AGNfitter.py)
+    if mc_settings.get('resource_planner', True):
+        if args.redo_failed:
+            nfits = len(failed)
+        elif args.sourcenumber >= 0:
+            nfits = 1
+        else:
+            nfits = nsources
+        if args.multisource:
+            nfits = int(np.ceil(nfits/mc_settings['batch_size']))
+        args.ncpu = PLAN_resources(args.ncpu, data_ALL, nfits, models_settings, mc_settings)
+
+    if args.redo_failed:
+        RUN_AGNfitter_multiprocessing(args.ncpu, data_ALL, models_settings, mc_settings, indep_bool=True, filters=filters_settings, clobbermodel=clobbermodel, lines=failed, out_settings=out_settings)
+        print ( '======= : =======')
+        print ( 'Process finished.')
+        sys.exit(0)
+
+    if args.distributed:
+        RUN_AGNfitter_distributed(args.ncpu, data_ALL, filters_settings, models_settings, mc_settings, clobbermodel=clobbermodel, out_settings=out_settings)
+        print ( '======= : =======')
+        print ( 'Process finished.')
+        sys.exit(0)
+
+    if args.multisource:
+        RUN_AGNfitter_multisource(args.ncpu, data_ALL, filters_settings, models_settings, mc_settings, sourcenumber=args.sourcenumber, clobbermodel=clobbermodel, out_settings=out_settings)
+        print ( '======= : =======')
+        print ( 'Process finished.')
+        sys.exit(0)
+
     # run for one source only and construct dictionary only for this source
     if args.independent:
         if args.ncpu>1.:
             
-            RUN_AGNfitter_multiprocessing(args.ncpu, data_ALL, models_settings, mc_settings, indep_bool=True, filters=filters_settings)
+            RUN_AGNfitter_multiprocessing(args.ncpu, data_ALL, models_settings, mc_settings, indep_bool=True, filters=filters_settings, out_settings=out_settings)
 
         elif args.sourcenumber >= 0:
-            RUN_AGNfitter_onesource_independent(args.sourcenumber, data_ALL, filters_settings, models_settings, mc_settings, clobbermodel=clobbermodel)
+            RUN_AGNfitter_onesource_independent(args.sourcenumber, data_ALL, filters_settings, models_settings, mc_settings, clobbermodel=clobbermodel, out_settings=out_settings)
         else:
-            for i in range(0, nsources, 1):
-                RUN_AGNfitter_onesource_independent(i, data_ALL, filters_settings, models_settings, mc_settings, clobbermodel=clobbermodel)
+            RUN_AGNfitter_multiprocessing(1, data_ALL, models_settings, mc_settings, indep_bool=True, filters=filters_settings, clobbermodel=clobbermodel, out_settings=out_settings)
             
     else:
         print('Option of one single dictionary for a whole catalogue is deprecated. Running "independent, -i" option.')
 
         if args.ncpu>1.:
             
-            RUN_AGNfitter_multiprocessing(args.ncpu, data_ALL, models_settings, mc_settings, indep_bool=True, filters=filters_settings)
+            RUN_AGNfitter_multiprocessing(args.ncpu, data_ALL, models_settings, mc_settings, indep_bool=True, filters=filters_settings, out_settings=out_settings)
 
         elif args.sourcenumber >= 0:
-            RUN_AGNfitter_onesource_independent(args.sourcenumber, data_ALL, filters_settings, models_settings, mc_settings, clobbermodel=clobbermodel)
+            RUN_AGNfitter_onesource_independent(args.sourcenumber, data_ALL, filters_settings, models_settings, mc_settings, clobbermodel=clobbermodel, out_settings=out_settings)
         else:
-            for i in range(0, nsources, 1):
-                RUN_AGNfitter_onesource_independent(i, data_ALL, filters_settings, models_settings, mc_settings, clobbermodel=clobbermodel)
+            RUN_AGNfitter_multiprocessing(1, data_ALL, models_settings, mc_settings, indep_bool=True, filters=filters_settings, clobbermodel=clobbermodel, out_settings=out_settings)
        
         
     print ( '======= : =======')
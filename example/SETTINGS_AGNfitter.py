@@ -32,6 +32,10 @@ def CATALOG_settings():
     cat['path'] = '/home/user/AGNfitter/' #path to the AGNfitter code
     cat['filename'] = cat['path']+ 'data/catalog_example.txt'  
     cat['filetype'] = 'ASCII'		## catalog file type: 'ASCII' or 'FITS'. 
+                                        ## Columnar catalogs 'PARQUET', 'ARROW' (Feather) or 'HDF5' 
+                                        ## are read only in the columns and rows used, with
+                                        ## the column names of FITS catalogs.
+    #cat['hdf5_path'] = 'data'          ## If HDF5: path of the table in the file (default: first table)
     cat['name'] = 0			## If ASCII: Column index (int) of source IDs
                                    	## If FITS : Column name (str). E.g. 'ID'
     cat['redshift'] = 1       		## If ASCII:  Column index(int) of redshift 
@@ -70,6 +74,10 @@ def CATALOG_settings():
     cat['ndflag_list'] = 'list'         ## If ASCII: List of column indexes (int)
                                         ## If FITS: List of column names (str)    
 
+    ##LARGE CATALOGS
+    cat['stream_chunksize'] = 0         ## Number of sources read and fitted at a time, for catalogs
+                                        ## larger than the memory (0: read the whole catalog at once)
+
     ## COSTUMIZED WORKING PATHS
     cat['workingpath'] = cat['path']  # Allows for a working path other than the AGNfitter code path.
                                       # Will include:
@@ -259,7 +267,7 @@ def MCMC_settings():
     =================================="""
 
     mc = dict()
-    mc['sampling_algorithm'] = 'ultranest' #ultranest or emcee
+    mc['sampling_algorithm'] = 'ultranest' #ultranest, emcee or optimizer (fast MAP + Laplace approximation)
 
     # If mcmc algorithm is emcee, please define the following values, otherwise just keep the current values
     mc['Nwalkers'] = 100	## number of walkers 
@@ -275,6 +283,36 @@ def MCMC_settings():
     mc['live_points'] = 400	# Number of initial live points to explore the space parameter
     mc['min_ess'] = 400		# Minimum number of effective samples
     mc['num_loops'] = 0		# How many times to go back and improve
+    mc['diagnostic_plots'] = True	# If False (or option -b), only the chains are written during sampling and the run, 
+                                	# trace and corner plots are rendered afterwards with option -r
+
+   # If mcmc algorithm is optimizer, please define the following values, otherwise just keep the current values
+    mc['optimizer_starts'] = 5		# Number of starting points of the MAP optimization
+    mc['optimizer_samples'] = 2000	# Number of posterior samples drawn from the Laplace approximation
+
+    # Warm start: initialize the fits from the posteriors of similar sources fitted before
+    mc['warm_start'] = False		# If True, completed fits are added to the library and new fits start from their nearest neighbours
+    mc['warm_start_library'] = 'WARMSTART/'	# Folder of the library, inside the output folder
+    mc['warm_start_neighbours'] = 5	# Number of similar sources whose posteriors seed a new fit
+    mc['warm_start_burnfrac'] = 0.25	# emcee: fraction of Nburn used for each burn-in set of warm-started fits
+
+    # Batched fits (option -m, emcee only): sources fitted together in one likelihood engine
+    mc['batch_size'] = 16		# Number of sources per batch. Memory grows as batch_size x Nwalkers x Nmcmc x Npar
+
+    # Catalog work queue (fits of many sources, option -c)
+    mc['sources_chunksize'] = 1	# Number of sources (groups of sources, with source_groups) sent to a processor at a time
+    mc['source_timeout'] = 0		# Wall-time limit of the fit of one source in seconds (0: no limit)
+    mc['source_retries'] = 1		# Times a failed or timed-out source is tried again. Failures are written to error.log
+    mc['cost_ordering'] = True		# Fit the most expensive sources first (estimated from the number of parameters and bands, and previous timings), not with -d
+    mc['resource_planner'] = True	# Split the cores (-c) between sources fitted at the same time, likelihood evaluators of each source (emcee, optimizer)
+					# and threads of the numerical libraries, to avoid oversubscription. If False, -c processes with default threads
+    mc['source_groups'] = True		# Hand out the sources in small groups of the same radio/X-ray models and valid bands, in order of redshift, each group
+					# to one processor, which keeps the model dictionary of sources at the same redshift in memory.
+					# Sources at the same redshift share one model dictionary in any case (output folder, SHARED_DICTIONARIES/)
+
+    # Distributed runs (option -d): several runs/nodes share a catalog through lease files in the output folder
+    mc['lease_expiry'] = 600		# Seconds without heartbeat after which the source of a crashed run is claimed again
+    mc['lease_heartbeat'] = 30		# Seconds between renewals of the lease of the source being fitted
 
     return mc
 
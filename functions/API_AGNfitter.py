@@ -0,0 +1,414 @@
+"""%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+      API_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+This script contains the Python interface of AGNfitter, to fit sources from
+a notebook or a pipeline without going through RUN_AGNfitter_multi.py:
+
+    from functions import API_AGNfitter as agnfitter
+    settings = agnfitter.load_settings('example/SETTINGS_AGNfitter.py')
+    records = agnfitter.fit_sources(settings, [0, 1, 2])
+
+The settings are a dictionary with the dictionaries of the settings file,
+settings['cat'], ['filters'], ['models'], ['mc'] and ['out'], which can be
+changed between calls. Everything expensive stays loaded in the Python process
+between calls: the catalogs (DATA_all.PROPS), the template libraries and filter sets
+(DICTIONARIES_AGNfitter.load_templates, load_filterset) and the model dictionaries
+of the last sources fitted. Sources at the same redshift with the same models share 
+one model dictionary, saved once in the output folder (SHARED_DICTIONARIES/), to which 
+their source folders link (source_dictionary), and COSTS_AGNfitter.group_sources hands 
+out such sources together.
+RUN_AGNfitter_multi.py fits every source through fit_source().
+
+This script includes:
+- functions load_settings, fit_settings_hash
+- functions load_catalog, shared_dictionary, clobber_marker, source_dictionary
+- functions source_models, prepare_source
+- functions fit_source, fit_sources
+
+"""
+import sys,os
+import time
+import socket
+import pickle
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from astropy import units as u
+from . import MCMC_AGNfitter, PLOTandWRITE_AGNfitter
+from . import SCHEDULER_AGNfitter as scheduler
+from .LEASES_AGNfitter import LeaseLost
+from . import COSTS_AGNfitter as costs
+from . import PARAMETERSPACE_AGNfitter as parspace
+from .DATA_AGNfitter import DATA, DATA_all
+from .MODEL_AGNfitter import MODELS
+from .DICTIONARIES_AGNfitter import MODELSDICT, FILTERING_VERSION, load_filterset
+from .SAMPLERS_AGNfitter import get_sampler
+from .MANIFEST_AGNfitter import MANIFEST, manifest_name, settings_hash
+
+
+SETTINGS = OrderedDict([('cat', 'CATALOG_settings'), ('filters', 'FILTERS_settings'), ('models', 'MODELS_settings'),
+                        ('mc', 'MCMC_settings'), ('out', 'OUTPUT_settings')])
+## settings of the sampling which change the posterior of a fit (fit_settings_hash())
+FIT_SETTINGS = ('sampling_algorithm', 'Nwalkers', 'Nburnsets', 'Nburn', 'Nmcmc',
+                'direction_generation', 'live_points', 'min_ess', 'num_loops',
+                'optimizer_starts', 'optimizer_samples',
+                'warm_start', 'warm_start_neighbours', 'warm_start_burnfrac')
+MAX_DICTIONARIES = 2        # model dictionaries of the last sources kept in memory (up to ~200 MB each)
+
+## Catalogs, model dictionaries and models of the likelihood (MODELS.DICTS) loaded in this process
+CATALOGS = dict()
+DICTIONARIES = OrderedDict()
+CONTEXTS = OrderedDict()
+## Run of this process and its processors, for the shared dictionaries built again (clobber_marker())
+RUN_ID = os.environ.setdefault('AGNFITTER_RUN_ID', '%s.%d.%d' % (socket.gethostname(), os.getpid(), int(time.time())))
+
+
+def load_settings(filename):
+
+    """
+    Reads a settings file (example/SETTINGS_AGNfitter.py).
+
+    ##input:
+    - filename of the settings file
+
+    ##output:
+    - dictionary with the settings dictionaries 'cat', 'filters', 'models', 'mc' and 'out'
+    """
+    ## settings files use the modules imported by RUN_AGNfitter_multi.py without importing them
+    namespace = dict(__file__=filename, __name__='AGNfitter_settings', np=np, u=u, os=os, sys=sys)
+    with open(filename) as f:
+        exec (compile(f.read(), filename, 'exec'), namespace)
+    try:
+        return dict((key, namespace[function]()) for key, function in SETTINGS.items())
+    except KeyError as e:
+        sys.exit('Something is wrong with your setting file '+filename+': '+str(e)+' is missing.')
+
+
+def fit_settings_hash(filters_settings, models_settings, mc_settings):
+    """
+    Hash of the settings of the fits, recorded in the run manifest.
+    Only the mcmc settings in FIT_SETTINGS are hashed: changing the processors,
+    the scheduling or the plots does not make the fits done before stale.
+    """
+    filters = dict((k, v) for k, v in filters_settings.items() if k != 'dict_zarray')
+    mc = dict((k, mc_settings[k]) for k in FIT_SETTINGS if k in mc_settings)
+    return settings_hash(filters, models_settings, mc)
+
+
+def load_catalog(settings):
+
+    """
+    Object DATA_all of the catalog of the settings, read only once per process
+    (again if the catalog file or the settings change).
+    """
+    cat = settings['cat']
+    key = (cat['filename'], os.path.getmtime(cat['filename']) if os.path.lexists(cat['filename']) else None, \
+           settings_hash(dict((k, v) for k, v in cat.items() if k != 'nsources'), settings['filters']))
+    if key not in CATALOGS:
+        data_obj = DATA_all(cat, settings['filters'])
+        data_obj.PROPS()
+        CATALOGS[key] = data_obj
+    data_obj = CATALOGS[key]
+    cat['nsources'] = data_obj.cat['nsources']
+    return data_obj
+
+
+def shared_dictionary(settings, z, nRADdata, nXRaysdata):
+
+    """
+    File name of the model dictionary shared by the sources at redshift z with the same radio 
+    and X-ray models (COSTS_AGNfitter.model_variant), in the folder SHARED_DICTIONARIES/ of the 
+    output folder. It depends on the models settings, the filter set (settings['filters']['path'], 
+    ['filterset']) and FILTERING_VERSION, and not on the bands used, which are merged into
+    the dictionary when they change (MODELSDICT.update_filters).
+    """
+    rad, xrays = costs.model_variant(settings['models'], nRADdata, nXRaysdata)
+    filterset = dict((k, settings['filters'].get(k)) for k in ('path', 'filterset'))
+    return settings['cat']['output_folder'] + 'SHARED_DICTIONARIES/MODELSDICT_z{0!r}_rad{1}_xrays{2}_v{3:d}_{4:s}'.format(\
+           float(z), rad, xrays, FILTERING_VERSION, settings_hash(settings['models'], filterset))
+
+
+def clobber_marker(shared):
+
+    """
+    Marks the shared dictionary to be built again in this run (clobbermodel): the first processor 
+    of the run to get here creates the marker file next to the dictionary (O_EXCL), and every
+    dictionary older than the marker is built again (source_dictionary). 
+    The run is named by the environment variable AGNFITTER_RUN_ID, which is set in the first 
+    process and inherited by its processors; several nodes of a run (-d) can export the same value.
+    The markers are empty files, left for other processors of the run which may still read them.
+
+    ##output:
+    - file name of the marker of this run
+    """
+    marker = shared + '.clobbered.' + RUN_ID
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        pass
+    return marker
+
+
+def source_dictionary(data, settings, clobbermodel=False):
+
+    """
+    Model dictionary at the redshift of the source, in the output folder of the source.
+    The dictionary is saved once for all the sources with the same redshift and models
+    (shared_dictionary()), and the source folder links to it. It is constructed only if it 
+    does not exist yet (or clobbermodel, once per run: clobber_marker()), updated if the 
+    filters changed (MODELSDICT.update_filters), and the last MAX_DICTIONARIES dictionaries
+    are kept in memory.
+
+    ##input:
+    - object data of class DATA (DATA_AGNfitter.py)
+    - dictionary settings (load_settings())
+
+    ##output:
+    - object of class MODELSDICT
+    """
+    sourcefolder = settings['cat']['output_folder'] +str(data.name)
+    if not os.path.lexists(sourcefolder):
+        os.system('mkdir -p ' + sourcefolder)
+
+    dictz = sourcefolder +'/MODELSDICT_' + str(data.name)
+    filtersz = dict(settings['filters'], dict_zarray=[data.z])
+    shared = shared_dictionary(settings, data.z, data.nRADdata, data.nXRaysdata)
+    fithash = fit_settings_hash(filtersz, settings['models'], dict())
+    if not os.path.isdir(os.path.dirname(shared)):
+        os.makedirs(os.path.dirname(shared), exist_ok=True)
+
+    ## remove this source modelsdict if it already exists and we want to remove it,
+    ## and the shared one if it was built before this run
+    marker = None
+    if clobbermodel and os.path.lexists(dictz):
+        os.system('rm -rf '+dictz)
+        print ( "removing source model dictionary "+dictz )
+    if clobbermodel:
+        marker = clobber_marker(shared)
+
+    def mtime(filename):
+        return os.path.getmtime(filename) if os.path.exists(filename) else None
+
+    def fresh(filename):
+        return mtime(filename) is not None and (marker is None or mtime(filename) >= mtime(marker))
+
+    ## link to the dictionary of another redshift or other settings, or to a removed one
+    if os.path.islink(dictz) and (not fresh(dictz) or os.path.realpath(dictz) != os.path.realpath(shared)):
+        os.remove(dictz)
+
+    ## the dictionary in memory, if the shared file was not written again since it was read
+    key = (shared, data.z, fithash, mtime(shared))
+    if key in DICTIONARIES and fresh(shared):
+        DICTIONARIES.move_to_end(key)
+        if not os.path.lexists(dictz):
+            os.symlink(os.path.abspath(shared), dictz)
+        return DICTIONARIES[key]
+
+    zdict = None
+    if os.path.lexists(dictz) and not os.path.islink(dictz):
+        ## dictionary of the source only, saved before the dictionaries were shared
+        with open(dictz, 'rb') as f:
+            zdict = pd.read_pickle(f)
+        if not np.isclose(zdict.z, data.z):
+            ## dictionary of an earlier source with the same name (e.g. fit service)
+            print ( '> The model dictionary '+dictz+' is for z=%.4g, constructing it again'% zdict.z )
+            os.remove(dictz)
+            zdict = None
+        elif not zdict.up_to_date():
+            ## filtered with an older filtering_models (DICTIONARIES_AGNfitter.FILTERING_VERSION)
+            print ( '> The model dictionary '+dictz+' was filtered with an older method, constructing it again' )
+            os.remove(dictz)
+            zdict = None
+        filename = dictz
+
+    if zdict is None and fresh(shared):
+        ## dictionary of another source at the same redshift, with the same models.
+        ## It can be removed by another run meanwhile (clobbermodel), and is then built again
+        try:
+            with open(shared, 'rb') as f:
+                zdict = pd.read_pickle(f)
+        except (FileNotFoundError, EOFError):
+            zdict = None
+        filename = shared
+        if zdict is not None and not os.path.lexists(dictz):
+            os.symlink(os.path.abspath(shared), dictz)
+            print ( '> The model dictionary '+dictz+' links to '+shared )
+
+    if zdict is not None:
+        ## dictionary of other filters: the bands which changed are merged into it
+        fo = load_filterset(filtersz, settings['cat']['path'])
+        if list(zdict.fo.filternames) != list(fo.filternames) or not np.array_equal(zdict.fo.central_nu_array, fo.central_nu_array):
+            added, removed = zdict.update_filters(fo)
+            zdict.filters_list = filtersz
+            ## written under a name unique to this process, as other processors may read the dictionary
+            tmp = filename + '.%d.tmp' % os.getpid()
+            with open(tmp, 'wb') as f:
+                pickle.dump(zdict, f, protocol=2)
+            os.replace(tmp, filename)
+            print ( '> The model dictionary '+filename+' was updated to the filters of the settings ' \
+                    '(%d bands added, %d removed)'% (len(added), len(removed)) )
+
+    if zdict is None:
+        t0 = time.time()
+        ## written under a name unique to this process, as other processors may build the same dictionary
+        tmp = shared + '.%d.tmp' % os.getpid()
+        zdict = MODELSDICT(tmp, settings['cat']['path'], filtersz, settings['models'], data.nRADdata, data.nXRaysdata)
+        zdict.build()
+        zdict.filename = shared
+        with open(tmp, 'wb') as f:
+            pickle.dump(zdict, f, protocol=2)
+        os.replace(tmp, shared)
+        if not os.path.lexists(dictz):
+            os.symlink(os.path.abspath(shared), dictz)
+        print ( '_____________________________________________________')
+        print ( 'For this dictionary creation %.2g min elapsed'% ((time.time() - t0)/60.) )
+
+    DICTIONARIES[(shared, data.z, fithash, mtime(shared))] = zdict
+    while len(DICTIONARIES) > MAX_DICTIONARIES:
+        DICTIONARIES.popitem(last=False)
+    return zdict
+
+
+def source_models(data, settings, clobbermodel=False):
+
+    """
+    Models and parameter space of a source.
+
+    ##input:
+    - object data of class DATA (DATA_AGNfitter.py)
+    - dictionary settings (load_settings())
+
+    ##output:
+    - models, P
+    """
+    models = MODELS(data.z, settings['models'], settings['mc'])
+    try:
+        zdict = source_dictionary(data, settings, clobbermodel)
+    except EOFError:
+        print ( 'Source ',data.name,' cannot be fitted.')
+        raise
+
+    ## the models in the bands of the likelihood are the same for sources with the same dictionary
+    ## (shared by sources at the same redshift, source_dictionary) and the same bands in the likelihood
+    context = (id(zdict.GALAXYFdict), parspace.likelihood_bands(data.nus, data.fluxes, data.z, models).tobytes(), settings_hash(settings['models'], settings['mc']))
+    if context in CONTEXTS and CONTEXTS[context][0] is zdict.GALAXYFdict:
+        CONTEXTS.move_to_end(context)
+        models = CONTEXTS[context][1]
+    else:
+        models.DICTS(dict(settings['filters'], dict_zarray=[data.z]), zdict, data)
+        CONTEXTS[context] = (zdict.GALAXYFdict, models)
+        while len(CONTEXTS) > MAX_DICTIONARIES:
+            CONTEXTS.popitem(last=False)
+    P = parspace.Pdict (data, models)   # Dictionary with all parameter space specifications.
+                                        # From PARAMETERSPACE_AGNfitter.py
+    return models, P
+
+
+def prepare_source(line, data_obj, settings, clobbermodel=False):
+
+    """
+    Data, models and parameter space of the source in line (source_models()).
+    """
+    data = DATA(data_obj,line)
+    models, P = source_models(data, settings, clobbermodel)
+    return data, models, P
+
+
+def fit_source(line, data_obj, settings, clobbermodel=False):
+
+    """
+    Fits the source in line and writes its output.
+    The state of the source is recorded in the run manifest of the catalog (MANIFEST_AGNfitter.py):
+    sources done with the same settings are skipped, and sources with saved chains are only written.
+
+    ##input:
+    - line: catalog line of the source
+    - object data_obj of class DATA_all (DATA_AGNfitter.py)
+    - dictionary settings (load_settings())
+    - clobbermodel: construct the model dictionary again, and fit the source even if it is done
+    """
+    mc_settings = settings['mc']
+    data = DATA(data_obj,line)
+
+    manifest = MANIFEST(manifest_name(settings['cat']))
+    fithash = fit_settings_hash(settings['filters'], settings['models'], mc_settings)
+    if not clobbermodel and manifest.is_done(line, fithash):
+        print ( '- Line ', line, ' (', data.name, ') done already.')
+        return
+
+    print ( '')
+    print ( '________________________'    )
+    print ( 'Fitting sources from catalog: ', data.catalog )
+    print ( '- Sourceline: ', line)
+    print ( '- Sourcename: ', data.name)
+
+    manifest.start(line, data.name, fithash)
+
+    try:
+        models, P = source_models(data, settings, clobbermodel)
+        sourcefolder = settings['cat']['output_folder'] +str(data.name)
+
+        new_chains = not get_sampler(mc_settings).is_done(sourcefolder)
+        if not new_chains:
+            print ( 'Chains saved already')
+        else:
+            t1= time.time()
+            MCMC_AGNfitter.main(data, models, P, mc_settings)
+            manifest.fitted(line, time.time() - t1, len(P['names']), int(np.sum(data.fluxes > -99e-23)))
+            print ( '_____________________________________________________')
+            print ( 'For this fit %.2g min elapsed'% ((time.time() - t1)/60.))
+
+        t2= time.time()
+        PLOTandWRITE_AGNfitter.main(data, models, P, settings['out'], settings['models'], mc_settings, new_chains=new_chains)
+        manifest.done(line, time.time() - t2, os.listdir(sourcefolder))
+
+    except LeaseLost:
+        ## the source is fitted by the run which took over its lease, and recorded by it
+        raise
+    except BaseException as e:
+        ## also the timeouts (SCHEDULER_AGNfitter.SourceTimeout) and interruptions, so that --redo-failed retries them
+        manifest.failed(line, data.name, type(e).__name__+': '+str(e))
+        raise
+
+
+def fit_sources(settings, sources=None, data_obj=None, clobbermodel=False):
+
+    """
+    Fits sources of a catalog in this process, keeping the catalog, templates,
+    filter sets and model dictionaries loaded for the next calls.
+    Failures do not stop the other sources: they are returned and written
+    to error.log in the working path (SCHEDULER_AGNfitter.py).
+
+    ##input:
+    - dictionary settings (load_settings())
+    - sources: catalog line, or list of catalog lines, of the sources (all sources if None)
+    - data_obj: optional object of class DATA_all, instead of the catalog in settings['cat'],
+      e.g. a chunk of a large catalog (DATA_all.STREAM)
+    - clobbermodel: construct the model dictionaries again, and fit sources which are done
+
+    ##output:
+    - records: list with the record of each source (line, name, status, elapsed time, error)
+    """
+    for key in SETTINGS:
+        if key not in settings:
+            raise KeyError('settings["'+key+'"] is missing, see load_settings().')
+
+    if data_obj is None:
+        data_obj = load_catalog(settings)
+    if sources is None:
+        sources = data_obj.LINES()
+    elif np.ndim(sources) == 0:
+        sources = [sources]
+
+    if not os.path.isdir(settings['cat']['output_folder']):
+        os.system('mkdir -p '+os.path.abspath(settings['cat']['output_folder']))
+
+    sources = [int(l) for l in sources]
+    groups = None
+    if settings['mc'].get('source_groups', True):
+        groups = costs.group_sources(data_obj, sources, settings['models'])
+    return scheduler.run_catalog(fit_source, sources, (data_obj, settings, clobbermodel), 1, settings['mc'], \
+                                 settings['cat']['workingpath']+'error.log', names=data_obj.NAMES(), groups=groups)
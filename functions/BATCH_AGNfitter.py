@@ -0,0 +1,373 @@
+"""%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+      BATCH_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+This script contains the batched likelihood engine, used to fit many sources together
+(option -m of RUN_AGNfitter_multi.py).
+
+The model of each source is compiled into arrays: for every component, the fluxes of all
+cells of its parameter grid at the catalog bands, and the response of the fluxes to the free
+parameters (reddening and alpha_ox scatter), which is log-linear: F(x) = F(cell) * R**x.
+Sources with the same parameter space are stacked into (sources x cells x bands) tensors,
+so that the total models and likelihoods of (sources x walkers) parameter vectors are
+computed in one array operation, with the same nearest-grid-value rule as pick_nD().
+
+One emcee ensemble per source (stretch move) is advanced in lock-step, with the burn-in
+and MCMC sets of MCMC_AGNfitter.run_emcee(). The chains are saved in the same files,
+so that all output functions work unchanged.
+The priors of PRIORS_AGNfitter.py need the model dictionaries, and are still evaluated per parameter vector.
+
+This script includes:
+- class COMPONENT
+- class BATCH
+- functions fit_batch, run_emcee_batch, sample_batch
+
+"""
+import os
+import copy
+import time
+import pickle
+import numpy as np
+import emcee
+from . import PARAMETERSPACE_AGNfitter as parspace
+from . import PRIORS_AGNfitter as priors
+from . import WARMSTART_AGNfitter as warmstart
+
+
+class COMPONENT:
+
+    """
+    Class COMPONENT
+
+    Compiled fluxes of one model component (galaxy, starburst, torus, accretion disk or radio) of one source.
+
+    ##input:
+    - obj: get_model object of the component (DICTIONARIES_AGNfitter.dictkey_arrays)
+    - scale: factor applied to all fluxes
+
+    ##output (attributes):
+    - axes: list with the grid values of each parameter (None for free parameters)
+    - fluxes: array (cells x bands), cells ordered as np.ravel_multi_index of the grid axes
+    - responses: array (free parameters x bands), the flux factors for a free parameter of value 1
+    """
+
+    def __init__(self, obj, scale=1.):
+
+        self.types = list(obj.par_types)
+        npar = len(self.types)
+        keys = np.array(obj.pars_modelkeys_float).reshape(npar, -1)
+        bands = list(obj.modelsdict.values())[0][0]
+
+        self.axes = []
+        for i in range(npar):
+            if self.types[i] == 'grid':
+                _, first = np.unique(keys[i], return_index=True)
+                self.axes.append(keys[i][np.sort(first)])    # same order as the first match of pick_nD
+            else:
+                self.axes.append(None)
+        self.grid = [i for i in range(npar) if self.types[i] == 'grid']
+        self.free = [i for i in range(npar) if self.types[i] == 'free']
+        self.shape = tuple(len(self.axes[i]) for i in self.grid)
+
+        base = np.zeros(npar)
+        ncells = int(np.prod(self.shape))
+        self.fluxes = np.full((ncells, len(bands)), np.nan)
+        for cell in range(ncells):
+            idx = np.unravel_index(cell, self.shape)
+            for j, i in enumerate(self.grid):
+                base[i] = self.axes[i][idx[j]]
+            obj.pick_nD(list(base))
+            try:
+                _, Fnu = obj.get_fluxes(obj.matched_parkeys)
+                self.fluxes[cell] = np.asarray(Fnu, dtype=float).flatten() * scale
+            except KeyError:                    # cell missing in the dictionary
+                pass
+
+        ## Free parameters: the same functions of get_fluxes(), applied to unit fluxes
+        probe = copy.copy(obj)
+        probe.modelsdict = UNIT_FLUXES(bands)
+        self.responses = np.ones((len(self.free), len(bands)))
+        for j, i in enumerate(self.free):
+            pars = base.copy()
+            pars[self.free] = 0.
+            pars[i] = 1.
+            probe.pick_nD(list(pars))
+            _, R = probe.get_fluxes(probe.matched_parkeys)
+            self.responses[j] = np.asarray(R, dtype=float).flatten()
+
+
+class UNIT_FLUXES:
+    """ Dictionary-like object returning unit fluxes at the given bands for any key."""
+    def __init__(self, bands):
+        self.bands = bands
+    def __getitem__(self, key):
+        return self.bands, np.ones(len(self.bands))
+
+
+class BATCH:
+
+    """
+    Class BATCH
+
+    Stacked compiled models and data of a group of sources with the same parameter space.
+
+    ##input:
+    - sources: list of (data, models, P) of each source
+
+    """
+
+    def __init__(self, sources):
+
+        self.sources = sources
+        data0, models0, P0 = sources[0]
+        self.names = list(P0['names'])
+        self.settings = models0.settings
+        self.priors = active_priors(models0.settings)
+        self.idxs = P0['idxs']
+
+        compiled = [compile_source(data, models, P) for data, models, P in sources]
+        self.ncomp = len(compiled[0])
+        self.comps = []
+        for c in range(self.ncomp):
+            comp = [compiled[s][c] for s in range(len(sources))]
+            self.comps.append(dict(
+                pars = comp[0][1],
+                norm = comp[0][2],
+                grid = comp[0][0].grid,
+                free = comp[0][0].free,
+                shape = comp[0][0].shape,
+                axes = [np.array([cs[0].axes[i] for cs in comp]) for i in comp[0][0].grid],
+                fluxes = np.array([cs[0].fluxes for cs in comp]),
+                responses = np.array([cs[0].responses for cs in comp])))
+
+        self.y = np.array([data.fluxes for data, models, P in sources])
+        self.ysigma = np.array([data.fluxerrs for data, models, P in sources])
+        self.mask = np.array([valid_bands(data, models) for data, models, P in sources])
+        self.pmin = np.array([P['min'] for data, models, P in sources], dtype=float)
+        self.pmax = np.array([P['max'] for data, models, P in sources], dtype=float)
+
+    def ymodel(self, pars):
+
+        """
+        Total model fluxes of the parameter vectors pars (sources x points x Npar),
+        as parspace.ymodel(). Returns an array (sources x points x bands).
+        """
+        S = np.arange(len(self.sources))[:, None]
+        lum = 0.
+        for comp in self.comps:
+            x = pars[:, :, comp['pars'][0]:comp['pars'][1]] if comp['pars'] is not None else None
+            cell = np.zeros(pars.shape[:2], dtype=int)
+            for j, i in enumerate(comp['grid']):
+                axis = comp['axes'][j]
+                idx = np.abs(axis[:, None, :] - x[:, :, i, None]).argmin(axis=-1)
+                cell = cell*comp['shape'][j] + idx
+            F = comp['fluxes'][S, cell]
+            for j, i in enumerate(comp['free']):
+                F = F * comp['responses'][:, j][:, None, :]**x[:, :, i, None]
+            if comp['norm'] is not None:
+                F = F * 10**pars[:, :, comp['norm'], None]
+            lum = lum + F
+        return lum
+
+    def ln_probab(self, pars):
+
+        """
+        Posterior probabilities of the parameter vectors pars (sources x points x Npar),
+        as parspace.ln_probab(). Returns an array (sources x points).
+        """
+        inside = np.all((pars >= self.pmin[:, None, :]) & (pars <= self.pmax[:, None, :]), axis=-1)
+        resid = np.where(self.mask[:, None, :], (self.y[:, None, :] - self.ymodel(pars))/self.ysigma[:, None, :], 0.)
+        lnp = -0.5*np.sum(resid**2, axis=-1)
+
+        if self.priors:
+            for s, w in zip(*np.nonzero(inside)):
+                lnp[s, w] += self.ln_prior(s, pars[s, w])
+        lnp[~inside | ~np.isfinite(lnp)] = -np.inf
+        return lnp
+
+    def ln_prior(self, s, pars):
+        """ Prior of source s, from the model dictionaries as in parspace.ln_probab()."""
+        data, models, P = self.sources[s]
+        pars = tuple(pars)
+        gal_obj, sb_obj, tor_obj, bbb_obj, agnrad_obj = models.dictkey_arrays
+        for k, obj in enumerate([gal_obj, sb_obj, tor_obj, bbb_obj]):
+            obj.pick_nD(pars[P['idxs'][k]:P['idxs'][k+1]])
+        if models.settings['RADIO'] == True and (agnrad_obj.pars_modelkeys != ['-99.9']).all():
+            agnrad_obj.pick_nD(pars[P['idxs'][4]:P['idxs'][5]])
+        return priors.PRIORS(data, models, P, *pars)
+
+
+def compile_source(data, models, P):
+
+    """
+    Compiles the model components of one source.
+    Returns a list of (COMPONENT, (first, last) parameter index, index of the normalization parameter).
+    """
+    gal_obj, sb_obj, tor_obj, bbb_obj, agnrad_obj = models.dictkey_arrays
+    names = list(P['names'])
+    R06 = models.settings['BBB'] == 'R06' or models.settings['BBB'] == 'THB21'
+
+    comps = []
+    for k, (obj, norm) in enumerate(zip([gal_obj, sb_obj, tor_obj, bbb_obj], ['GA', 'SB', 'TO', 'BB'])):
+        if norm == 'BB' and not R06:        # the other accretion disk models are normalized with the distance
+            comps.append((COMPONENT(obj, 1./(4*np.pi*data.dlum**2)), (P['idxs'][k], P['idxs'][k+1]), None))
+        else:
+            comps.append((COMPONENT(obj), (P['idxs'][k], P['idxs'][k+1]), names.index(norm)))
+
+    if models.settings['RADIO'] == True:
+        if (agnrad_obj.pars_modelkeys != ['-99.9']).all():
+            comps.append((COMPONENT(agnrad_obj), (P['idxs'][4], P['idxs'][5]), names.index('RAD')))
+        else:                               # fixed radio model: one cell without parameters
+            fixed = COMPONENT.__new__(COMPONENT)
+            fixed.types, fixed.axes, fixed.grid, fixed.free, fixed.shape = [], [], [], [], ()
+            fixed.fluxes = np.asarray(agnrad_obj.get_fluxes('-99.9')[1], dtype=float).reshape(1, -1)
+            fixed.responses = np.ones((0, fixed.fluxes.shape[1]))
+            comps.append((fixed, None, names.index('RAD')))
+    return comps
+
+
+def valid_bands(data, models):
+    """ Bands used in the likelihood, with the same rule as parspace.ln_likelihood()."""
+    x, y, z = data.nus, data.fluxes, data.z
+    if models.settings['XRAYS'] == 'Prior':
+        return (x< np.log10(10**(15.38)/(1+z))) & (y>-99.e-23)
+    else:
+        return (x< np.log10(10**(15.38)/(1+z))) | (x > np.log10(10**(16.685)/(1+z))) & (y>-99.e-23)
+
+
+def active_priors(modelsettings):
+    """ True if PRIORS_AGNfitter.PRIORS() adds any prior for these model settings."""
+    return modelsettings['PRIOR_energy_balance'] in ['Flexible', 'Restrictive'] or modelsettings['PRIOR_galaxy_only'] == True \
+        or modelsettings['PRIOR_AGNfraction'] == True or modelsettings['PRIOR_midIR_UV'] == True \
+        or modelsettings['RADIO'] == True or modelsettings['XRAYS'] in ['Prior_UV', 'Prior_midIR']
+
+
+def signature(data, models, P):
+    """ Sources with equal signatures can be stacked in one BATCH."""
+    gal_obj, sb_obj, tor_obj, bbb_obj, agnrad_obj = models.dictkey_arrays
+    keys = [tuple(np.shape(o.pars_modelkeys)) for o in [gal_obj, sb_obj, tor_obj, bbb_obj]]
+    if models.settings['RADIO'] == True:
+        keys.append(tuple(np.shape(agnrad_obj.pars_modelkeys)))
+    return (tuple(P['names']), tuple(keys), len(data.nus))
+
+
+def fit_batch(sources, mc):
+
+    """
+    Fits a list of sources with the batched engine. Sources are grouped by signature,
+    and each group is sampled with run_emcee_batch().
+
+    ##input:
+    - sources: list of (data, models, P) of each source
+    - dictionary mc, of mcmc settings
+    """
+    groups = dict()
+    for src in sources:
+        groups.setdefault(signature(*src), []).append(src)
+
+    for group in groups.values():
+        t0 = time.time()
+        batch = BATCH(group)
+        print( 'Batch of %i sources compiled in %.2g s: ' % (len(group), time.time()-t0), [str(data.name) for data, models, P in group])
+        run_emcee_batch(batch, mc)
+
+
+def run_emcee_batch(batch, mc):
+
+    """
+    Burn-in sets and MCMC sampling of all sources of the batch, as MCMC_AGNfitter.run_emcee().
+    Saves samples_burn1-2-3.sav and samples_mcmc.sav of each source.
+    """
+    nwalkers = mc['Nwalkers']
+    p0, warm = [], []
+    for data, models, P in batch.sources:
+        if not os.path.lexists(data.output_folder+str(data.name)):
+            os.mkdir(data.output_folder+str(data.name))
+        p = warmstart.initial_samples(data, P, mc, nwalkers)
+        warm.append(p is not None)
+        p0.append(p if p is not None else parspace.get_initial_positions(nwalkers, P))
+    pos = np.array(p0)
+    lnp = batch.ln_probab(pos)
+
+    ## BURN-IN SETS ##
+    if mc['Nburn'] > 0:
+        t1 = time.time()
+        Nburn = max(1, int(mc['Nburn']*mc['warm_start_burnfrac'])) if all(warm) else mc['Nburn']
+        for i in range(mc['Nburnsets']):
+            print( 'Running burn-in nr. '+ str(i)+' with %i steps' % Nburn)
+            chain, lnprob, accept = sample_batch(batch, pos, lnp, Nburn, mc['iprint'])
+            save_batch_chains(batch, 'samples_burn1-2-3.sav', chain, lnprob, accept)
+
+            ## restart around the maximum likelihood position, as parspace.get_best_position()
+            best = lnprob.reshape(len(pos), -1).argmax(axis=1)
+            ml = chain.reshape(len(pos), -1, chain.shape[-1])[np.arange(len(pos)), best]
+            pos = ml[:, None, :] + np.random.normal(size=pos.shape)*0.00001
+            lnp = batch.ln_probab(pos)
+        print( '%.2g min elapsed' % ((time.time() - t1)/60.))
+
+    ## MCMC SAMPLING ##
+    if mc['Nmcmc'] > 0:
+        t2 = time.time()
+        print( "Running MCMC with %i steps" % mc['Nmcmc'])
+        chain, lnprob, accept = sample_batch(batch, pos, lnp, mc['Nmcmc'], mc['iprint'])
+        save_batch_chains(batch, 'samples_mcmc.sav', chain, lnprob, accept)
+        print( '%.2g min elapsed' % ((time.time() - t2)/60.))
+
+
+def sample_batch(batch, pos, lnp, nsteps, iprint, a=2.):
+
+    """
+    Advances one ensemble per source in lock-step, with the stretch move of emcee
+    (Goodman & Weare 2010): each half of the walkers moves along the line to a random
+    walker of the other half.
+
+    ##input:
+    - batch: object of class BATCH
+    - pos, lnp: initial positions (sources x walkers x Npar) and their posterior probabilities
+    - nsteps: number of steps
+
+    ##output:
+    - chain (sources x walkers x steps x Npar), lnprob (sources x walkers x steps), acceptance fractions (sources x walkers)
+    """
+    S, W, D = pos.shape
+    pos, lnp = pos.copy(), lnp.copy()
+    chain = np.empty((S, W, nsteps, D))
+    lnprob = np.empty((S, W, nsteps))
+    naccept = np.zeros((S, W))
+    half = W//2
+    rows = np.arange(S)[:, None]
+
+    for step in range(nsteps):
+        for moving, other in [(slice(0, half), slice(half, W)), (slice(half, W), slice(0, half))]:
+            active, comp = pos[:, moving], pos[:, other]
+            n = active.shape[1]
+            z = ((a - 1.)*np.random.uniform(size=(S, n)) + 1)**2/a
+            partner = comp[rows, np.random.randint(comp.shape[1], size=(S, n))]
+            proposal = partner + z[:, :, None]*(active - partner)
+            lnp_new = batch.ln_probab(proposal)
+            with np.errstate(invalid='ignore'):
+                accept = np.log(np.random.uniform(size=(S, n))) < (D - 1.)*np.log(z) + lnp_new - lnp[:, moving]
+            active[accept] = proposal[accept]
+            lnp[:, moving][accept] = lnp_new[accept]
+            naccept[:, moving] += accept
+        chain[:, :, step] = pos
+        lnprob[:, :, step] = lnp
+        if not (step+1) % iprint:
+            print( step+1 )
+
+    return chain, lnprob, naccept/nsteps
+
+
+def save_batch_chains(batch, filename, chain, lnprob, accept):
+    """
+    Save the chains of each source into its folder, with the keys of MCMC_AGNfitter.save_chains().
+    """
+    for s, (data, models, P) in enumerate(batch.sources):
+        acor = emcee.autocorr.integrated_time(np.swapaxes(chain[s], 0, 1), quiet=True)
+        f = open(data.output_folder+str(data.name)+'/'+filename, 'wb')
+        pickle.dump(dict(
+            chain=chain[s], accept=accept[s],
+            lnprob=lnprob[s], final_pos=chain[s][:, -1], state=None, acor=acor), f, protocol=2)
+        f.close()
@@ -0,0 +1,136 @@
+"""%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+      CATALOGS_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+This script contains the readers of columnar catalogs (cat['filetype']):
+- 'PARQUET': Apache Parquet files (needs pyarrow),
+- 'ARROW': Arrow IPC / Feather v2 files (needs pyarrow), memory-mapped,
+- 'HDF5': tables written by astropy (Table.write(..., format='hdf5')) or any
+  HDF5 dataset with named fields (needs h5py); cat['hdf5_path'] is the path of
+  the dataset in the file, by default the first table found.
+
+The columns are named as in FITS catalogs (see CATALOG_settings). Only the
+columns used by AGNfitter are read (DATA_all.COLUMNS), and only the rows asked for,
+so that one source of a large survey table is read without reading the table.
+The catalog is opened once (open_catalog) for all the reads of an object DATA_all,
+and closed when they are done.
+
+This script includes:
+- function open_catalog
+- functions columns, nrows
+- function read_rows
+
+"""
+import sys,os
+import contextlib
+import numpy as np
+from astropy.table import Table
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+COLUMNAR = ['PARQUET', 'ARROW', 'HDF5']
+MODULES = dict(PARQUET='pyarrow', ARROW='pyarrow', HDF5='h5py')
+
+
+@contextlib.contextmanager
+def open_catalog(filename, filetype, hdf5_path=None):
+
+    """
+    Opens a columnar catalog for columns(), nrows() and read_rows(), and closes the file
+    at the end of the with block.
+
+    ##input:
+    - filename and filetype ('PARQUET', 'ARROW' or 'HDF5') of the catalog
+    - hdf5_path: path of the table in an HDF5 file (None: first table found)
+
+    ##output:
+    - the table: ParquetFile, Arrow IPC file reader or HDF5 dataset
+    """
+    if filetype not in COLUMNAR:
+        sys.exit('Error CATALOGS_AGNfitter.py: unknown catalog file type '+str(filetype)+', use ASCII, FITS or '+', '.join(COLUMNAR))
+    if (pa if filetype != 'HDF5' else h5py) is None:
+        sys.exit('Error CATALOGS_AGNfitter.py: '+filetype+' catalogs need the package '+MODULES[filetype])
+
+    if filetype == 'HDF5':
+        source = h5py.File(filename, 'r')
+    else:
+        source = pa.memory_map(filename, 'r')
+    try:
+        if filetype == 'PARQUET':
+            table = pq.ParquetFile(source)
+        elif filetype == 'ARROW':
+            table = pa.ipc.open_file(source)
+        else:
+            if hdf5_path is None:
+                tables = []
+                source.visititems(lambda name, item: tables.append(name) if isinstance(item, h5py.Dataset) and item.dtype.names else None)
+                if len(tables) == 0:
+                    sys.exit('Error CATALOGS_AGNfitter.py: no table in the HDF5 catalog '+filename)
+                hdf5_path = tables[0]
+            table = source[hdf5_path]
+        yield table
+    finally:
+        source.close()
+
+
+def columns(table, filetype):
+    """ Names of the columns of a columnar catalog (open_catalog()), read from its schema only."""
+    if filetype == 'PARQUET':
+        return list(table.schema_arrow.names)
+    elif filetype == 'ARROW':
+        return list(table.schema.names)
+    return list(table.dtype.names)
+
+
+def nrows(table, filetype):
+    """ Number of rows of a columnar catalog (open_catalog()), read from its metadata only."""
+    if filetype == 'PARQUET':
+        return table.metadata.num_rows
+    elif filetype == 'ARROW':
+        return sum(table.get_batch(i).num_rows for i in range(table.num_record_batches))
+    return table.shape[0]
+
+
+def read_rows(table, filetype, names, first=0, stop=None):
+
+    """
+    Reads the columns names of the rows first to stop-1 of a columnar catalog.
+
+    ##input:
+    - table: the catalog opened with open_catalog(), and its filetype
+    - names: list of the columns to read
+    - first, stop: rows to read (stop=None: until the end of the catalog)
+
+    ##output:
+    - astropy Table with the columns names
+    """
+    if filetype == 'HDF5':
+        ## h5py reads only the selected fields of the selected rows
+        return Table(table.fields(list(names))[first:stop])
+
+    if filetype == 'PARQUET':
+        ## only the row groups which hold the rows are read
+        stop = table.metadata.num_rows if stop is None else min(stop, table.metadata.num_rows)
+        ends = np.cumsum([table.metadata.row_group(i).num_rows for i in range(table.num_row_groups)])
+        groups = [i for i in range(table.num_row_groups) if ends[i] > first and ends[i] - table.metadata.row_group(i).num_rows < stop]
+        start = ends[groups[0]] - table.metadata.row_group(groups[0]).num_rows if len(groups) > 0 else first
+        arrow = table.read_row_groups(groups, columns=list(names)).slice(first - start, max(0, stop - first))
+    else:
+        ## the record batches of a memory-mapped IPC file are read without copies
+        arrow = table.read_all().select(list(names))
+        stop = arrow.num_rows if stop is None else min(stop, arrow.num_rows)
+        arrow = arrow.slice(first, max(0, stop - first))
+
+    return Table(dict((n, arrow.column(n).to_numpy()) for n in names), names=list(names))
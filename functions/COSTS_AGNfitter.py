@@ -0,0 +1,221 @@
+"""%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+      COSTS_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+This script contains the cost model of the fits, used to hand out the most
+expensive sources of a catalog first, so that a large run does not end with
+a few long fits on otherwise idle processors.
+
+The fit time of a source is modelled as
+    log(t) = c0 + c1*log(ndim) + c2*log(nbands)
+with ndim the number of fitted parameters and nbands the number of valid bands.
+The parameters that change from source to source are those of the radio model
+(number of valid radio points, AGN_RAD) and of the X-ray extension of the
+accretion disk (number of valid X-ray points, BBB). The coefficients are fitted
+to the timings of previous fits in the run manifest (MANIFEST_AGNfitter.py).
+With fewer than MIN_HISTORY timings only c0 is fitted, which scales the default
+costs to seconds, and sources which were fitted before keep their own time.
+
+The sources can also be handed out in small groups (group_sources): sources with
+the same radio and X-ray models and the same valid bands, in order of redshift,
+are fitted one after the other by the same processor, which then keeps the model
+dictionary and likelihood views of sources at the same redshift in memory
+(API_AGNfitter.source_dictionary, source_models).
+
+This script includes:
+- functions varying_dimensions, model_variant, source_features
+- function fit_cost_model
+- functions estimate_costs, order_by_cost
+- function group_sources
+
+"""
+import numpy as np
+from collections import OrderedDict
+
+
+BASE_DIMENSIONS = 10        # typical number of parameters which are the same for all sources
+DEFAULT_COEFFS = [0., 2., 1.]   # without timings: t ~ ndim**2 * nbands
+MIN_HISTORY = 5             # minimum number of timed fits to fit the coefficients
+GROUPS_PER_PROCESSOR = 4    # large groups are split so that every processor gets several groups
+MAX_GROUP_SIZE = 8          # and the progress is reported at least every MAX_GROUP_SIZE sources of a processor
+
+
+def varying_dimensions(models_settings, nRADdata, nXRaysdata):
+
+    """
+    Number of parameters which depend on the data of the source, following the
+    choice of models in AGN_RAD() and BBB() (MODEL_AGNfitter.py).
+    """
+    ndim = 0
+    if models_settings['RADIO'] == True:
+        ndim += 1                                   # normalization RAD
+        if nRADdata > 1:
+            ndim += min(nRADdata, 4) - 1            # alpha / curv, nut / alpha1, alpha2, nut
+        if models_settings['Blazar'] != 'None':
+            ndim += 1                               # Ecutoff
+    if models_settings['XRAYS'] == True and not models_settings['BBB'].startswith('KD18'):
+        ndim += 1                                   # alphaScat
+        if nXRaysdata > 1:
+            ndim += 1                               # Gamma
+    return ndim
+
+
+def model_variant(models_settings, nRADdata, nXRaysdata):
+
+    """
+    Variant of the radio and X-ray models of a source, following the choice of models 
+    in AGN_RAD() and BBB() (MODEL_AGNfitter.py): sources of the same variant have the
+    same templates and parameters.
+    """
+    rad = min(int(nRADdata), 4) if models_settings['RADIO'] == True else None
+    xrays = int(nXRaysdata > 1) if models_settings['XRAYS'] == True else None
+    return rad, xrays
+
+
+def source_features(data_obj, lines, models_settings, base=BASE_DIMENSIONS):
+
+    """
+    Estimated number of parameters and number of valid bands of the sources in lines.
+
+    ##input:
+    - object data_obj of class DATA_all (DATA_AGNfitter.py)
+    - lines: catalog lines of the sources
+    - dictionary models_settings
+    - base: number of parameters which are the same for all sources
+
+    ##output:
+    - ndim, nbands: arrays with one value per source
+    """
+    rows = np.asarray(list(lines), dtype=int) - data_obj.first       # rows in a chunk of the catalog (DATA_all.STREAM)
+    nbands = np.sum(np.asarray(data_obj.fluxes)[rows] > -99e-23, axis=1)       # same data points as the likelihood
+    ndim = np.array([base + varying_dimensions(models_settings, data_obj.nRADdata[r], data_obj.nXRaysdata[r]) for r in rows])
+    return ndim, nbands
+
+
+def fit_cost_model(history):
+
+    """
+    Least-squares fit of the coefficients of the cost model.
+
+    ##input:
+    - history: list of (ndim, nbands, fit_time) of previous fits
+
+    ##output:
+    - coefficients [c0, c1, c2]: DEFAULT_COEFFS without timings (relative costs),
+      DEFAULT_COEFFS scaled to seconds by the median ratio of the measured to the default 
+      costs with fewer than MIN_HISTORY timings, and all coefficients fitted otherwise
+    """
+    history = np.array([h for h in history if None not in h and h[2] > 0], dtype=float).reshape(-1, 3)
+    if len(history) == 0:
+        return list(DEFAULT_COEFFS)
+
+    A = np.column_stack((np.ones(len(history)), np.log(history[:, 0]), np.log(history[:, 1])))
+    coeffs = list(DEFAULT_COEFFS)
+    if len(history) < MIN_HISTORY:
+        coeffs[0] = np.median(np.log(history[:, 2]) - coeffs[1]*A[:, 1] - coeffs[2]*A[:, 2])
+        return coeffs
+
+    ## features without spread in the history keep their default coefficient
+    varying = [0] + [i for i in (1, 2) if np.ptp(A[:, i]) > 0]
+    b = np.log(history[:, 2]) - sum(coeffs[i]*A[:, i] for i in (1, 2) if i not in varying)
+    solution = np.linalg.lstsq(A[:, varying], b, rcond=None)[0]
+    for i, c in zip(varying, solution):
+        coeffs[i] = c
+    return coeffs
+
+
+def estimate_costs(data_obj, lines, models_settings, timed=dict()):
+
+    """
+    Estimated fit times (in seconds, or relative without timings) of the sources in lines.
+    The measured times of sources fitted before are only used if the cost model is in 
+    seconds, i.e. if some timings have their number of parameters and bands.
+
+    ##input:
+    - object data_obj of class DATA_all (DATA_AGNfitter.py)
+    - lines: catalog lines of the sources
+    - dictionary models_settings
+    - timed: timings of previous fits, {line: (ndim, nbands, fit_time)} (MANIFEST.timings())
+    """
+    lines = list(lines)
+    base = BASE_DIMENSIONS
+    if len(timed) > 0:
+        ## the number of parameters shared by all sources, from the fitted parameter spaces
+        first = data_obj.first
+        base = int(np.median([timed[l][0] - varying_dimensions(models_settings, data_obj.nRADdata[l-first], data_obj.nXRaysdata[l-first]) \
+                              for l in timed if timed[l][0] is not None and 0 <= l-first < len(data_obj.z)] or [base]))
+    ndim, nbands = source_features(data_obj, lines, models_settings, base)
+
+    history = list(timed.values())
+    coeffs = fit_cost_model(history)
+    costs = np.exp(coeffs[0] + coeffs[1]*np.log(ndim) + coeffs[2]*np.log(np.maximum(nbands, 1)))
+    if not any(None not in h and h[2] > 0 for h in history):
+        return costs
+    for i, line in enumerate(lines):
+        if line in timed and timed[line][2] is not None:
+            costs[i] = timed[line][2]
+    return costs
+
+
+def order_by_cost(data_obj, lines, models_settings, manifest=None):
+
+    """
+    Returns the sources in lines sorted from the most to the least expensive.
+
+    ##input:
+    - object data_obj of class DATA_all (DATA_AGNfitter.py)
+    - lines: catalog lines of the sources
+    - dictionary models_settings
+    - manifest: optional object of class MANIFEST, with the timings of previous fits
+    """
+    lines = list(lines)
+    if len(lines) == 0:
+        return lines
+    timed = manifest.timings() if manifest is not None else dict()
+    costs = estimate_costs(data_obj, lines, models_settings, timed)
+    order = np.argsort(-costs, kind='stable')
+    print ( '- Estimated fit costs: longest/shortest source %.2g, %i sources with previous timings' \
+            % (costs[order[0]]/costs[order[-1]], len([l for l in lines if l in timed])))
+    return [lines[i] for i in order]
+
+
+def group_sources(data_obj, lines, models_settings, processors=1):
+
+    """
+    Groups the sources in lines by model variant (model_variant()) and valid bands,
+    for the work queue (SCHEDULER_AGNfitter.run_catalog).
+
+    ##input:
+    - object data_obj of class DATA_all (DATA_AGNfitter.py)
+    - lines: catalog lines of the sources, in the order they should be fitted
+    - dictionary models_settings
+    - processors: number of processes, groups are split in at least GROUPS_PER_PROCESSOR x processors parts,
+      of at most MAX_GROUP_SIZE sources
+
+    ##output:
+    - list of groups (lists of lines). The groups are in the order of their first source in lines,
+      and the sources of a group in order of redshift, so that sources at the same redshift follow each other.
+    """
+    lines = list(lines)
+    if len(lines) == 0:
+        return []
+    rows = np.asarray(lines, dtype=int) - data_obj.first       # rows in a chunk of the catalog (DATA_all.STREAM)
+    valid = np.asarray(data_obj.fluxes)[rows] > -99e-23         # same data points as the likelihood
+    z = np.asarray(data_obj.z, dtype=float)[rows]
+
+    groups = OrderedDict()
+    for i, r in enumerate(rows):
+        key = (model_variant(models_settings, data_obj.nRADdata[r], data_obj.nXRaysdata[r]), valid[i].tobytes())
+        groups.setdefault(key, []).append(i)
+
+    maxsize = min(int(np.ceil(len(lines)/float(GROUPS_PER_PROCESSOR*processors))), MAX_GROUP_SIZE)
+    split = []
+    for group in groups.values():
+        group = sorted(group, key=lambda i: z[i])
+        split.extend(group[k:k+maxsize] for k in range(0, len(group), maxsize))
+
+    print ( '- {0:d} sources in {1:d} groups of model variant and valid bands ({2:d} variants)'.format(\
+            len(lines), len(split), len(set(key[0] for key in groups))))
+    return [[lines[i] for i in group] for group in split]
@@ -10,6 +10,8 @@ It also helps transporting
 the main information on the dictionaries (DICTS).
 """
 import sys,os
+import socket
+import hashlib
 import numpy as np
 import pandas as pd
 from math import pi, sqrt
@@ -17,7 +19,13 @@ from scipy.interpolate import interp1d
 from astropy import units as u
 from astropy.table import Table
 import functions.MODEL_AGNfitter as model  
+import functions.CATALOGS_AGNfitter as catalogs
+import functions.FILTERS_AGNfitter as filterpy
 import decimal
+from collections import OrderedDict
+
+
+SHARED_ARRAYS = ['name', 'z', 'dlum', 'nus', 'fluxes', 'fluxerrs', 'ndflag', 'nRADdata', 'nXRaysdata']
 
 
 class DATA_all:
@@ -43,15 +51,24 @@ class DATA_all:
             sys.exit(1)
         self.path = cat['path']
         self.output_folder = cat['output_folder']
+        self.first = 0          # catalog line of the first source (STREAM)
 
-    def PROPS(self):
+    def PROPS(self, table=None):
+
+        """
+        Reads the catalog, or only the rows in table (STREAM), 
+        and processes the photometry of its sources.
+        """
 
         if self.cat['filetype'] == 'ASCII': 
 
             ### read catalog columns
             # It's necessary to read redshift as decimal.Decimal object because of the representation as a binary floating point number 
             # (python add digits to some values of z)
-            column = pd.read_csv(self.catalog, sep='\s+', decimal=".", skiprows = 0, converters = {'z':decimal.Decimal}) 
+            if table is None:
+                column = pd.read_csv(self.catalog, sep='\s+', decimal=".", skiprows = 0, converters = {'z':decimal.Decimal}) 
+            else:
+                column = table.reset_index(drop=True)
 
             ### properties
             self.name = column.iloc[:, self.cat['name']]
@@ -62,8 +79,7 @@ class DATA_all:
                 ### If central wavelengths are *not* given in catalog and need to be extracted automatically from chosen filters. 
 
                 ### read all wavelengths, fluxes, fluerrors, flags                
-                names = np.loadtxt(self.cat['path'] + 'models/FILTERS/ALL_FILTERS_info.dat', delimiter = '|', usecols=[1], skiprows = 1, dtype=str)
-                centralwls = np.loadtxt(self.cat['path'] + 'models/FILTERS/ALL_FILTERS_info.dat', delimiter = '|', usecols=[3], skiprows = 1)
+                names, centralwls = filterpy.filters_info(self.cat['path'])
 
                 dictionary = self.filters.copy()
                 
@@ -80,7 +96,7 @@ class DATA_all:
                             ### The filter dictionary need to have to entries [True/False, column_number]
                             if list(dictionary.keys())[i] == names[j] and dictionary[list(dictionary.keys())[i]][0]:
                                 list_centralwls.append([ dictionary[list(dictionary.keys())[i]][1], centralwls[j]])
-                        except:
+                        except Exception:
                             print (list(dictionary.keys())[i], 'not in list')
 
                 def getkeynumber(item):
@@ -106,115 +122,40 @@ class DATA_all:
             if self.cat['ndflag_bool'] == True: 
                 ndflag_cat_ALL = np.array(column.iloc[:, self.cat['ndflag_list']])
 
-            nus_l=[]
-            fluxes_l=[]
-            fluxerrs_l=[]
-            ndflag_l=[]
-            nRADdata_l = []
-            nXRaysdata_l = []
-
             nrSOURCES, nrBANDS= np.shape(flux_cat_ALL)
             
             self.cat['nsources'] = nrSOURCES
 
-            ##Convert to right units but give back just values
-            for j in range(nrSOURCES):
-                
-                if self.cat['use_central_wavelength']:
-                    freq_wl_cat = freq_wl_cat_ALL                    
-                
-                else:
-                    freq_wl_cat = freq_wl_cat_ALL[:,j]
-                
-                flux_cat= flux_cat_ALL[j]
-                fluxerr_cat= fluxerr_cat_ALL[j]
-
-                if self.cat['use_central_wavelength']:
-                    nus0 = freq_wl_cat
-                    
-                else:
-                    if self.cat['freq/wl_format']== 'frequency' :
-                        nus0 = np.log10(freq_wl_cat.to(u.Hz).value)
-                    if self.cat['freq/wl_format']== 'wavelength' :
-                        nus0 = np.log10(freq_wl_cat.to(u.Hz, equivalencies=u.spectral()).value)
-
-                fluxes0 = np.array(flux_cat.to(u.erg/ u.s/ (u.cm)**2 / u.Hz).value)
-                fluxerrs0 = np.array(fluxerr_cat.to(u.erg/ u.s/(u.cm)**2/u.Hz).value)
-                
-                ## If columns with flags exist
-                if self.cat['ndflag_bool'] == True: 
-                    ndflag_cat0 = ndflag_cat_ALL[:,j]     
-                    # If fluxerrs0 are not given (-99), we assume flux is an upper limit for a non detection.
-                    # Upper limit flux is then represented for the fitting
-                    # with a data point at uppflux/2, and an error of +- uppflux/2
-                    # implying an uncertanty that ranges from [0,uppflux]  
-                    units_flags = self.cat['flux_unit'].value
-                    ndflag_cat0[fluxerr_cat.value/units_flags<=-99]= 0.                                 
-                    fluxes0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]= \
-                             fluxes0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]*0.5
-                    fluxerrs0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]= \
-                               fluxes0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]
-
-                ## If NO columns with flags exist
-                elif self.cat['ndflag_bool'] == False:
-                    ndflag_cat0 = np.ones(np.shape(fluxes0))
-                    # If fluxerrs0 are not given (-99), we assume flux is an upper limit for a non detection.
-                    # Upper limit flux is then represented for the fitting
-                    # with a data point at uppflux/2, and an error of +- uppflux/2
-                    # implying an uncertanty that ranges from [0,uppflux]
-                    units_flags = self.cat['flux_unit'].value
-                    ndflag_cat0[fluxerr_cat.value/units_flags<=-99]= 0.
-                    fluxes0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]=\
-                             fluxes0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]*0.5
-                    fluxerrs0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]= \
-                              fluxes0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]
-                    # If neither fluxes and fluxerrs are given (both -99), 
-                    # these are considered as a non existant data point.
-
-                if self.cat['err+10%flux_moreflex'] == True:  
-                    ## It's a option to add in quadrature a 10% of the flux to the measurement error in order to increase the flexibility of the fit
-                    fluxerrs0[ndflag_cat0 != 0] = np.sqrt(fluxerrs0[ndflag_cat0 != 0]**2 + (fluxes0[ndflag_cat0 != 0]*0.1)**2)
-
-
-                ## Sort in order of frequency
-                nus_l.append(nus0[nus0.argsort()])
-                fluxes_l.append(fluxes0[nus0.argsort()])
-                fluxerrs_l.append(fluxerrs0[nus0.argsort()])
-                ndflag_l.append(ndflag_cat0[nus0.argsort()])
-
-                ## Evaluate the number of valid radio data. This information will be important to choose a AGN radio model
-                RADdata_pos = nus0[nus0.argsort()] < (10.5-np.log10(1+self.z[j]))        # < 30 GHz rest frame
-                RADdata = fluxes0[nus0.argsort()][(RADdata_pos == True) & (ndflag_cat0[nus0.argsort()] > 0)]
-                nRADdata_l.append(len(RADdata))
-
-                ## Evaluate the number of valid Xrays data. This information will be important to choose the model
-                XRdata_pos = nus0[nus0.argsort()] > (16.685-np.log10(1+self.z[j]))        # > 0.2 keV rest frame
-                XRdata = fluxes0[nus0.argsort()][(XRdata_pos == True) & (ndflag_cat0[nus0.argsort()] > 0)]
-                nXRaysdata_l.append(len(XRdata))
-
-            self.nus = np.array(nus_l)
-            self.fluxes = np.array(fluxes_l)
-            self.fluxerrs = np.array(fluxerrs_l)
-            self.ndflag = np.array(ndflag_l)
-            self.nRADdata = np.array(nRADdata_l)
-            self.nXRaysdata = np.array(nXRaysdata_l)
-
-        elif self.cat['filetype'] == 'FITS': 
-
-            #read all columns
-            fitstable = Table.read(self.catalog)
+            if self.cat['use_central_wavelength']:
+                nus0 = freq_wl_cat_ALL
+            else:
+                if self.cat['freq/wl_format']== 'frequency' :
+                    nus0 = np.log10(freq_wl_cat_ALL.to(u.Hz).value).T
+                if self.cat['freq/wl_format']== 'wavelength' :
+                    nus0 = np.log10(freq_wl_cat_ALL.to(u.Hz, equivalencies=u.spectral()).value).T
+
+            self.PHOTOMETRY(nus0, flux_cat_ALL, fluxerr_cat_ALL, ndflag_cat_ALL if self.cat['ndflag_bool'] == True else None)
+
+        elif self.cat['filetype'] == 'FITS' or self.cat['filetype'] in catalogs.COLUMNAR: 
+
+            #read all columns (only the columns used, for columnar catalogs)
+            if table is not None:
+                fitstable = table
+            elif self.cat['filetype'] == 'FITS':
+                fitstable = Table.read(self.catalog)
+            else:
+                fitstable = self.READ()
 
             #properties
             self.name = fitstable[self.cat['name']].astype(int)
             self.z = fitstable[self.cat['redshift']].astype(float)
-            self.dlum = np.array([model.z2Dlum(z) for z in self.z])
+            self.dlum = np.array(model.z2Dlum(self.z))
 
             if self.cat['use_central_wavelength']:
                 ### If central wavelengths are *not* given in catalog and need to be extracted automatically from chosen filters. 
 
                 ### read all wavelengths, fluxes, fluerrors, flags                
-                names = np.loadtxt(self.cat['path'] + 'models/FILTERS/ALL_FILTERS_info.dat', delimiter = '|', usecols=[1], skiprows = 1, dtype=str)
-                centralwls = np.loadtxt(self.cat['path'] + 'models/FILTERS/ALL_FILTERS_info.dat', delimiter = '|', usecols=[3], skiprows = 1)
+                names, centralwls = filterpy.filters_info(self.cat['path'])
 
                 dictionary = self.filters.copy()
                 
@@ -225,15 +166,15 @@ class DATA_all:
                 del dictionary['path'];
 
                 list_centralwls = []
-                for i in range(len(dictionary.keys())):
+                for i in range(len(list(dictionary.keys()))):
 
                     for j in range(len(names)):
                         try:
                             ### The filter dictionary need to have to entries [True/False, column_number]
-                            if dictionary.keys()[i] == names[j] and dictionary[dictionary.keys()[i]][0]:
-                                list_centralwls.append([ dictionary[dictionary.keys()[i]][1], centralwls[j]])
-                        except:
-                            print (dictionary.keys()[i], 'not in list')
+                            if list(dictionary.keys())[i] == names[j] and dictionary[list(dictionary.keys())[i]][0]:
+                                list_centralwls.append([ dictionary[list(dictionary.keys())[i]][1], centralwls[j]])
+                        except Exception:
+                            print (list(dictionary.keys())[i], 'not in list')
 
                 def getkeynumber(item):
                     return item[0]
@@ -243,14 +184,13 @@ class DATA_all:
                 centr_wl = sortedwl[:,1]
                 freq_wl_cat_ALL = centr_wl # These are in 10log frequency!
 
-            else:
+            #read all wavelengths, fluxes, fluerrors, flags
+            colnames = fitstable.dtype.names
+            flux_cols = [ c for c in colnames if self.cat['flux_suffix'] in c]
+            flux_err_cols = [ c for c in colnames if self.cat['fluxerr_suffix'] in c]
 
-                #read all wavelengths, fluxes, fluerrors, flags
-                colnames = fitstable.dtype.names
+            if not self.cat['use_central_wavelength']:
                 wl_cols = [ c for c in colnames if self.cat['freq/wl_suffix'] in c]
-                flux_cols = [ c for c in colnames if self.cat['flux_suffix'] in c]
-                flux_err_cols = [ c for c in colnames if self.cat['fluxerr_suffix'] in c]
-
                 freq_wl_cat_ALL = \
                                 np.array([fitstable[c] for c in wl_cols])* self.cat['freq/wl_unit'] 
             flux_cat_ALL =\
@@ -260,86 +200,217 @@ class DATA_all:
             if self.cat['ndflag_bool'] == True: 
                 ndflag_cat_ALL = np.array(fitstable[self.cat['ndflag_list']])
 
-            nus_l=[]
-            fluxes_l=[]
-            fluxerrs_l=[]
-            ndflag_l=[]
-            nRADdata_l = []
-
             nrBANDS, nrSOURCES= np.shape(flux_cat_ALL)
 
             self.cat['nsources'] = nrSOURCES
-            
-            ##Convert to right units but give back just values
-            for j in range(nrSOURCES):
-            
-                freq_wl_cat= freq_wl_cat_ALL[:,j]
-                flux_cat= flux_cat_ALL[:,j]
-                fluxerr_cat= fluxerr_cat_ALL[:,j]
 
-                if self.cat['freq/wl_format']== 'frequency' :
-                    nus0 = np.log10(freq_wl_cat.to(u.Hz).value)
-                if self.cat['freq/wl_format']== 'wavelength' :
-                    nus0 = np.log10(freq_wl_cat.to(u.Hz, equivalencies=u.spectral()).value)
-
-                fluxes0 = np.array(flux_cat.to(u.erg/ u.s/ (u.cm)**2 / u.Hz).value)
-                fluxerrs0 = np.array(fluxerr_cat.to(u.erg/ u.s/(u.cm)**2/u.Hz).value)
-
-                ## If columns with flags exist
-                if self.cat['ndflag_bool'] == True: 
-                    ndflag_cat0 = ndflag_cat_ALL[:,j]     
-                    # If fluxerrs0 are not given (-99), we assume flux is an upper limit for a non detection.
-                    # Upper limit flux is then represented for the fitting
-                    # with a data point at uppflux/2, and an error of +- uppflux/2
-                    # implying an uncertanty that ranges from [0,uppflux]  
-                    units_flags = self.cat['flux_unit'].value
-                    ndflag_cat0[flux_cat.value/units_flags<=-99]= 0.                                 
-                    fluxes0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]=\
-                            fluxes0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]*0.5
-                    fluxerrs0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]=\
-                            fluxes0 [(fluxerr_cat.value/units_flags<=-99)&(flux_cat/units_flags.value>-99)]
-
-                ## If NO columns with flags exist
-                elif self.cat['ndflag_bool'] == False:
-
-                    ndflag_cat0 = np.ones(np.shape(fluxes0))
-                    # If fluxerrs0 are not given (-99), we assume flux is an upper limit for a non detection.
-                    # Upper limit flux is then represented for the fitting
-                    # with a data point at uppflux/2, and an error of +- uppflux/2
-                    # implying an uncertanty that ranges from [0,uppflux]  
-                    units_flags = self.cat['flux_unit'].value
-                    ndflag_cat0[flux_cat.value/units_flags<=-99]= 0.
-                    fluxes0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]=\
-                            fluxes0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]*0.5
-                    fluxerrs0[(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]=\
-                            fluxes0 [(fluxerr_cat.value/units_flags<=-99)&(flux_cat.value/units_flags>-99)]
-
-                    # If neither fluxes and fluxerrs are given (both -99), 
-                    # these are considered as a non existant data point.
-
-                ## Sort in order of frequency
-                nus_l.append(nus0[nus0.argsort()])
-                fluxes_l.append(fluxes0[nus0.argsort()])
-                fluxerrs_l.append(fluxerrs0[nus0.argsort()])
-                ndflag_l.append(ndflag_cat0[nus0.argsort()])
-
-                ## Evaluate the number of valid radio data. This information will be important to choose a AGN radio model
-                RADdata_pos = nus0[nus0.argsort()] < (10.5-np.log10(1+self.z[j]))        # < 30 GHz rest frame
-                RADdata = fluxes0[nus0.argsort()][(RADdata_pos == True) & (ndflag_cat0[nus0.argsort()] > 0)]
-                nRADdata_l.append(len(RADdata))
-
-                ## Evaluate the number of valid Xrays data. This information will be important to choose the model
-                XRdata_pos = nus0[nus0.argsort()] < (16.685-np.log10(1+self.z[j]))        # > 0.2 keV rest frame
-                XRdata = fluxes0[nus0.argsort()][(XRdata_pos == True) & (ndflag_cat0[nus0.argsort()] > 0)]
-                nXRaysdata_l.append(len(XRdata))
-
-
-            self.nus = np.array(nus_l)
-            self.fluxes = np.array(fluxes_l)
-            self.fluxerrs = np.array(fluxerrs_l)
-            self.ndflag = np.array(ndflag_l)
-            self.nRADdata = np.array(nRADdata_l)
-            self.nXRaysdata = np.array(nXRaysdata_l)
+            if self.cat['use_central_wavelength']:
+                nus0 = freq_wl_cat_ALL
+            elif self.cat['freq/wl_format']== 'frequency' :
+                nus0 = np.log10(freq_wl_cat_ALL.to(u.Hz).value).T
+            elif self.cat['freq/wl_format']== 'wavelength' :
+                nus0 = np.log10(freq_wl_cat_ALL.to(u.Hz, equivalencies=u.spectral()).value).T
+
+            self.PHOTOMETRY(nus0, flux_cat_ALL.T, fluxerr_cat_ALL.T, ndflag_cat_ALL.T if self.cat['ndflag_bool'] == True else None)
+
+    def PHOTOMETRY(self, nus0, flux_cat_ALL, fluxerr_cat_ALL, ndflag_cat_ALL=None):
+
+        """
+        Processes the photometry of all sources at once, as arrays (Nsources x Nbands):
+        conversion to erg/s/cm2/Hz, non-detections, sorting in order of frequency
+        and number of valid radio and X-ray data.
+
+        ##input:
+        - nus0: log10 frequencies [Hz] of the bands, (Nbands) if the same for all sources, or (Nsources x Nbands)
+        - flux_cat_ALL, fluxerr_cat_ALL: fluxes and errors with astropy units (Nsources x Nbands)
+        - ndflag_cat_ALL: flags 1(0) for detections (nondetections), or None if the catalog has no flags
+        """
+        ##Convert to right units but give back just values
+        fluxes0 = np.array(flux_cat_ALL.to(u.erg/ u.s/ (u.cm)**2 / u.Hz).value)
+        fluxerrs0 = np.array(fluxerr_cat_ALL.to(u.erg/ u.s/(u.cm)**2/u.Hz).value)
+        if ndflag_cat_ALL is not None:
+            ndflag_cat0 = np.array(ndflag_cat_ALL)
+        else:
+            ndflag_cat0 = np.ones(np.shape(fluxes0))
+
+        # If fluxerrs0 are not given (-99), we assume flux is an upper limit for a non detection.
+        # Upper limit flux is then represented for the fitting
+        # with a data point at uppflux/2, and an error of +- uppflux/2
+        # implying an uncertanty that ranges from [0,uppflux]  
+        # If neither fluxes and fluxerrs are given (both -99), 
+        # these are considered as a non existant data point.
+        units_flags = self.cat['flux_unit'].value
+        ndflag_cat0[fluxerr_cat_ALL.value/units_flags<=-99]= 0.
+        upperlimits = (fluxerr_cat_ALL.value/units_flags<=-99)&(flux_cat_ALL.value/units_flags>-99)
+        fluxes0[upperlimits]= fluxes0[upperlimits]*0.5
+        fluxerrs0[upperlimits]= fluxes0[upperlimits]
+
+        if self.cat['err+10%flux_moreflex'] == True:  
+            ## It's a option to add in quadrature a 10% of the flux to the measurement error in order to increase the flexibility of the fit
+            fluxerrs0[ndflag_cat0 != 0] = np.sqrt(fluxerrs0[ndflag_cat0 != 0]**2 + (fluxes0[ndflag_cat0 != 0]*0.1)**2)
+
+        ## Sort in order of frequency
+        nus0 = np.broadcast_to(nus0, np.shape(fluxes0))
+        order = nus0.argsort(axis=1)
+        self.nus = np.take_along_axis(nus0, order, axis=1)
+        self.fluxes = np.take_along_axis(fluxes0, order, axis=1)
+        self.fluxerrs = np.take_along_axis(fluxerrs0, order, axis=1)
+        self.ndflag = np.take_along_axis(ndflag_cat0, order, axis=1)
+
+        z = np.asarray(self.z, dtype=float)[:, None]
+        ## Evaluate the number of valid radio data. This information will be important to choose a AGN radio model
+        RADdata_pos = self.nus < (10.5-np.log10(1+z))        # < 30 GHz rest frame
+        self.nRADdata = np.sum(RADdata_pos & (self.ndflag > 0), axis=1)
+
+        ## Evaluate the number of valid Xrays data. This information will be important to choose the model
+        XRdata_pos = self.nus > (16.685-np.log10(1+z))        # > 0.2 keV rest frame
+        self.nXRaysdata = np.sum(XRdata_pos & (self.ndflag > 0), axis=1)
+
+    def STREAM(self, chunksize):
+
+        """
+        Reads the catalog in chunks of chunksize sources, for catalogs larger than the memory.
+        Yields for every chunk an object of class DATA_all with the properties (PROPS)
+        of the sources in the chunk. Its attribute first is the catalog line of the
+        first source of the chunk, so that the sources keep their catalog lines.
+        """
+        if self.cat['filetype'] == 'ASCII':
+            tables = pd.read_csv(self.catalog, sep='\s+', decimal=".", skiprows = 0, converters = {'z':decimal.Decimal}, chunksize=chunksize)
+        elif self.cat['filetype'] == 'FITS':
+            fitstable = Table.read(self.catalog, memmap=True)
+            tables = (fitstable[i:i+chunksize] for i in range(0, len(fitstable), chunksize))
+        else:
+            def chunks():
+                ## the catalog is opened once for all chunks
+                with self.OPEN() as catalog:
+                    names = self.COLUMNS(catalog)
+                    for i in range(0, catalogs.nrows(catalog, self.cat['filetype']), chunksize):
+                        yield catalogs.read_rows(catalog, self.cat['filetype'], names, i, i+chunksize)
+            tables = chunks()
+
+        first = 0
+        for table in tables:
+            chunk = DATA_all(dict(self.cat), self.filters)
+            chunk.first = first
+            chunk.PROPS(table)
+            first += len(table)
+            yield chunk
+
+    def OPEN(self):
+
+        """
+        Opens the columnar catalog (CATALOGS_AGNfitter.open_catalog), to be used in a with block:
+            with data_obj.OPEN() as catalog:
+        """
+        return catalogs.open_catalog(self.catalog, self.cat['filetype'], self.cat.get('hdf5_path'))
+
+    def COLUMNS(self, catalog):
+
+        """
+        Names of the columns of the opened columnar catalog (OPEN) used by AGNfitter:
+        name, redshift, fluxes, errors, flags and, if given, frequencies/wavelengths.
+        """
+        colnames = catalogs.columns(catalog, self.cat['filetype'])
+        suffixes = ['flux_suffix', 'fluxerr_suffix'] + ([] if self.cat['use_central_wavelength'] else ['freq/wl_suffix'])
+        names = [self.cat['name'], self.cat['redshift']]
+        if self.cat['ndflag_bool'] == True:
+            names += list(np.atleast_1d(self.cat['ndflag_list']))
+        names += [c for c in colnames if any(self.cat[s] in c for s in suffixes)]
+
+        missing = [c for c in names if c not in colnames]
+        if len(missing) > 0:
+            sys.exit('ERROR: Catalog '+self.catalog+' has no column '+', '.join(str(c) for c in missing))
+        return list(OrderedDict.fromkeys(names))
+
+    def READ(self, first=0, stop=None):
+
+        """
+        Reads the columns used (COLUMNS) of the rows first to stop-1 of a columnar catalog,
+        as an astropy Table, without reading the rest of the catalog.
+        Exits if the catalog has no row first.
+        """
+        with self.OPEN() as catalog:
+            nrows = catalogs.nrows(catalog, self.cat['filetype'])
+            if first >= nrows:
+                sys.exit('ERROR: Catalog '+self.catalog+' has '+str(nrows)+' sources, there is no source in line '+str(first))
+            return catalogs.read_rows(catalog, self.cat['filetype'], self.COLUMNS(catalog), first, stop)
+
+    def ROWS(self, first, stop):
+
+        """
+        Object of class DATA_all with the properties (PROPS) of the sources
+        in the catalog lines first to stop-1 only, e.g. to fit one source of a large catalog.
+        Columnar and FITS catalogs are read only in these rows.
+        """
+        if self.cat['filetype'] == 'ASCII':
+            table = pd.read_csv(self.catalog, sep='\s+', decimal=".", skiprows = range(1, first+1), nrows = stop-first, converters = {'z':decimal.Decimal})
+        elif self.cat['filetype'] == 'FITS':
+            table = Table.read(self.catalog, memmap=True)[first:stop]
+        else:
+            table = self.READ(first, stop)
+        if len(table) == 0:
+            sys.exit('ERROR: Catalog '+self.catalog+' has no source in line '+str(first))
+
+        chunk = DATA_all(dict(self.cat), self.filters)
+        chunk.first = first
+        chunk.PROPS(table)
+        return chunk
+
+    def LINES(self):
+        """ Catalog lines of the sources of this object."""
+        return range(self.first, self.first + len(self.z))
+
+    def NAMES(self):
+        """ Names of the sources of this object, by catalog line."""
+        return dict(zip(self.LINES(), self.name))
+
+    def SHARE(self, folder):
+
+        """
+        Saves the catalog arrays (SHARED_ARRAYS) as .npy files in a subfolder of folder,
+        so that the processors of a pool map them into memory (ATTACH) 
+        instead of receiving a copy of the catalog with every source.
+        The subfolder is named by the hash of the arrays, so that runs (and chunks) sharing
+        the output folder never read each other's arrays, and every file is written
+        under a name unique to the writing process before it is renamed.
+
+        ##output:
+        - subfolder of the arrays, to give to ATTACH
+        """
+        arrays = OrderedDict()
+        for key in SHARED_ARRAYS:
+            array = np.asarray(getattr(self, key))
+            if array.dtype == object:
+                array = array.astype(str)
+            arrays[key] = array
+        arrays['first'] = np.asarray(self.first)
+
+        h = hashlib.sha1()
+        for key, array in arrays.items():
+            h.update((key + str(array.dtype) + str(array.shape)).encode())
+            h.update(np.ascontiguousarray(array).tobytes())
+        folder = folder + h.hexdigest()[:16] + '/'
+        if not os.path.lexists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        tmp = '.%s.%d.tmp.npy' % (socket.gethostname(), os.getpid())
+        for key, array in arrays.items():
+            if not os.path.lexists(folder + key + '.npy'):        # else written by another run, with the same content
+                np.save(folder + key + tmp, array)
+                os.replace(folder + key + tmp, folder + key + '.npy')
+        return folder
+
+    def ATTACH(self, folder):
+
+        """
+        Reads the catalog arrays saved with SHARE as read-only memory maps,
+        replacing PROPS in the processors of a pool.
+        """
+        for key in SHARED_ARRAYS:
+            setattr(self, key, np.load(folder + key + '.npy', mmap_mode='r'))
+        self.first = int(np.load(folder + 'first.npy'))
+        self.cat['nsources'] = len(self.z)
+
 
 class DATA():
 
@@ -357,6 +428,7 @@ class DATA():
     def __init__(self, data_all, line):
 
         catalog = data_all
+        line = line - catalog.first     # row of the source in a chunk of the catalog (DATA_all.STREAM)
         self.nus = catalog.nus[line]
         self.fluxes = catalog.fluxes[line]
         self.fluxerrs = catalog.fluxerrs[line]
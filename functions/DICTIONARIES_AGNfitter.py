@@ -21,9 +21,44 @@ from . import FILTERS_AGNfitter as filterpy
 from scipy.integrate  import trapezoid
 from scipy.interpolate import interp1d
 import time
+import json
 import pickle 
 
 
+## Template libraries and filter sets loaded in this process, shared by the
+## dictionaries of all sources fitted by the process (load_templates, load_filterset)
+TEMPLATES = dict()
+FILTERSETS = dict()
+
+## Version of the projection of the templates into the bands (filtering_models), recorded in every
+## dictionary: dictionaries of another version are built again, never reused or merged into (MODELSDICT.up_to_date)
+## 1: nearest-neighbour resampling, 2: exact band integrals
+FILTERING_VERSION = 2
+
+def load_templates(component, path, modelsettings, *args):
+
+    """
+    Template library of component ('GALAXY', 'STARBURST', 'BBB', 'TORUS' or 'AGN_RAD'),
+    as returned by the function of the same name in MODEL_AGNfitter.py.
+    It is read from the models folder only once per process and settings.
+    """
+    key = (component, path, json.dumps(modelsettings, sort_keys=True, default=str)) + tuple(int(a) for a in args)
+    if key not in TEMPLATES:
+        TEMPLATES[key] = getattr(model, component)(path, modelsettings, *args)
+    return TEMPLATES[key]
+
+def load_filterset(filters, path):
+
+    """
+    Filter set of the filter settings (FILTERS_AGNfitter.create_filtersets),
+    created only once per process and settings.
+    """
+    key = (path, json.dumps(dict((k, v) for k, v in filters.items() if k != 'dict_zarray'), sort_keys=True, default=str))
+    if key not in FILTERSETS:
+        FILTERSETS[key] = filterpy.create_filtersets(filters, path)
+    return FILTERSETS[key]
+
+
 class MODELSDICT:
 
 
@@ -49,6 +84,7 @@ class MODELSDICT:
         self.modelsettings=models
         self.nRADdata = nRADdata  #Number of valid radio data
         self.nXRaysdata = nXRaysdata  #Number of valid Xrays data
+        self.filtering_version = FILTERING_VERSION
 
         ## To be called form filters
         self.z_array = filters['dict_zarray']
@@ -71,7 +107,7 @@ class MODELSDICT:
             self.filters = self.fo.filternames
             self.filterset_name = self.fo.name
         else:
-            self.fo = filterpy.create_filtersets(a, path)
+            self.fo = load_filterset(a, path)
             self.filters = self.fo.filternames
             self.filterset_name = self.fo.name
 
@@ -89,29 +125,17 @@ class MODELSDICT:
         self.TORUSFdict = dict()
         self.z= z
         self.filterdict= filterdict
-        self.GALAXYFdict_4plot, self.GALAXY_SFRdict, self.GALAXYatt_dict, galaxy_parnames, galaxy_partypes,self.GALAXYfunctions  = model.GALAXY(self.path, self.modelsettings)
-        for c in self.GALAXYFdict_4plot.keys():
-                    gal_nu, gal_Fnu=self.GALAXYFdict_4plot[c]               
-                    bands,  gal_Fnu_filtered =  filtering_models(gal_nu, gal_Fnu, filterdict, z)            
-                    self.GALAXYFdict[c] = bands, gal_Fnu_filtered.flatten()
-
-        self.STARBURSTFdict_4plot, self.STARBURST_LIRdict, starburst_parnames, starburst_partypes ,self.STARBURSTfunctions = model.STARBURST(self.path, self.modelsettings)
-        for c in self.STARBURSTFdict_4plot.keys():
-                    sb_nu, sb_Fnu=self.STARBURSTFdict_4plot[c]               
-                    bands, sb_Fnu_filtered  =  filtering_models(sb_nu, sb_Fnu, filterdict, z)            
-                    self.STARBURSTFdict[c] = bands, sb_Fnu_filtered.flatten()
-
-        self.BBBFdict_4plot, bbb_parnames, bbb_partypes ,self.BBBfunctions= model.BBB(self.path, self.modelsettings, self.nXRaysdata)
-        for c in self.BBBFdict_4plot.keys():
-                    bbb_nu, bbb_Fnu=self.BBBFdict_4plot[c]             
-                    bands,  bbb_Fnu_filtered =  filtering_models(bbb_nu, bbb_Fnu, filterdict, z)              
-                    self.BBBFdict[c] = bands, bbb_Fnu_filtered.flatten()
-
-        self.TORUSFdict_4plot, torus_parnames, torus_partypes ,self.TORUSfunctions = model.TORUS(self.path, self.modelsettings)
-        for c in self.TORUSFdict_4plot.keys():
-                    tor_nu, tor_Fnu=self.TORUSFdict_4plot[c]               
-                    bands, tor_Fnu_filtered  =  filtering_models(tor_nu, tor_Fnu, filterdict, z)            
-                    self.TORUSFdict[c] = bands, tor_Fnu_filtered.flatten()
+        self.GALAXYFdict_4plot, self.GALAXY_SFRdict, self.GALAXYatt_dict, galaxy_parnames, galaxy_partypes,self.GALAXYfunctions  = load_templates('GALAXY', self.path, self.modelsettings)
+        self.GALAXYFdict = filtering_templates(self.GALAXYFdict_4plot, filterdict, z)
+
+        self.STARBURSTFdict_4plot, self.STARBURST_LIRdict, starburst_parnames, starburst_partypes ,self.STARBURSTfunctions = load_templates('STARBURST', self.path, self.modelsettings)
+        self.STARBURSTFdict = filtering_templates(self.STARBURSTFdict_4plot, filterdict, z)
+
+        self.BBBFdict_4plot, bbb_parnames, bbb_partypes ,self.BBBfunctions= load_templates('BBB', self.path, self.modelsettings, self.nXRaysdata)
+        self.BBBFdict = filtering_templates(self.BBBFdict_4plot, filterdict, z)
+
+        self.TORUSFdict_4plot, torus_parnames, torus_partypes ,self.TORUSfunctions = load_templates('TORUS', self.path, self.modelsettings)
+        self.TORUSFdict = filtering_templates(self.TORUSFdict_4plot, filterdict, z)
 
         norm_parnames = ['GA', 'SB', 'BB', 'TO' ]
         norm_partypes = ['free', 'free', 'free', 'free' ]
@@ -121,11 +145,8 @@ class MODELSDICT:
 
         if self.modelsettings['RADIO']== True:  #If there are radio data available, the SEDfitting consider 5 components (AGN radio is the 5th)
             self.AGN_RADFdict = dict()
-            self.AGN_RADFdict_4plot, agnrad_parnames, agnrad_partypes, self.AGN_RADfunctions  = model.AGN_RAD(self.path, self.modelsettings, self.nRADdata)
-            for c in self.AGN_RADFdict_4plot.keys():
-                agnrad_nu, agnrad_Fnu = self.AGN_RADFdict_4plot[c]               
-                bands, agnrad_Fnu_filtered  =  filtering_models(agnrad_nu, agnrad_Fnu, filterdict, z)            
-                self.AGN_RADFdict[c] = bands, agnrad_Fnu_filtered.flatten()
+            self.AGN_RADFdict_4plot, agnrad_parnames, agnrad_partypes, self.AGN_RADfunctions  = load_templates('AGN_RAD', self.path, self.modelsettings, self.nRADdata)
+            self.AGN_RADFdict = filtering_templates(self.AGN_RADFdict_4plot, filterdict, z)
             norm_parnames.append('RAD')
             norm_partypes.append('free')
             self.all_parnames.extend((agnrad_parnames, norm_parnames))
@@ -145,7 +166,7 @@ class MODELSDICT:
     
         for z in self.z_array:                
             i += 1
-            filterdict = [self.fo.central_nu_array, self.fo.lambdas_dict, self.fo.factors_dict]
+            filterdict = [self.fo.central_nu_array, self.fo.lambdas_dict, self.fo.throughputs_dict]
             dict_modelsfiltered = self.construct_dictionaryarray_filtered(z, filterdict)          #Models SEDs are redshifted and filtered
             Modelsdict[str(z)] = dict_modelsfiltered
             time.sleep(0.01)
@@ -153,13 +174,64 @@ class MODELSDICT:
 
         self.MD = Modelsdict
 
-def dictkey_arrays(MD):
+    def up_to_date(self):
+        """ True if the dictionary was filtered with the current filtering_models (FILTERING_VERSION)."""
+        return getattr(self, 'filtering_version', 1) == FILTERING_VERSION
+
+    def update_filters(self, fo):
+
+        """
+        Updates the dictionary to the filter set fo (FILTERS_AGNfitter.create_filtersets),
+        without building it again: only the fluxes of the templates in the bands 
+        which are new are computed, and the bands which are not in fo any more are dropped.
+        Only for dictionaries of the current FILTERING_VERSION (up_to_date()), so that the 
+        bands of one dictionary are always filtered with the same method.
+
+        ##output:
+        - lists of the bands [log10(nu)] added and removed
+        """
+        if not self.up_to_date():
+            raise ValueError('the model dictionary '+self.filename+' was filtered with an older filtering_models, it has to be built again')
+        added = [nu for nu in fo.central_nu_array if nu not in self.fo.central_nu_array]
+        removed = [nu for nu in self.fo.central_nu_array if nu not in fo.central_nu_array]
+        filterdict = [np.array(added), fo.lambdas_dict, fo.throughputs_dict]
+
+        components = [(self.GALAXYFdict, self.GALAXYFdict_4plot), (self.STARBURSTFdict, self.STARBURSTFdict_4plot),
+                      (self.BBBFdict, self.BBBFdict_4plot), (self.TORUSFdict, self.TORUSFdict_4plot)]
+        if self.modelsettings['RADIO']== True:
+            components.append((self.AGN_RADFdict, self.AGN_RADFdict_4plot))
+
+        for Fdict, Fdict_4plot in components:
+            if len(added) > 0:
+                Fdict_added = filtering_templates(Fdict_4plot, filterdict, self.z)
+            for c in Fdict.keys():
+                bands, Fnu_filtered = Fdict[c]
+                if len(added) > 0:
+                    bands = np.concatenate([bands, added])
+                    Fnu_filtered = np.concatenate([Fnu_filtered, Fdict_added[c][1]])
+                ## columns in the order of the bands of fo
+                columns = [list(bands).index(nu) for nu in fo.central_nu_array]
+                Fdict[c] = fo.central_nu_array, Fnu_filtered[columns]
+
+        self.fo = fo
+        self.filters = fo.filternames
+        self.filterset_name = fo.name
+        return added, removed
+
+def compact_dict(Fdict, bands):
+    """ Copy of a dictionary of filtered models {key: (bands, Fnu)} with only the bands of index bands."""
+    return dict((key, (np.ascontiguousarray(nus[bands]), np.ascontiguousarray(Fnu[bands]))) for key, (nus, Fnu) in Fdict.items())
+
+
+def dictkey_arrays(MD, bands=None):
 
     """
     Summarizes the model dictionary keys and does the interpolation to nearest value in grid.
     used to be transporte to data
 
     ##input:
+    - MD: object of class MODELSDICT
+    - bands: optional indices of the bands kept in the fluxes of the models (MODELS.DICTS)
 
     ##output:
     """
@@ -271,21 +343,32 @@ def dictkey_arrays(MD):
                     else: 
                         print('Error DICTIONARIES_AGNfitter.py: parameter type ',self.par_types, ' is unknown.')
 
+            def get_fluxes_of(self, obj):
+                    """ Fluxes of the parameters picked by obj, a get_model of the same models in all bands."""
+                    self.matched_parkeys_grid = obj.matched_parkeys_grid
+                    return self.get_fluxes(obj.matched_parkeys)
+
+    Fdicts = dict(GA=MD.GALAXYFdict, SB=MD.STARBURSTFdict, TO=MD.TORUSFdict, BB=MD.BBBFdict)
+    if MD.modelsettings['RADIO']== True:
+        Fdicts['RAD'] = MD.AGN_RADFdict
+    if bands is not None:
+        Fdicts = dict((c, compact_dict(Fdict, bands)) for c, Fdict in Fdicts.items())
+
     if MD.modelsettings['RADIO']== True:
         agnrad_parkeys = np.array(list(MD.AGN_RADFdict.keys()))
         galaxy_parnames, starburst_parnames,torus_parnames, bbb_parnames, agnrad_parnames, norm_parnames = MD.all_parnames
         galaxy_partypes, starburst_partypes,torus_partypes, bbb_partypes, agnrad_partypes, norm_partypes = MD.all_partypes 
-        agnrad_obj=get_model(agnrad_parnames,agnrad_partypes,agnrad_parkeys,MD.AGN_RADFdict,MD.z, MD.AGN_RADfunctions ,model.AGN_RADfunctions)
+        agnrad_obj=get_model(agnrad_parnames,agnrad_partypes,agnrad_parkeys,Fdicts['RAD'],MD.z, MD.AGN_RADfunctions ,model.AGN_RADfunctions)
 
     else:     
         galaxy_parnames, starburst_parnames,torus_parnames, bbb_parnames, norm_parnames = MD.all_parnames
         galaxy_partypes, starburst_partypes,torus_partypes, bbb_partypes, norm_partypes = MD.all_partypes 
         agnrad_obj = '-99.9'   #If there isn't AGN radio model create a false object, so the get model class always return 5 elements
 
-    gal_obj =get_model(galaxy_parnames,galaxy_partypes,galaxy_parkeys, MD.GALAXYFdict, MD.z, MD.GALAXYfunctions, model.GALAXYfunctions)
-    sb_obj =get_model(starburst_parnames,starburst_partypes,starburst_parkeys, MD.STARBURSTFdict,MD.z, MD.STARBURSTfunctions, model.STARBURSTfunctions)
-    tor_obj=get_model(torus_parnames,torus_partypes,torus_parkeys, MD.TORUSFdict,MD.z, MD.TORUSfunctions, model.TORUSfunctions)
-    bbb_obj=get_model(bbb_parnames,bbb_partypes,bbb_parkeys,MD.BBBFdict,MD.z, MD.BBBfunctions ,model.BBBfunctions)
+    gal_obj =get_model(galaxy_parnames,galaxy_partypes,galaxy_parkeys, Fdicts['GA'], MD.z, MD.GALAXYfunctions, model.GALAXYfunctions)
+    sb_obj =get_model(starburst_parnames,starburst_partypes,starburst_parkeys, Fdicts['SB'],MD.z, MD.STARBURSTfunctions, model.STARBURSTfunctions)
+    tor_obj=get_model(torus_parnames,torus_partypes,torus_parkeys, Fdicts['TO'],MD.z, MD.TORUSfunctions, model.TORUSfunctions)
+    bbb_obj=get_model(bbb_parnames,bbb_partypes,bbb_parkeys,Fdicts['BB'],MD.z, MD.BBBfunctions ,model.BBBfunctions)
 
     return gal_obj,sb_obj,tor_obj, bbb_obj, agnrad_obj
 
@@ -428,54 +511,161 @@ def filtering_models( model_nus, model_fluxes, filterdict, z ):
     """
     Projects the model SEDs into the filter curves of each photometric band.
 
+    The templates (F_lambda) are taken as linear between their wavelengths, and the filter 
+    curves between theirs, and the integral of their product over each band is computed exactly
+    (band_integrals), for all bands and templates at once. This replaces the resampling of
+    the templates at the wavelengths of the filters with nearest-neighbour interpolation.
+    Compared with a Simpson integration on the merged grid of template and filter wavelengths
+    (exact for these products), the filtered fluxes agree to 1e-12, and to 1e-6 in bands where
+    a template is 15 orders of magnitude below its peak. The nearest-neighbour resampling was
+    off by 0.02-2% (median) and up to 60% in bands with few template points.
+
     ##input:
     - model_nus: template frequencies [log10(nu)]
-    - model_fluxes: template fluxes [F_nu]
-    - filterdict: dictionary with all band filter curves' information.
+    - model_fluxes: template fluxes [F_nu], of one template, or (Ntemplates x Nnus)
+                    of templates with the same frequencies model_nus
+    - filterdict: dictionary with all band filter curves' information
+                  (bands, wavelengths and normalized throughputs of the filters, FILTER_SET.compile).
                   To change this, add one band and filter curve, etc,
                   look at DICTIONARIES_AGNfitter.py
     - z: redshift
 
     ##output:
     - bands [log10(nu)]
-    - Filtered fluxes at these bands [F_nu]
+    - Filtered fluxes at these bands [F_nu], (Nbands) or (Ntemplates x Nbands)
     """
 
-    bands, lambdas_dict, factors_dict = filterdict
-    filtered_model_Fnus = []
-
+    bands = filterdict[0]
+    points = band_points(filterdict)
 
     # Costumize model frequencies and fluxes [F_nu]
-    # to same units as filter curves (to wavelengths [angstrom] and F_lambda)
-    model_lambdas = nu2lambda_angstrom(model_nus) * (1+z)
-    model_lambdas =  model_lambdas[::-1]
-    model_fluxes_nu =  model_fluxes[::-1]
-    model_fluxes_lambda = fluxnu_2_fluxlambda(model_fluxes_nu, model_lambdas) 
-    mod2filter_interpol = interp1d(model_lambdas, model_fluxes_lambda, kind = 'nearest', bounds_error=False, fill_value=0.)            
-
-    # For filter curve at each band. 
-    # (Vectorised integration was not possible -> different filter-curve-arrays' sizes)
+    # to same units as filter curves (to wavelengths [angstrom] and F_lambda), in order of wavelength
+    model_lambdas = nu2lambda_angstrom(np.asarray(model_nus, dtype=float)) * (1+z)
+    order = np.argsort(model_lambdas, kind='stable')
+    model_lambdas = model_lambdas[order]
+    model_fluxes_nu = np.atleast_2d(np.asarray(model_fluxes, dtype=float))[:, order]
+
+    if len(model_fluxes_nu) > len(model_lambdas):
+        ## more templates than frequencies: the filtered fluxes are linear in the template fluxes,
+        ## so the band integrals of the templates with unit flux at one frequency are computed instead
+        unit_fluxes_lambda = np.diag(fluxnu_2_fluxlambda(np.ones(len(model_lambdas)), model_lambdas))
+        filtered_modelF_lambda = np.dot(model_fluxes_nu, band_integrals(model_lambdas, unit_fluxes_lambda, points))
+    else:
+        filtered_modelF_lambda = band_integrals(model_lambdas, fluxnu_2_fluxlambda(model_fluxes_nu, model_lambdas), points)
+
+    # Convert all from lambda, F_lambda  to Fnu and nu    
+    filtered_model_Fnus = fluxlambda_2_fluxnu(filtered_modelF_lambda, nu2lambda_angstrom(np.asarray(bands)))
+
+    return bands, filtered_model_Fnus[0] if np.ndim(model_fluxes) == 1 else filtered_model_Fnus
+
+
+def filtering_templates( templates, filterdict, z ):
+
+    """
+    Projects all templates of a model component into the filter curves (filtering_models),
+    the templates with the same frequencies at once.
+
+    ##input:
+    - templates: dictionary {parameters: (frequencies [log10(nu)], fluxes [F_nu])}, e.g. GALAXYFdict_4plot
+    - filterdict, z: as in filtering_models
+
+    ##output:
+    - dictionary {parameters: (bands [log10(nu)], filtered fluxes [F_nu])}
+    """
+    grids = dict()
+    for c in templates.keys():
+        grids.setdefault(np.asarray(templates[c][0], dtype=float).tobytes(), []).append(c)
+
+    filtered = dict()
+    for keys in grids.values():
+        bands, Fnus_filtered = filtering_models(templates[keys[0]][0], np.array([np.asarray(templates[c][1], dtype=float) for c in keys]), filterdict, z)
+        for c, Fnu_filtered in zip(keys, Fnus_filtered):
+            filtered[c] = bands, Fnu_filtered
+    return filtered
+
+
+def band_points(filterdict):
+
+    """
+    Wavelengths [angstrom] of the filter curves of all bands, one band after the other, 
+    with the normalized throughput at the start of each segment between them and its slope
+    (zero for the last point of each band), and the index of the first point of each band.
+    Filters with the same central frequency are taken in the order of the filter set.
+    """
+    bands, lambdas_dict, throughputs_dict = filterdict
+
+    lambdas, throughputs, slopes, starts = [], [], [], []
+    counts = dict()
+    n = 0
     for iband in bands:
+        i = counts.get(iband, 0)
+        counts[iband] = i + 1
+        lambdas_filter = np.asarray(lambdas_dict[iband][i], dtype=float)
+        throughput = np.asarray(throughputs_dict[iband][i], dtype=float)
+        dlambdas = np.diff(lambdas_filter)
+        slope = np.divide(np.diff(throughput), dlambdas, out=np.zeros(len(dlambdas)), where=dlambdas != 0)
+        lambdas.append(lambdas_filter)
+        throughputs.append(np.append(throughput[:-1], 0.))
+        slopes.append(np.append(slope, 0.))
+        starts.append(n)
+        n += len(lambdas_filter)
+
+    return np.concatenate(lambdas), np.concatenate(throughputs), np.concatenate(slopes), np.array(starts)
+
+
+def band_integrals(model_lambdas, model_fluxes_lambda, points, maxsize=4000000):
 
-        # Read filter curves info for each data point 
-        # (wavelengths [angstrom] and factors [non])
-        lambdas_filter = np.array(lambdas_dict[iband])
-        factors_filter = np.array(factors_dict[iband])
-        iband_angst = nu2lambda_angstrom(iband)
-        # Interpolate the model fluxes to 
-        #the exact wavelengths of filter curves
-        modelfluxes_at_filterlambdas = mod2filter_interpol(lambdas_filter)
-        # Compute the flux ratios, equivalent to the filtered fluxes: 
-        # F = int(model)/int(filter)
-        integral_model = trapezoid(modelfluxes_at_filterlambdas*factors_filter, x= lambdas_filter)
-        integral_filter = trapezoid(factors_filter, x= lambdas_filter)     
-        filtered_modelF_lambda = (integral_model/integral_filter)
-
-        # Convert all from lambda, F_lambda  to Fnu and nu    
-        filtered_modelFnu_atfilter_i = fluxlambda_2_fluxnu(filtered_modelF_lambda, iband_angst)
-        filtered_model_Fnus.append(filtered_modelFnu_atfilter_i)
-  
-    return bands, np.array(filtered_model_Fnus)
+    """
+    Integrals of the templates times the normalized filter curves over each band.
+    Between the points of a filter curve (a, b), with throughput T(a) + slope*(lambda-a),
+    the integral is T(a)*int(F) + slope*int(F*(lambda-a)). The integrals of F and F*lambda are
+    sums over the whole segments of the template grid between a and b, plus the parts of the
+    segments of a and b, which are exact for F linear in each segment. They are not taken as
+    differences of cumulative integrals, which lose the bands where the template is faint.
+    Templates are zero outside their wavelengths.
+
+    ##input:
+    - model_lambdas: wavelengths of the templates [angstrom], increasing
+    - model_fluxes_lambda: F_lambda of the templates (Ntemplates x Nlambdas)
+    - points: filter curves of the bands (band_points)
+    - maxsize: number of values computed at a time, templates are integrated in blocks
+
+    ##output:
+    - mean F_lambda of the templates in the bands (Ntemplates x Nbands)
+    """
+    lambdas_filter, throughputs, slopes, starts = points
+
+    x = model_lambdas
+    dx = np.diff(x)
+    clipped = np.clip(lambdas_filter, x[0], x[-1])
+    k = np.clip(np.searchsorted(x, clipped, side='right') - 1, 0, len(x) - 2)  # segment of each filter point
+    t = clipped - x[k]
+
+    ## whole template segments between consecutive filter points, summed with reduceat
+    lo, hi = np.minimum(k[:-1], k[1:]), np.maximum(k[:-1], k[1:])
+    sign = np.where(k[1:] > k[:-1], 1., -1.) * (hi > lo)
+    segments = np.empty(2*len(lo), dtype=int)
+    segments[::2], segments[1::2] = lo, hi
+
+    integrals = []
+    blocksize = max(1, int(maxsize // (2*len(lambdas_filter))))
+    for first in range(0, len(model_fluxes_lambda), blocksize):
+        F = model_fluxes_lambda[first:first+blocksize]
+        Fk = F[:, :-1]
+        slope = np.divide(np.diff(F, axis=1), dx, out=np.zeros(Fk.shape), where=dx > 0)
+
+        ## integrals of F and F*lambda over each template segment, and over its part before the filter points
+        I0 = np.append(0.5*(Fk + F[:, 1:])*dx, np.zeros((len(F), 1)), axis=1)
+        I1 = np.append(Fk*x[:-1]*dx + (Fk + slope*x[:-1])*dx**2/2. + slope*dx**3/3., np.zeros((len(F), 1)), axis=1)
+        p0 = Fk[:, k]*t + slope[:, k]*t**2/2.
+        p1 = Fk[:, k]*x[k]*t + (Fk[:, k] + slope[:, k]*x[k])*t**2/2. + slope[:, k]*t**3/3.
+
+        d0 = sign*np.add.reduceat(I0, segments, axis=1)[:, ::2] + p0[:, 1:] - p0[:, :-1]
+        d1 = sign*np.add.reduceat(I1, segments, axis=1)[:, ::2] + p1[:, 1:] - p1[:, :-1]
+        contributions = throughputs[:-1]*d0 + slopes[:-1]*(d1 - lambdas_filter[:-1]*d0)
+        integrals.append(np.add.reduceat(contributions, starts, axis=1))
+
+    return np.concatenate(integrals)
 
 
 
@@ -11,6 +11,12 @@ This script contains all functions which are needed to construct the total model
 (in cases: 1)add a filter which is not included, 
 2) need finer grid for better S/N data)
  see DICTIONARIES_AGNfitter.py  
+
+The filter sets are read from the filter store ALL_FILTERS.bin, written next to the
+file ALL_FILTERS (dictionary of FILTER objects) every time ALL_FILTERS changes (write_store).
+The store holds the wavelengths [Angstrom] and throughputs of all filters as plain
+float arrays, after an index with their positions, so that only the filters of a
+filter set are read (read_filters).
     
 
 """
@@ -18,13 +24,23 @@ import numpy as np
 import sys
 from collections import defaultdict
 import os
+import json
 import pickle
+import hashlib
 from astropy import units as u 
 from astropy.table import Table
 from astropy.io import ascii
+from scipy.integrate import trapezoid
 import pandas as pd
 
 
+## filters of filters['filterset'] = 'filterset_default'
+DEFAULT_FILTERS = ['SPIRE500', 'SPIRE350', 'SPIRE250', 'MIPS24', 'IRAC4',
+                   'IRAC3', 'IRAC2', 'IRAC1', 'Ks_2mass', 'H_2mass', 'J_2mass',
+                   'Y_VISTA', 'z_SUBARU', 'i_SUBARU', 'r_SUBARU', 'B_SUBARU', 'u_CHFT',
+                   'GALEX_2500']
+
+
 class FILTER:
 
 	"""
@@ -68,6 +84,26 @@ class FILTER:
 		self.central_nu = float(np.log10((Angstrom*c)/self.central_lambda.value))
 
 
+class STORED_FILTER:
+
+	"""
+	Class STORED_FILTER
+
+	Filter read from the filter store (read_filters), with the attributes of FILTER
+	used by FILTER_SET. The wavelengths [Angstrom] and throughputs are plain arrays.
+
+	"""
+
+	def __init__(self, filtername, lambdas, factors, central_lambda, central_nu, description):
+
+		self.filtername = filtername
+		self.lambdas = lambdas
+		self.factors = factors
+		self.central_lambda = central_lambda
+		self.central_nu = central_nu
+		self.description = description
+
+
 class FILTER_SET:
 	"""
 	Class FILTER_SET
@@ -77,35 +113,17 @@ class FILTER_SET:
 	##input: 
 	- filterset name 
 	- filter settings dictionary
-	- the dictionary of all filter objects
+	- the dictionary of all filter objects (or of the chosen filters only, with filternames_all)
+	- filternames_all: names of all filters, if not all of them are in the dictionary of filter objects
 
 	"""   
-	def __init__(self, filterset_name, filtersdict, filters_objects_all):
+	def __init__(self, filterset_name, filtersdict, filters_objects_all, filternames_all=None):
 
-		self.name = filterset_name
-		if filtersdict['filterset'] == 'filterset_default':
-			default_filters =['SPIRE500', 'SPIRE350', 'SPIRE250', 'MIPS24', 'IRAC4',\
-		 'IRAC3', 'IRAC2', 'IRAC1', 'Ks_2mass', 'H_2mass', 'J_2mass',\
-		 'Y_VISTA', 'z_SUBARU', 'i_SUBARU', 'r_SUBARU', 'B_SUBARU', 'u_CHFT',\
-		  'GALEX_2500']
+		if filternames_all is None:
+			filternames_all = filters_objects_all.keys()
 
-			filters_objects_chosen = [o for o in filters_objects_all.values() if o.filtername in default_filters]
-		else:
-			filters_objects_chosen = []
-
-			for o in filtersdict.keys():
-				if o not in filters_objects_all.keys():
-					if o not in ['dict_zarray', 'path', 'filterset', 'add_filters','add_filters_dict']:
-						print ('Filter ',o, ' still needs to be added.')
-						exit() 
-
-			for o in filters_objects_all.values():
-				try:
-					if o.filtername in filtersdict.keys():
-						if filtersdict[o.filtername]==True or True in filtersdict[o.filtername]:
-							filters_objects_chosen.append(o)
-				except:
-						print ('Filter ',o.filtername, ' still needs to be added.')
+		self.name = filterset_name
+		filters_objects_chosen = [filters_objects_all[name] for name in select_filters(filtersdict, filternames_all)]
 					
 		self.filternames =[i.filtername for i in filters_objects_chosen]
 		#dictionaries lambdas_dict, factors_dict
@@ -123,6 +141,24 @@ class FILTER_SET:
 		self.factors_dict= factors_dict
 
 
+	def compile(self):
+
+		"""
+		Precomputes, for every filter, the integral of the throughput over wavelength
+		and the throughput normalized by this integral, used to integrate the models
+		over the bands (DICTIONARIES_AGNfitter.filtering_models).
+		The dictionaries integrals_dict and throughputs_dict are keyed like lambdas_dict.
+		"""
+		self.integrals_dict = defaultdict(list)
+		self.throughputs_dict = defaultdict(list)
+
+		for nu in self.lambdas_dict.keys():
+			for lambdas, factors in zip(self.lambdas_dict[nu], self.factors_dict[nu]):
+				integral = trapezoid(factors, x= np.asarray(lambdas, dtype=float))
+				self.integrals_dict[nu].append(integral)
+				self.throughputs_dict[nu].append(np.asarray(factors, dtype=float) / integral)
+
+
 	def save(self,filename):
 		f = open(filename, 'wb')
 		pickle.dump(self, f, protocol=2)
@@ -241,9 +277,140 @@ def change_filters(path, old_names, new_names):
 	sys.exit("FILTERS CHANGED\n---------------\nYour filters "+ str(new_filters['names'])+ "have been successfully changed.\n>> ")
 
 
+def select_filters(filtersdict, filternames_all):
+
+	"""
+	Names of the filters chosen in the filter settings filtersdict, 
+	in the order of filternames_all (all filters of the library).
+	"""
+	if filtersdict['filterset'] == 'filterset_default':
+		return [name for name in filternames_all if name in DEFAULT_FILTERS]
+
+	for o in filtersdict.keys():
+		if o not in filternames_all:
+			if o not in ['dict_zarray', 'path', 'filterset', 'add_filters','add_filters_dict']:
+				print ('Filter ',o, ' still needs to be added.')
+				exit() 
+
+	chosen = []
+	for name in filternames_all:
+		try:
+			if name in filtersdict.keys():
+				if filtersdict[name]==True or True in filtersdict[name]:
+					chosen.append(name)
+		except Exception:
+				print ('Filter ',name, ' still needs to be added.')
+	return chosen
+
+
+def write_store(filters_objects_all_filename):
+
+	"""
+	Writes the filter store filters_objects_all_filename + '.bin' from the dictionary of
+	all FILTER objects: a JSON index {filtername: [position, length, central lambda, central nu, description, checksum]},
+	preceded by its length in bytes, and the wavelengths [Angstrom] and throughputs of all filters (float64).
+	"""
+	with open(filters_objects_all_filename, 'rb') as f:
+		filters_objects_all = pd.read_pickle(f)
+
+	index = dict()
+	arrays = []
+	position = 0
+	for name, o in filters_objects_all.items():
+		lambdas = np.asarray(o.lambdas.to(u.Angstrom).value if hasattr(o.lambdas, 'unit') else o.lambdas, dtype=np.float64)
+		factors = np.asarray(o.factors, dtype=np.float64)
+		central_lambda = o.central_lambda.to(u.Angstrom).value if hasattr(o.central_lambda, 'unit') else o.central_lambda
+		checksum = hashlib.sha1(lambdas.tobytes() + factors.tobytes()).hexdigest()
+		index[name] = [position, len(lambdas), float(central_lambda), float(o.central_nu), str(o.description), checksum]
+		arrays += [lambdas, factors]
+		position += 2*len(lambdas)
+
+	header = json.dumps(index).encode()
+	header += b' '*(-len(header) % 8)
+	store = filters_objects_all_filename + '.bin'
+	## processes writing the store at the same time each write their own file, and rename it when complete
+	tmp = store + '.' + str(os.getpid())
+	with open(tmp, 'wb') as f:
+		f.write(np.array([len(header)], dtype='<i8').tobytes())
+		f.write(header)
+		f.write(np.concatenate(arrays).astype('<f8').tobytes())
+	os.replace(tmp, store)
+
+
+def read_index(store):
+	"""
+	Index of the filter store, {filtername: [position, length, central lambda, central nu, description, checksum]},
+	and position in bytes of the arrays in the file.
+	"""
+	with open(store, 'rb') as f:
+		size = int(np.frombuffer(f.read(8), dtype='<i8')[0])
+		return json.loads(f.read(size).decode()), 8 + size
+
+
+def check_store(store):
+	"""
+	True if the filter store is complete: an index which can be read,
+	and the file as long as the curves of all filters of the index.
+	"""
+	try:
+		index, start = read_index(store)
+		end = max([entry[0] + 2*entry[1] for entry in index.values()] + [0])
+		return os.path.getsize(store) == start + 8*end
+	except (OSError, ValueError, IndexError, TypeError):
+		return False
+
+
+def read_filters(store, filternames):
+
+	"""
+	Reads the filters filternames from the filter store, 
+	without reading the other filters.
+
+	##output:
+	- dictionary {filtername: object of class STORED_FILTER}
+	"""
+	index, start = read_index(store)
+	data = np.memmap(store, dtype='<f8', mode='r', offset=start)
+
+	filters_objects = dict()
+	for name in filternames:
+		position, n, central_lambda, central_nu, description, checksum = index[name][:6]
+		lambdas, factors = np.array(data[position:position+n], dtype=np.float64), np.array(data[position+n:position+2*n], dtype=np.float64)
+		if hashlib.sha1(lambdas.tobytes() + factors.tobytes()).hexdigest() != checksum:
+			raise ValueError('the curve of the filter '+name+' in the filter store '+store+' does not match its checksum')
+		filters_objects[name] = STORED_FILTER(name, lambdas, factors, central_lambda, central_nu, description)
+	return filters_objects
+
+
+## Tables ALL_FILTERS_info.dat read in this process (filters_info)
+FILTERS_INFO = dict()
+
+def filters_info(path):
+
+	"""
+	Names and central frequencies [log Hz] of all filters, from the table
+	models/FILTERS/ALL_FILTERS_info.dat, read only once per process (again if it changes).
+	"""
+	filename = path + 'models/FILTERS/ALL_FILTERS_info.dat'
+	key = (filename, os.path.getmtime(filename))
+	if key not in FILTERS_INFO:
+		table = np.loadtxt(filename, delimiter = '|', usecols=[1,3], skiprows = 1, dtype=str)
+		FILTERS_INFO[key] = (table[:,0], table[:,1].astype(float))
+	return FILTERS_INFO[key]
+
+
+def filterset_hash(index, filternames):
+	""" Hash of the names and curves (checksums in the filter store index) of the filters of a filter set."""
+	return hashlib.sha1(json.dumps([[name, index[name][5]] for name in filternames]).encode()).hexdigest()[:16]
+
+
 def create_filtersets(filters_dict, path):
 	"""
 	Creates new filter_sets following the choice of the user given in the settings file.
+	Filter sets are compiled (FILTER_SET.compile) once and saved in the folder
+	COMPILED/ of the filters, under the hash of their filter names and curves (filterset_hash):
+	they are reused by all runs and settings files choosing the same filters,
+	and compiled again when the curves or names change (add_newfilters, change_filters).
 
 	##input:
 	- dictionary from the settings file, giving all filters to add.
@@ -263,9 +430,47 @@ def create_filtersets(filters_dict, path):
 		ADDfilters_dict = filters_dict['add_filters_dict']
 		add_newfilters(filters_objects_all_filename, ADDfilters_dict, path)	    	
 
-	a=open(filters_objects_all_filename, 'rb')
-	filters_objects_all = pd.read_pickle(a)
-	filterset = FILTER_SET(filters_dict['filterset'], filters_dict, filters_objects_all)
+	## the filter store is written again when ALL_FILTERS changes (add_newfilters, change_filters)
+	## stores written before the checksums were added to the index, or incomplete, are written again
+	store = filters_objects_all_filename + '.bin'
+	if not os.path.lexists(store) or os.path.getmtime(store) < os.path.getmtime(filters_objects_all_filename) or \
+	   not check_store(store) or any(len(entry) < 6 for entry in read_index(store)[0].values()):
+		try:
+			write_store(filters_objects_all_filename)
+		except OSError as e:
+			print ('The filter store '+store+' cannot be written ('+str(e)+'), reading '+filters_objects_all_filename)
+			a=open(filters_objects_all_filename, 'rb')
+			filters_objects_all = pd.read_pickle(a)
+			filterset = FILTER_SET(filters_dict['filterset'], filters_dict, filters_objects_all)
+			filterset.compile()
+			return filterset
+
+	index = read_index(store)[0]
+	chosen = select_filters(filters_dict, index.keys())
+	compiled = path + filters_dict['path'] + 'COMPILED/FILTERSET_' + filterset_hash(index, chosen)
+
+	if os.path.lexists(compiled):
+		with open(compiled, 'rb') as f:
+			filterset = pickle.load(f)
+		filterset.name = filters_dict['filterset']
+		return filterset
+
+	## only the filters of the filter set are read, and checked, since the compiled filter set is kept
+	try:
+		stored = read_filters(store, chosen)
+	except ValueError as e:
+		print ('Writing the filter store again: '+str(e))
+		write_store(filters_objects_all_filename)
+		stored = read_filters(store, chosen)
+	filterset = FILTER_SET(filters_dict['filterset'], filters_dict, stored, index.keys())
+	filterset.compile()
+	try:
+		if not os.path.isdir(os.path.dirname(compiled)):
+			os.makedirs(os.path.dirname(compiled), exist_ok=True)
+		filterset.save(compiled + '.' + str(os.getpid()))
+		os.replace(compiled + '.' + str(os.getpid()), compiled)
+	except OSError as e:
+		print ('The compiled filter set '+compiled+' cannot be saved ('+str(e)+')')
 
 	return filterset
 
@@ -0,0 +1,276 @@
+"""%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+      LEASES_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+This script contains the distribution of the sources of a catalog over several
+independent runs of RUN_AGNfitter_multi.py (option -d), for example on different
+nodes of a cluster which share the output folder. No queue service is needed.
+
+Each source is claimed with a lease file in the folder output_folder + 'LEASES/',
+created atomically (it fails if the file exists). While the source is fitted,
+the lease is renewed (heartbeat) every mc['lease_heartbeat'] seconds. A lease which
+was not renewed for mc['lease_expiry'] seconds belongs to a crashed run, and the
+source is claimed again by another run. Finished sources leave a '.done' file,
+and failed attempts are counted in a '.failed' file.
+
+Every lease holds a token of its holder. An expired lease is taken over by replacing
+it atomically, by the only run which created the marker file of that lease and renewal.
+A run whose heartbeat finds another token in its lease has lost it: the fit of the
+source is stopped (LeaseLost) and left to the new holder.
+
+This script includes:
+- class LeaseLost
+- class LEASES
+- function run_worker
+
+"""
+import os
+import time
+import json
+import uuid
+import signal
+import socket
+import _thread
+import threading
+import numpy as np
+from . import SCHEDULER_AGNfitter as scheduler
+
+
+class LeaseLost(BaseException):
+    """ Raised in the fit of a source whose lease was taken over by another run."""
+    pass
+
+
+def _lost(signum, frame):
+    raise LeaseLost('the lease of the source was taken over by another run')
+
+
+class LEASES:
+
+    """
+    Class LEASES
+
+    Lease files of the sources of a catalog.
+
+    ##input:
+    - folder: folder of the lease files, shared by all runs
+    - expiry: seconds after which a lease which was not renewed can be claimed again
+    - heartbeat: seconds between renewals of the leases held by this process
+    """
+
+    def __init__(self, folder, expiry, heartbeat):
+        self.folder = folder
+        self.expiry = expiry
+        self.heartbeat = heartbeat
+        self.owner = '{0:s}:{1:d}'.format(socket.gethostname(), os.getpid())
+        self._beating = dict()
+        self._tokens = dict()
+        if not os.path.lexists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    def filename(self, line, kind='lease'):
+        return self.folder + str(int(line)) + '.' + kind
+
+    def is_done(self, line):
+        return os.path.lexists(self.filename(line, 'done'))
+
+    def failures(self, line):
+        try:
+            with open(self.filename(line, 'failed')) as f:
+                return len(f.readlines())
+        except IOError:
+            return 0
+
+    def read(self, line):
+        """ Content of the lease of the source in line, None if there is none (or it is being written)."""
+        try:
+            with open(self.filename(line)) as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def holds(self, line):
+        """ True if this process holds the lease of the source in line."""
+        lease = self.read(line)
+        return lease is not None and lease.get('token') == self._tokens.get(int(line))
+
+    def claim(self, line, maxattempts=None):
+
+        """
+        Tries to claim the source in line: creates its lease, or takes over an expired lease.
+        Sources done, or failed maxattempts times, by other runs are not claimed.
+
+        ##output:
+        - True if this process holds the lease of the source
+        """
+        lease = self.filename(line)
+        token = uuid.uuid4().hex
+        content = json.dumps(dict(owner=self.owner, token=token, claimed=time.time()))
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+        except FileExistsError:
+            if not self._take_over(line, content):
+                return False
+        self._tokens[int(line)] = token
+
+        ## done or failed in another run since the list of open sources was made
+        if self.is_done(line) or (maxattempts is not None and self.failures(line) >= maxattempts):
+            self.release(line, None)
+            return False
+        self._start_heartbeat(line)
+        return True
+
+    def _take_over(self, line, content):
+
+        """
+        Replaces the lease of the source in line by content, if it expired.
+        Only the run which creates the marker file of the expired lease (token and renewal time)
+        takes it over, and the lease is replaced in one rename, so that it exists at all times.
+        """
+        lease = self.filename(line)
+        try:
+            mtime = os.stat(lease).st_mtime_ns
+        except OSError:
+            return False        # just released, the source is claimed at the next visit
+        if time.time() - mtime/1e9 <= self.expiry:
+            return False
+
+        expired = self.read(line)
+        marker = lease + '.{0:s}.{1:d}.takeover'.format((expired or dict()).get('token', 'none'), mtime)
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(marker) > self.expiry:
+                    os.remove(marker)       # left by a run which crashed while taking over
+            except OSError:
+                pass
+            return False
+
+        try:
+            ## the lease must still be the expired one: neither renewed nor taken over meanwhile
+            if os.stat(lease).st_mtime_ns != mtime or self.read(line) != expired:
+                return False
+            tmp = lease + '.' + self.owner + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(content)
+            os.replace(tmp, lease)
+        except OSError:
+            return False
+        finally:
+            os.remove(marker)
+        print ( '> Lease of line {0:d} expired, claiming it again'.format(int(line)))
+        return True
+
+    def _start_heartbeat(self, line):
+        stop = threading.Event()
+        def beat():
+            while not stop.wait(self.heartbeat):
+                if not self.holds(line):
+                    ## taken over by another run: stop the fit in the main thread (run_worker)
+                    if not stop.is_set():
+                        print ( '*** {0:s} lost the lease of line {1:d}'.format(self.owner, int(line)))
+                        _thread.interrupt_main(signal.SIGUSR1)
+                    return
+                try:
+                    os.utime(self.filename(line))
+                except OSError:
+                    pass
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        self._beating[int(line)] = stop
+
+    def release(self, line, status):
+
+        """
+        Releases the lease of the source in line, after the attempt ended with status
+        ('done', 'failed' or 'timeout'; None records nothing, e.g. for a lost lease).
+        Only a lease still held by this process is removed.
+        """
+        stop = self._beating.pop(int(line), None)
+        if stop is not None:
+            stop.set()
+        if status == 'done':
+            open(self.filename(line, 'done'), 'w').close()
+        elif status is not None:
+            with open(self.filename(line, 'failed'), 'a') as f:
+                f.write(json.dumps(dict(owner=self.owner, status=status, time=time.time()))+'\n')
+        if self.holds(line):
+            try:
+                os.remove(self.filename(line))
+            except OSError:
+                pass
+        self._tokens.pop(int(line), None)
+
+
+def run_worker(function, lines, args, mc, folder, logfile, names=None):
+
+    """
+    Claims and fits the sources in lines until all of them are done, have failed
+    mc['source_retries']+1 times, or are held by other runs with valid leases.
+    The sources are visited from a random position, so that runs starting
+    at the same time claim different sources.
+
+    ##input:
+    - function: fits one source, function(line, *args)
+    - lines: catalog lines of the sources
+    - args: tuple of the other arguments of function
+    - dictionary mc, of mcmc settings (RUN_AGNfitter_multi.py)
+    - folder: folder of the lease files
+    - logfile: file where the failures are recorded
+    - names: optional list of source names, indexed by line, for the failure records
+
+    ##output:
+    - number of sources fitted by this process
+    """
+    leases = LEASES(folder, mc['lease_expiry'], mc['lease_heartbeat'])
+    timeout = mc.get('source_timeout', 0)
+    maxattempts = mc.get('source_retries', 0) + 1
+
+    lines = list(lines)
+    start = np.random.randint(len(lines)) if len(lines) > 0 else 0
+    lines = lines[start:] + lines[:start]
+    nfitted = 0
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, _lost)       # raised by the heartbeat of a lost lease
+    t0 = time.time()
+
+    while True:
+        open_lines = [l for l in lines if not leases.is_done(l) and leases.failures(l) < maxattempts]
+        if len(open_lines) == 0:
+            break
+
+        claimed = False
+        for line in open_lines:
+            if not leases.claim(line, maxattempts):
+                continue
+            claimed = True
+            attempt = leases.failures(line) + 1
+            try:
+                record = scheduler.run_source((function, line, args, timeout, attempt))
+                leases.release(line, record['status'])
+            except LeaseLost:
+                leases.release(line, None)
+                print ( '*** Line {0:d} left to the run which took over its lease'.format(int(line)))
+                continue
+            if names is not None:
+                record['name'] = str(names[record['line']])
+            if record['status'] == 'done':
+                nfitted += 1
+                hours = (time.time() - t0)/3600.
+                print ( '- {0:s}: {1:d} sources fitted | {2:.1f} sources/hour'.format(leases.owner, nfitted, nfitted/hours))
+            else:
+                record['owner'] = leases.owner
+                scheduler.write_failure(logfile, record)
+                print ( '*** Line {0:d} {1:s} ({2:s}), see {3:s}'.format(record['line'], record['status'], record['error'], logfile))
+
+        if not claimed:
+            ## all open sources are held by other runs: wait for them to finish or expire
+            time.sleep(min(mc['lease_heartbeat'], mc['lease_expiry']))
+
+    print ( '{0:s}: {1:d} sources fitted, no sources left in the catalog'.format(leases.owner, nfitted))
+    return nfitted
@@ -0,0 +1,156 @@
+"""%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+      MANIFEST_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+This script contains the run manifest of a catalog: an SQLite database, next to
+the output folder, with one row per source recording
+- the state of the source: 'running', 'fitted' (chains saved), 'done' (output written) or 'failed',
+- the number of attempts, the start and end times, and the time spent sampling and writing the output,
+- the hash of the settings used for the fit,
+- the output products, or the last error.
+
+It replaces the probing of output files to decide whether a source still needs
+to be fitted, and allows to list the state of a catalog (option -s) and to
+fit again only the failed sources (option --redo-failed).
+
+This script includes:
+- class MANIFEST
+- functions manifest_name, settings_hash
+
+"""
+import os
+import time
+import json
+import socket
+import sqlite3
+import hashlib
+import contextlib
+
+
+STATES = ['running', 'fitted', 'done', 'failed']
+
+COLUMNS = """line INTEGER PRIMARY KEY, name TEXT, state TEXT, attempts INTEGER DEFAULT 0, settings_hash TEXT,
+             started REAL, finished REAL, fit_time REAL, output_time REAL, products TEXT, error TEXT, host TEXT, pid INTEGER,
+             ndim INTEGER, nbands INTEGER"""
+
+
+def manifest_name(cat):
+    """ File name of the run manifest of the catalog: next to the output folder."""
+    return os.path.normpath(cat['output_folder']) + '_MANIFEST.sqlite'
+
+
+def settings_hash(*settings):
+    """ Short hash of the settings dictionaries which define a fit."""
+    text = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+
+class MANIFEST:
+
+    """
+    Class MANIFEST
+
+    Run manifest of a catalog. Every method opens its own short transaction,
+    so that the processors of a pool can share the same file.
+
+    ##input:
+    - filename: SQLite file (manifest_name())
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS sources ('+COLUMNS+')')
+            ## add the columns of newer versions to older manifests
+            existing = [row[1] for row in db.execute('PRAGMA table_info(sources)')]
+            for column in COLUMNS.split(','):
+                name = column.split()[0]
+                if name not in existing:
+                    db.execute('ALTER TABLE sources ADD COLUMN '+column.strip())
+
+    @contextlib.contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with db:            # commits, or rolls back on errors
+                yield db
+        finally:
+            db.close()
+
+    def get(self, line):
+        """ Row of the source in line as a dictionary, or None if it was never fitted."""
+        with self.connect() as db:
+            db.row_factory = sqlite3.Row
+            row = db.execute('SELECT * FROM sources WHERE line=?', (int(line),)).fetchone()
+        return dict(row) if row is not None else None
+
+    def state(self, line):
+        row = self.get(line)
+        return row['state'] if row is not None else None
+
+    def is_done(self, line, fithash):
+        """ True if the output of the source in line has been written, with the settings of fithash."""
+        row = self.get(line)
+        return row is not None and row['state'] == 'done' and row['settings_hash'] == fithash
+
+    def start(self, line, name, fithash):
+        """ The fit of the source in line starts."""
+        with self.connect() as db:
+            db.execute('INSERT OR IGNORE INTO sources (line, name) VALUES (?, ?)', (int(line), str(name)))
+            db.execute("""UPDATE sources SET state='running', attempts=attempts+1, settings_hash=?, started=?, finished=NULL,
+                          error=NULL, host=?, pid=? WHERE line=?""", (fithash, time.time(), socket.gethostname(), os.getpid(), int(line)))
+
+    def fitted(self, line, fit_time, ndim=None, nbands=None):
+        """ The chains of the source in line have been saved, after fit_time seconds."""
+        with self.connect() as db:
+            db.execute("UPDATE sources SET state='fitted', fit_time=?, ndim=?, nbands=? WHERE line=?", (fit_time, ndim, nbands, int(line)))
+
+    def done(self, line, output_time, products):
+        """ The output of the source in line has been written."""
+        with self.connect() as db:
+            db.execute("UPDATE sources SET state='done', output_time=?, products=?, finished=? WHERE line=?", \
+                        (output_time, json.dumps(sorted(products)), time.time(), int(line)))
+
+    def failed(self, line, name, error):
+        """ The fit of the source in line has failed."""
+        with self.connect() as db:
+            db.execute('INSERT OR IGNORE INTO sources (line, name) VALUES (?, ?)', (int(line), str(name)))
+            db.execute("UPDATE sources SET state='failed', error=?, finished=? WHERE line=?", (error, time.time(), int(line)))
+
+    def lines(self, state):
+        """ Catalog lines of the sources in state."""
+        with self.connect() as db:
+            return [row[0] for row in db.execute('SELECT line FROM sources WHERE state=? ORDER BY line', (state,))]
+
+    def timings(self):
+        """ Fit times of the sources fitted before, {line: (ndim, nbands, fit_time)} (COSTS_AGNfitter.py)."""
+        with self.connect() as db:
+            rows = db.execute('SELECT line, ndim, nbands, fit_time FROM sources WHERE fit_time IS NOT NULL').fetchall()
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def status(self, nsources, fithash=None):
+
+        """
+        Prints the number of sources in each state, the mean times per source,
+        and the failed sources with their errors.
+        """
+        with self.connect() as db:
+            counts = dict(db.execute('SELECT state, COUNT(*) FROM sources GROUP BY state').fetchall())
+            fit_time, output_time = db.execute("SELECT AVG(fit_time), AVG(output_time) FROM sources WHERE state='done'").fetchone()
+            stale = db.execute("SELECT COUNT(*) FROM sources WHERE state='done' AND settings_hash!=?", (fithash,)).fetchone()[0]
+            failed = db.execute("SELECT line, name, attempts, error FROM sources WHERE state='failed' ORDER BY line").fetchall()
+
+        print ( '________________________')
+        print ( 'RUN MANIFEST: ', self.filename)
+        print ( '- sources in catalog: ', nsources)
+        for state in STATES:
+            print ( '- {0:s}: {1:d}'.format(state, counts.get(state, 0)))
+        print ( '- not started: ', nsources - sum(counts.values()))
+        if fit_time is not None:
+            print ( '- mean time per source: sampling %.2g min, output %.2g min' % (fit_time/60., output_time/60.))
+        if fithash is not None and stale > 0:
+            print ( '- %i done sources were fitted with other settings' % stale)
+        for line, name, attempts, error in failed:
+            print ( '*** line {0:d} ({1:s}), {2:d} attempts: {3:s}'.format(line, str(name), attempts, str(error)))
@@ -15,11 +15,14 @@ import sys,os
 import time
 import pickle
 from . import PARAMETERSPACE_AGNfitter as parspace
+from . import WARMSTART_AGNfitter as warmstart
+from . import RESOURCES_AGNfitter as resources
 import ultranest
 from ultranest import ReactiveNestedSampler, stepsampler, dychmc, popstepsampler
 import numpy as np
 from ultranest.plot import cornerplot, traceplot
 from ultranest.stepsampler import OrthogonalDirectionGenerator
+from ultranest.hotstart import get_auxiliary_contbox_parameterization
 import importlib
 
 
@@ -33,8 +36,9 @@ if __name__ == 'main':
 def main(data, models, P, mc):
 
     """
-    Main function for the MCMC sampling.
-    Integrates Emcee with parameter settings and mcmc settings.
+    Main function for the sampling.
+    Runs the sampler backend chosen in mc['sampling_algorithm'] (SAMPLERS_AGNfitter.py)
+    with parameter settings and mcmc settings.
     Saves chains into files.
 
     ##input:
@@ -42,15 +46,23 @@ def main(data, models, P, mc):
     - dictionary P, of parameter settings (PARAMETERSPACE_AGNfitter.py)
     - dictionary mc, of mcmc settings (RUN_AGNfitter_multi.py)
     """
+    from . import SAMPLERS_AGNfitter as samplers
 
     print( '......................................................')
     print( 'model parameters', P['names'])
     print( 'minimum values', ['{0:.2f}'.format(k) for k in P['min']])
     print( 'maximum values', ['{0:.2f}'.format(k) for k in P['max']])
     print( '......................................................')
-    print ( mc['Nwalkers'], 'walkers')
 
-    Npar = len(P['names'])
+    sampler = samplers.get_sampler(mc)
+    sampler.run(data, models, P)
+
+
+def run_ultranest(data, models, P, mc):
+
+    """
+    Runs UltraNest and saves the chains into data.output_folder/name/ultranest/.
+    """
 
     # Functions for ultranest
     def my_posterior(params):
@@ -71,82 +83,265 @@ def main(data, models, P, mc):
             params[i] = normalization
         return params
 
-    if mc['sampling_algorithm'] == 'ultranest':
+    if not os.path.lexists(data.output_folder+str(data.name)):
+        os.mkdir(data.output_folder+str(data.name))
+    log_dir = data.output_folder+str(data.name)+'/ultranest'
+
+    ## Warm start: posterior samples of similar sources define a tighter auxiliary proposal (hot start).
+    ## The samples are kept in log_dir, so that an interrupted run resumes with the same parameterization.
+    paramnames, loglike, transform = list(P['names']), my_posterior, my_params_transform
+    if os.path.lexists(log_dir+'/warmstart.sav'):
+        with open(log_dir+'/warmstart.sav', 'rb') as f:
+            upoints = pickle.load(f)
+    elif not os.path.lexists(log_dir):
+        p0 = warmstart.initial_samples(data, P, mc, 1000)
+        upoints = None if p0 is None else np.clip((p0 - np.array(P['min']))/(np.array(P['max']) - np.array(P['min'])), 1e-6, 1-1e-6)
+        if upoints is not None:
+            os.mkdir(log_dir)
+            f = open(log_dir+'/warmstart.sav', 'wb')
+            pickle.dump(upoints, f, protocol=2)
+            f.close()
+    else:
+        upoints = None
+    if upoints is not None:
+        paramnames, loglike, transform, _ = get_auxiliary_contbox_parameterization(paramnames, my_posterior, my_params_transform, \
+                                                upoints, np.ones(len(upoints))/len(upoints), vectorized=True)
+
+    sampler = ultranest.ReactiveNestedSampler(paramnames, loglike, transform, resume=True, log_dir= log_dir, vectorized=True)
+
+    if mc['direction_generation'] == 'de-mix':
+        direction_stepsampler = ultranest.stepsampler.generate_mixture_random_direction
+    elif mc['direction_generation'] == 'region-slice':
+        direction_stepsampler = ultranest.stepsampler.generate_region_oriented_direction
+    elif mc['direction_generation'] == 'cube-ortho-harm':
+        direction_stepsampler = OrthogonalDirectionGenerator(ultranest.stepsampler.generate_random_direction)
+
+
+    sampler.stepsampler = ultranest.stepsampler.SliceSampler( nsteps=20,
+     generate_direction = direction_stepsampler)  # step sampling technique for high dimensional spaces
+                                                  #without this, the code can take more than 2h for 3 sources
+
+    sampler.run( min_num_live_points= mc['live_points'], min_ess= mc['min_ess'], max_num_improvement_loops = mc['num_loops'] , ) 
+
+    if mc.get('diagnostic_plots', True):
+        sampler.plot_run()
+        sampler.plot_trace()
+        sampler.plot_corner()
+    else:
+        ## Headless batch mode: only the chains are written here, the diagnostic 
+        ## plots are produced later by render_diagnostics() (option -r of RUN_AGNfitter_multi.py)
+        write_diagnostics_manifest(log_dir, paramnames)
+
+
+def run_emcee(data, models, P, mc):
+
+    """
+    Runs the emcee burn-in sets and the MCMC sampling,
+    and saves the chains into samples_burn1-2-3.sav and samples_mcmc.sav.
+    """
+
+    print ( mc['Nwalkers'], 'walkers')
+    Npar = len(P['names'])
 
+    #Change default value of quiet = False in emcee auto correlation time function
+    file_autocorr = os.path.dirname(emcee.__file__) + '/autocorr.py'
+
+    acor_2r = open(file_autocorr, 'r')
+    Lines = acor_2r.readlines()
+    acor_2r.close()
+    with open(file_autocorr, 'w') as acor_py:
+        for line in Lines:
+            if 'integrated_time(x, c=5, tol=50, quiet=False)' in line:
+                line = line.replace('quiet=False', 'quiet=True')
+                print('Autocorr python file has been changed. Quiet input of integrated_time became True')
+            acor_py.write(line)
+    acor_py.close()
+    importlib.reload(emcee.autocorr)
+
+    if mc.get('evaluators', 1) > 1:
+        ## the walkers of each move are evaluated by a pool of processes (RESOURCES_AGNfitter.py)
+        evaluator = resources.EVALUATOR(data, models, P, mc['evaluators'], mc.get('threads', 1))
+        sampler = emcee.EnsembleSampler( mc['Nwalkers'], Npar, evaluator, vectorize=True)
+    else:
+        evaluator = None
+        sampler = emcee.EnsembleSampler( mc['Nwalkers'], Npar, parspace.ln_probab, args=[data, models, P])
+
+    ## BURN-IN SETS ##
+    if mc['Nburn'] > 0:
+        t1 = time.time()
         if not os.path.lexists(data.output_folder+str(data.name)):
             os.mkdir(data.output_folder+str(data.name))
 
-        sampler = ultranest.ReactiveNestedSampler(P['names'], my_posterior, my_params_transform, resume=True, log_dir=  data.output_folder+str(data.name)+'/ultranest', vectorized=True)
+        p_maxlike = warmstart.initial_samples(data, P, mc, mc['Nwalkers'])
+        if p_maxlike is None:
+            p_maxlike = parspace.get_initial_positions(mc['Nwalkers'], P)
+            mc_burn = mc
+        else:
+            ## walkers start from the posteriors of similar sources: shorter burn-in sets
+            mc_burn = dict(mc, Nburn = max(1, int(mc['Nburn']*mc['warm_start_burnfrac'])))
+        Nr_BurnIns = mc['Nburnsets']  
+
+        for i in range(Nr_BurnIns):
+            p_maxlike, state = run_burn_in(sampler, mc_burn, p_maxlike, data.name, data.output_folder, i)
+            savedfile = data.output_folder+str(data.name)+'/samples_burn1-2-3.sav'
+            p_maxlike = parspace.get_best_position(savedfile, mc['Nwalkers'], P)
+        print( '%.2g min elapsed' % ((time.time() - t1)/60.))
+
+    ## MCMC SAMPLING ##
+    if mc['Nmcmc'] > 0:
+        t2 = time.time()
+        run_mcmc(sampler, p_maxlike, data.name,data.output_folder, mc)
+        print( '%.2g min elapsed' % ((time.time() - t2)/60.))
+    del sampler.pool  
+    if evaluator is not None:
+        evaluator.close()
+
+    #Change to default value of quiet = False in emcee auto correlation time function
+
+    acor_2r = open(file_autocorr, 'r')
+    Lines = acor_2r.readlines()
+    acor_2r.close()
+    with open(file_autocorr, 'w') as acor_py:
+        for line in Lines:
+            if 'integrated_time(x, c=5, tol=50, quiet=True)' in line:
+                line = line.replace('quiet=True', 'quiet=False')
+                print('Autocorr python file has been changed. Quiet input of integrated_time became False again')
+            acor_py.write(line)
+    acor_py.close()
+
+
+def run_optimizer(data, models, P, mc):
 
-        if mc['direction_generation'] == 'de-mix':
-            direction_stepsampler = ultranest.stepsampler.generate_mixture_random_direction
-        elif mc['direction_generation'] == 'region-slice':
-            direction_stepsampler = ultranest.stepsampler.generate_region_oriented_direction
-        elif mc['direction_generation'] == 'cube-ortho-harm':
-            direction_stepsampler = OrthogonalDirectionGenerator(ultranest.stepsampler.generate_random_direction)
+    """
+    Fast alternative to the samplers, for quick-look fits of large catalogs.
+    Finds the maximum a posteriori (MAP) parameters with a multi-start Powell optimization,
+    approximates the posterior around it with a Gaussian (Laplace approximation) and draws
+    samples from it, which are reweighted with the true posterior (importance sampling).
+    Saves the equally weighted samples and the evidence into data.output_folder/name/optimizer/.
 
+    ##input:
+    - object data of class DATA (DATA_AGNfitter.py)
+    - dictionary P, of parameter settings (PARAMETERSPACE_AGNfitter.py)
+    - dictionary mc, of mcmc settings, with the keys 'optimizer_starts' and 'optimizer_samples'
+    """
+    from scipy.optimize import minimize
+    from scipy.stats import multivariate_normal
 
-        sampler.stepsampler = ultranest.stepsampler.SliceSampler( nsteps=20,
-         generate_direction = direction_stepsampler)  # step sampling technique for high dimensional spaces
-                                                      #without this, the code can take more than 2h for 3 sources
+    Npar = len(P['names'])
+    pmin = np.array(P['min'], dtype=float)
+    pmax = np.array(P['max'], dtype=float)
+    width = pmax - pmin
+    folder = data.output_folder+str(data.name)+'/optimizer'
+
+    def neg_lnprob(pars):
+        lnp = parspace.ln_probab(tuple(pars), data, models, P)
+        return -lnp if np.isfinite(lnp) else 1e300
+
+    t1 = time.time()
+
+    ## MAP: MULTI-START OPTIMIZATION ##
+    starts = np.vstack((0.5*(pmin + pmax), pmin + width*np.random.uniform(size=(mc['optimizer_starts']-1, Npar))))
+    best = None
+    nfev = 0
+    for x0 in starts:
+        res = minimize(neg_lnprob, x0, method='Powell', bounds=list(zip(pmin, pmax)))
+        nfev += res.nfev
+        if best is None or res.fun < best.fun:
+            best = res
+    p_map = best.x
+    print( 'MAP ln-posterior %.2f, from %i starts (%i evaluations)' % (-best.fun, len(starts), nfev))
+
+    ## LAPLACE APPROXIMATION AND IMPORTANCE SAMPLING ##
+    cov = laplace_covariance(neg_lnprob, p_map, pmin, pmax)
+
+    Ns = mc['optimizer_samples']
+    proposal = np.random.multivariate_normal(p_map, cov, size=Ns)
+    lnq = multivariate_normal(p_map, cov, allow_singular=True).logpdf(proposal)
+    if mc.get('evaluators', 1) > 1:
+        evaluator = resources.EVALUATOR(data, models, P, mc['evaluators'], mc.get('threads', 1))
+        lnp = evaluator(proposal)
+        evaluator.close()
+    else:
+        lnp = np.array([parspace.ln_probab(tuple(p), data, models, P) for p in proposal])
+    lnw = lnp - lnq
+    valid = np.isfinite(lnw)
+
+    if valid.any():
+        lnw_max = lnw[valid].max()
+        w = np.where(valid, np.exp(np.where(valid, lnw, lnw_max) - lnw_max), 0.)
+        ## Evidence normalized to the flat prior volume, as in the UltraNest runs
+        logz = lnw_max + np.log(np.sum(w)/Ns) - np.sum(np.log(width))
+        w = w/np.sum(w)
+        ess = 1./np.sum(w**2)
+        idx = np.random.choice(Ns, Ns, p=w)
+        samples, logl = proposal[idx], lnp[idx]
+    else:
+        logz, ess = np.nan, 1.
+        samples, logl = np.tile(p_map, (Ns, 1)), np.full(Ns, -best.fun)
+
+    if ess < 0.1*Ns:
+        print( 'Warning: the Laplace approximation describes the posterior poorly (ESS = %.0f of %i samples).' % (ess, Ns))
+        print( 'Consider sampling this source with ultranest or emcee.')
+    print( '%.2g min elapsed' % ((time.time() - t1)/60.))
+
+    if not os.path.lexists(folder+'/chains'):
+        os.makedirs(folder+'/chains')
+    np.savetxt(folder+'/chains/equal_weighted_post.txt', np.column_stack((logl, samples)), header=' '.join(['logl']+list(P['names'])), comments='')
+    np.savetxt(folder+'/chains/run.txt', [[logz, ess, -best.fun]], header='logz ess logl_map', comments='')
+
+    f = open(folder+'/laplace.sav', 'wb')
+    pickle.dump(dict(names=list(P['names']), map=p_map, lnprob_map=-best.fun, cov=cov, logz=logz, ess=ess), f, protocol=2)
+    f.close()
 
-        sampler.run( min_num_live_points= mc['live_points'], min_ess= mc['min_ess'], max_num_improvement_loops = mc['num_loops'] , ) 
-        sampler.plot_run()
-        sampler.plot_trace()
-        sampler.plot_corner()
 
-    elif mc['sampling_algorithm'] == 'emcee':
-        #Change default value of quiet = False in emcee auto correlation time function
-        file_autocorr = os.path.dirname(emcee.__file__) + '/autocorr.py'
-
-        acor_2r = open(file_autocorr, 'r')
-        Lines = acor_2r.readlines()
-        acor_2r.close()
-        with open(file_autocorr, 'w') as acor_py:
-            for line in Lines:
-                if 'integrated_time(x, c=5, tol=50, quiet=False)' in line:
-                    line = line.replace('quiet=False', 'quiet=True')
-                    print('Autocorr python file has been changed. Quiet input of integrated_time became True')
-                acor_py.write(line)
-        acor_py.close()
-        importlib.reload(emcee.autocorr)
+def laplace_covariance(neg_lnprob, p_map, pmin, pmax, step=0.02):
 
-        sampler = emcee.EnsembleSampler( mc['Nwalkers'], Npar, parspace.ln_probab, args=[data, models, P])
+    """
+    Covariance of the Laplace approximation at the MAP, from the finite-difference Hessian
+    of -ln(posterior). The steps are a fraction 'step' of the prior widths, so that they span
+    several cells of the model grids, on which the posterior is piecewise constant.
+    The flat prior adds the curvature of a Gaussian of the same variance (width**2/12), so that
+    directions without curvature keep the prior width. If the Hessian is still not positive
+    definite, its diagonal is used.
 
-        ## BURN-IN SETS ##
-        if mc['Nburn'] > 0:
-            t1 = time.time()
-            if not os.path.lexists(data.output_folder+str(data.name)):
-                os.mkdir(data.output_folder+str(data.name))
+    ##input:
+    - neg_lnprob: function returning -ln(posterior)
+    - p_map: MAP parameters
+    - pmin, pmax: prior limits
 
-            p_maxlike = parspace.get_initial_positions(mc['Nwalkers'], P)
-            Nr_BurnIns = mc['Nburnsets']  
-
-            for i in range(Nr_BurnIns):
-                p_maxlike, state = run_burn_in(sampler, mc, p_maxlike, data.name, data.output_folder, i)
-                savedfile = data.output_folder+str(data.name)+'/samples_burn1-2-3.sav'
-                p_maxlike = parspace.get_best_position(savedfile, mc['Nwalkers'], P)
-            print( '%.2g min elapsed' % ((time.time() - t1)/60.))
-
-        ## MCMC SAMPLING ##
-        if mc['Nmcmc'] > 0:
-            t2 = time.time()
-            run_mcmc(sampler, p_maxlike, data.name,data.output_folder, mc)
-            print( '%.2g min elapsed' % ((time.time() - t2)/60.))
-        del sampler.pool  
-
-        #Change to default value of quiet = False in emcee auto correlation time function
-
-        acor_2r = open(file_autocorr, 'r')
-        Lines = acor_2r.readlines()
-        acor_2r.close()
-        with open(file_autocorr, 'w') as acor_py:
-            for line in Lines:
-                if 'integrated_time(x, c=5, tol=50, quiet=True)' in line:
-                    line = line.replace('quiet=True', 'quiet=False')
-                    print('Autocorr python file has been changed. Quiet input of integrated_time became False again')
-                acor_py.write(line)
-        acor_py.close()
+    ##output:
+    - covariance matrix (Npar x Npar)
+    """
+    Npar = len(p_map)
+    width = pmax - pmin
+    h = step*width
+    f0 = neg_lnprob(p_map)
+
+    def f(dx):
+        return neg_lnprob(np.clip(p_map + dx, pmin, pmax))
+
+    H = np.zeros((Npar, Npar))
+    for i in range(Npar):
+        ei = np.zeros(Npar)
+        ei[i] = h[i]
+        fs = [f(ei), f(-ei)]
+        if max(fs) < 1e300:
+            H[i,i] = (fs[0] - 2*f0 + fs[1])/h[i]**2
+        for j in range(i+1, Npar):
+            ej = np.zeros(Npar)
+            ej[j] = h[j]
+            fs = [f(ei+ej), f(ei-ej), f(-ei+ej), f(-ei-ej)]
+            if max(fs) < 1e300:
+                H[i,j] = H[j,i] = (fs[0] - fs[1] - fs[2] + fs[3])/(4*h[i]*h[j])
+
+    H_prior = 12./width**2
+    try:
+        np.linalg.cholesky(H + np.diag(H_prior))
+        cov = np.linalg.inv(H + np.diag(H_prior))
+    except np.linalg.LinAlgError:
+        cov = np.diag(1./np.maximum(np.diag(H), H_prior))
+
+    return cov
 
 """==================================================
  SAMPLING FUNCTIONS
@@ -205,3 +400,77 @@ def save_chains(filename, sampler, pos, state):
         lnprob=sampler.lnprobability, final_pos=pos, state=state, acor=sampler.acor), f, protocol=2)
     f.close()
 
+
+"""==================================================
+ DIAGNOSTIC PLOTS (HEADLESS BATCH MODE)
+=================================================="""
+
+
+def write_diagnostics_manifest(log_dir, paramnames, plots=('run', 'trace', 'corner')):
+    """
+    Save the manifest of diagnostic plots that are still pending for an UltraNest run.
+    It is read by render_diagnostics(), which produces the plots in a separate stage.
+
+    ##input:
+    - log_dir: UltraNest output folder of the source
+    - paramnames: list of parameter names (P['names'])
+    - plots: diagnostic plots to be produced
+    """
+    f = open(log_dir+'/diagnostics.sav', 'wb')
+    pickle.dump(dict(paramnames=list(paramnames), plots=list(plots), rendered=False), f, protocol=2)
+    f.close()
+
+
+def render_diagnostics(log_dir, clobber=False):
+    """
+    Produce the UltraNest run, trace and corner plots of a source fitted in headless batch mode,
+    from the chains saved in log_dir. The plots are written to log_dir/plots/, 
+    as sampler.plot_run(), sampler.plot_trace() and sampler.plot_corner() do.
+
+    ##input:
+    - log_dir: UltraNest output folder of the source
+    - clobber: render again, even if the manifest says the plots are done
+
+    ##output:
+    - True if plots were produced, False if there was nothing to render
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from ultranest.integrator import read_file
+    from ultranest.plot import runplot
+
+    manifest_name = log_dir+'/diagnostics.sav'
+    if not os.path.lexists(manifest_name):
+        return False
+    with open(manifest_name, 'rb') as f:
+        manifest = pickle.load(f)
+    if manifest['rendered'] and not clobber:
+        return False
+
+    with np.errstate(divide='ignore'):       # the last iterations have no live points left
+        sequence, results = read_file(log_dir, len(manifest['paramnames']), random=False)
+    results['paramnames'] = manifest['paramnames']
+
+    if not os.path.lexists(log_dir+'/plots'):
+        os.mkdir(log_dir+'/plots')
+
+    if 'run' in manifest['plots']:
+        runplot(results=sequence, logplot=True)
+        plt.savefig(log_dir+'/plots/run.pdf', bbox_inches='tight')
+        plt.close()
+    if 'trace' in manifest['plots']:
+        traceplot(results=sequence, labels=manifest['paramnames'])
+        plt.savefig(log_dir+'/plots/trace.pdf', bbox_inches='tight')
+        plt.close()
+    if 'corner' in manifest['plots']:
+        cornerplot(results)
+        plt.savefig(log_dir+'/plots/corner.pdf', bbox_inches='tight')
+        plt.close()
+
+    manifest['rendered'] = True
+    f = open(manifest_name, 'wb')
+    pickle.dump(manifest, f, protocol=2)
+    f.close()
+
+    return True
@@ -18,6 +18,7 @@ TORUS_nf
 
 """
 
+import sys
 import numpy as np
 from math import pi
 import pickle
@@ -28,7 +29,8 @@ import astropy.units as u
 import itertools
 import pandas as pd
 import functions.DICTIONARIES_AGNfitter as dicts
-from scipy.interpolate import interp1d
+import functions.PARAMETERSPACE_AGNfitter as parspace
+from scipy.interpolate import interp1d, CubicSpline
 from astropy.cosmology import FlatLambdaCDM       #Cosmology that we assume for estimate luminosity distance   
                
 
@@ -1282,12 +1284,49 @@ def GALAXYred_CharlotFall(gal_nu, gal_Fnu,GAebv):
 
 Angstrom = 1e10
 
-def z2Dlum(z):
+## The luminosity distances of the assumed cosmology are interpolated in a table,
+## computed once per process and checked against astropy (z2Dlum)
+COSMOLOGY = FlatLambdaCDM(H0=67.4* u.km / u.s / u.Mpc, Tcmb0=2.725 * u.K, Om0=0.315)  
+DLUM_ZRANGE = (1e-5, 20.)      # redshifts of the table, other distances are computed by astropy
+DLUM_NZ = 2000                  # points of the table, uniform in log z
+DLUM_RTOL = 1e-7                # maximum relative error of the table (astropy integrates to ~3e-8)
+DLUM_TABLE = dict()
+
+def dlum_table():
+
+    """
+    Cubic spline of log10(D_L [cm]) in log10(z), computed on the first call.
+    Its relative error is measured against astropy halfway between the points of the table.
+    If it is above DLUM_RTOL, a warning is printed and None is returned: the distances
+    are then computed by astropy (z2Dlum).
+    """
+    if 'spline' not in DLUM_TABLE:
+        logz = np.linspace(np.log10(DLUM_ZRANGE[0]), np.log10(DLUM_ZRANGE[1]), DLUM_NZ)
+        spline = CubicSpline(logz, np.log10(COSMOLOGY.luminosity_distance(10**logz).to(u.cm).value))
+        midz = 10**(0.5*(logz[1:] + logz[:-1]))
+        error = np.max(np.abs(10**spline(np.log10(midz)) / COSMOLOGY.luminosity_distance(midz).to(u.cm).value - 1.))
+        if error > DLUM_RTOL:
+            print ( 'Warning: the luminosity distance table has a relative error of %.2g, above %.2g. ' \
+                    'The distances are computed by astropy.' % (error, DLUM_RTOL))
+            spline = None
+        DLUM_TABLE.update(spline=spline, error=error)
+    return DLUM_TABLE['spline']
 
-    cosmo = FlatLambdaCDM(H0=67.4* u.km / u.s / u.Mpc, Tcmb0=2.725 * u.K, Om0=0.315)  
-    dlum_cm = cosmo.luminosity_distance(z).to(u.cm).value
+def z2Dlum(z):
 
-    return dlum_cm
+    """
+    Luminosity distance [cm] at redshift z (number or array), in the assumed cosmology.
+    """
+    z = np.asarray(z, dtype=float)
+    spline = dlum_table()
+    intable = (z >= DLUM_ZRANGE[0]) & (z <= DLUM_ZRANGE[1]) & (spline is not None)
+    dlum_cm = np.empty(z.shape)
+    if np.any(intable):
+        dlum_cm[intable] = 10**spline(np.log10(z[intable]))
+    if not np.all(intable):
+        dlum_cm[~intable] = COSMOLOGY.luminosity_distance(z[~intable]).to(u.cm).value
+
+    return dlum_cm if dlum_cm.ndim > 0 else float(dlum_cm)
    
 def fluxlambda_2_fluxnu (flux_lambda, wl_angst):
 
@@ -1300,108 +1339,69 @@ def fluxlambda_2_fluxnu (flux_lambda, wl_angst):
              COMPUTED QUANTITIES
 -----------------------------------------------"""
 
-def stellar_info(chain, data, models, mc):
+def stellar_info(chain, data, models):
 
     """
-    computes stellar masses and SFRs
+    computes stellar masses and SFRs of all samples at once
     """
     gal_obj,_,_,_,_ = models.dictkey_arrays
+    MD= models.dict_modelfluxes
+
+    chain = np.atleast_2d(chain)
+    if models.settings['RADIO'] == False and (models.settings['BBB'] == 'R06' or models.settings['BBB'] == 'THB21'):
+        GA = chain[:, -4]
+    elif models.settings['RADIO'] == False and (models.settings['BBB'] != 'R06' and models.settings['BBB'] != 'THB21'):
+        GA = chain[:, -3]
+    elif models.settings['RADIO'] == True and (models.settings['BBB'] == 'R06' or models.settings['BBB'] == 'THB21'):
+        GA = chain[:, -5] 
+    elif models.settings['RADIO'] == True and (models.settings['BBB'] != 'R06' and models.settings['BBB'] != 'THB21'):
+        GA = chain[:, -4] #- 18. ## 1e18 is the common normalization factor used in parspace.ymodel 
+                        ## in order to have comparable NORMfactors  
+
+    ## grid keys of the parameters of the SFR (tau, age, and metallicity first for BC03_metal; not EBVgal)
+    ## nearest to the samples, chosen as in gal_obj.pick_nD
+    keys = []
+    idxs = []
+    for i in range(len(gal_obj.par_names)-1):
+        _, first = np.unique(gal_obj.pars_modelkeys_float[i], return_index=True)
+        first = np.sort(first)          # in the order of the keys, so that ties are broken as by argmin
+        keys.append(gal_obj.pars_modelkeys[i][first])
+        idxs.append(np.abs(gal_obj.pars_modelkeys_float[i][first] - chain[:, i, None]).argmin(axis=1))
+    SFR_mcmc = sfr_table(MD.GALAXY_SFRdict, keys)[tuple(idxs)]
 
-    if mc['sampling_algorithm'] == 'ultranest':
-        if models.settings['RADIO'] == False and (models.settings['BBB'] == 'R06' or models.settings['BBB'] == 'THB21'):
-            GA = chain.iloc[:, -4]
-        elif models.settings['RADIO'] == False and (models.settings['BBB'] != 'R06' and models.settings['BBB'] != 'THB21'):
-            GA = chain.iloc[:, -3]
-        elif models.settings['RADIO'] == True and (models.settings['BBB'] == 'R06' or models.settings['BBB'] == 'THB21'):
-            GA = chain.iloc[:, -5] 
-        elif models.settings['RADIO'] == True and (models.settings['BBB'] != 'R06' and models.settings['BBB'] != 'THB21'):
-            GA = chain.iloc[:, -4] #- 18. ## 1e18 is the common normalization factor used in parspace.ymodel 
-                            ## in order to have comparable NORMfactors  
-        MD= models.dict_modelfluxes
-
-        if len(gal_obj.par_names)==3:
-            tau_mcmc = chain.iloc[:,0]  
-            age_mcmc = chain.iloc[:,1] 
-        elif len(gal_obj.par_names)==4:
-            metal_mcmc = chain.iloc[:,0] 
-            tau_mcmc = chain.iloc[:,1]     
-            age_mcmc = chain.iloc[:,2] 
-    else:
-        if models.settings['RADIO'] == False and (models.settings['BBB'] == 'R06' or models.settings['BBB'] == 'THB21'):
-            GA = chain[:, -4]
-        elif models.settings['RADIO'] == False and (models.settings['BBB'] != 'R06' and models.settings['BBB'] != 'THB21'):
-            GA = chain[:, -3]
-        elif models.settings['RADIO'] == True and (models.settings['BBB'] == 'R06' or models.settings['BBB'] == 'THB21'):
-            GA = chain[:, -5] 
-        elif models.settings['RADIO'] == True and (models.settings['BBB'] != 'R06' and models.settings['BBB'] != 'THB21'):
-            GA = chain[:, -4] #- 18. ## 1e18 is the common normalization factor used in parspace.ymodel 
-                            ## in order to have comparable NORMfactors  
-        MD= models.dict_modelfluxes
-
-        if len(gal_obj.par_names)==3:
-            tau_mcmc = chain[:,0]  
-            age_mcmc = chain[:,1] 
-        elif len(gal_obj.par_names)==4:
-            metal_mcmc = chain[:,0] 
-            tau_mcmc = chain[:,1]     
-            age_mcmc = chain[:,2] 
-  
     z = data.z
     distance = z2Dlum(z)
 
     #constants
     solarlum = const.L_sun.to(u.erg/u.second) #3.839e33
 
-    Mstar_list=[]
-    SFR_list=[]
-
-    if mc['sampling_algorithm'] == 'ultranest':
-        for i in range(len(tau_mcmc)):        
-            N = 10**GA.iloc[i]* 4* pi* distance**2 / (solarlum.value)/ (1+z)
-            N = renorm_template('GA', N)
-
-            if len(gal_obj.par_names)==3:
-                gal_obj.pick_nD(tuple([tau_mcmc.iloc[i], age_mcmc.iloc[i], 0.]))
-                tau_dct, age_dct, ebvg_dct=gal_obj.matched_parkeys
-                SFR_mcmc =MD.GALAXY_SFRdict[tau_dct, age_dct]
-            elif len(gal_obj.par_names)==4:
-                gal_obj.pick_nD(tuple([metal_mcmc.iloc[i], tau_mcmc.iloc[i], age_mcmc.iloc[i], 0.]))
-                metal_dct,tau_dct, age_dct, ebvg_dct=gal_obj.matched_parkeys
-                SFR_mcmc =MD.GALAXY_SFRdict[metal_dct,tau_dct, age_dct]
-
-            Mstar = np.log10(N * 1) 
-            #Calculate SFR. output is in [Msun/yr]. 
-            #print tau_mcmc[i], age_mcmc[i], (N * SFR_mcmc), np.log10(N), SFR_mcmc 
-            SFR = N * SFR_mcmc
-            SFR_list.append(SFR.value)    
-            Mstar_list.append(Mstar)  
-    else:
-        for i in range (len (tau_mcmc)):        
-            N = 10**GA[i]* 4* pi* distance**2 / (solarlum.value)/ (1+z)
-            N = renorm_template('GA', N)
+    N = 10**GA* 4* pi* distance**2 / (solarlum.value)/ (1+z)
+    N = renorm_template('GA', N)
 
-            if len(gal_obj.par_names)==3:
-                gal_obj.pick_nD(tuple([tau_mcmc[i], age_mcmc[i], 0.]))
-                tau_dct, age_dct, ebvg_dct=gal_obj.matched_parkeys
-                SFR_mcmc =MD.GALAXY_SFRdict[tau_dct, age_dct]
-            elif len(gal_obj.par_names)==4:
-                gal_obj.pick_nD(tuple([metal_mcmc[i], tau_mcmc[i], age_mcmc[i], 0.]))
-                metal_dct,tau_dct, age_dct, ebvg_dct=gal_obj.matched_parkeys
-                SFR_mcmc =MD.GALAXY_SFRdict[metal_dct,tau_dct, age_dct]
+    # Calculate Mstar. BC03 templates are normalized to M* = 1 M_sun. 
+    # Thanks to Kenneth Duncan, and his python version of BC03, smpy
+    Mstar = np.log10(N * 1) 
+    #Calculate SFR. output is in [Msun/yr]. 
+    SFR = N * SFR_mcmc
 
-            # Calculate Mstar. BC03 templates are normalized to M* = 1 M_sun. 
-            # Thanks to Kenneth Duncan, and his python version of BC03, smpy
-            Mstar = np.log10(N * 1) 
-            #Calculate SFR. output is in [Msun/yr]. 
-            #print tau_mcmc[i], age_mcmc[i], (N * SFR_mcmc), np.log10(N), SFR_mcmc 
-            SFR = N * SFR_mcmc
-            SFR_list.append(SFR.value)    
-            Mstar_list.append(Mstar)    
+    return Mstar, SFR
 
-    return np.array(Mstar_list) , np.array(SFR_list)
 
+def sfr_table(SFRdict, keys):
+
+    """
+    Array of the SFRs of the galaxy templates, table[i,j(,k)] = SFRdict[keys[0][i], keys[1][j](, keys[2][k])],
+    nan for combinations of keys which are not in the dictionary.
+    """
+    table = np.full([len(k) for k in keys], np.nan)
+    for idx in itertools.product(*[range(len(k)) for k in keys]):
+        key = tuple(k[i] for k, i in zip(keys, idx))
+        if key in SFRdict:
+            table[idx] = SFRdict[key].value
+    return table
 
-def stellar_info_array(chain_flat, data, models, Nthin_compute, mc):
+
+def stellar_info_array(chain_flat, data, models, Nthin_compute):
 
     """
     computes arrays of stellar masses and SFRs
@@ -1409,24 +1409,13 @@ def stellar_info_array(chain_flat, data, models, Nthin_compute, mc):
     import random
 
     Ns, Npar = np.shape(chain_flat) 
-    if mc['sampling_algorithm'] == 'ultranest':
-        chain_thinned = chain_flat.iloc[random.sample(list(np.arange(Ns)), Nthin_compute)]
-
-    else:
-        chain_thinned = chain_flat[random.sample(list(np.arange(Ns)), Nthin_compute),:]
-
-    Mstar, SFR = stellar_info(chain_thinned, data, models, mc)
-
-    Mstar_list = []
-    SFR_list = []
+    chain_thinned = chain_flat[random.sample(range(Ns), Nthin_compute),:]
 
-    for i in range(Nthin_compute):
-        for j in range(int(Ns/Nthin_compute)): 
-            Mstar_list.append(Mstar[i])
-            SFR_list.append(SFR[i])
+    Mstar, SFR = stellar_info(chain_thinned, data, models)
 
-    Mstar1 = np.array(Mstar_list)    
-    SFR1 = np.array(SFR_list)
+    ## every sample of the thinned chain stands for int(Ns/Nthin_compute) samples of the chain
+    Mstar1 = np.repeat(Mstar, int(Ns/Nthin_compute))
+    SFR1 = np.repeat(SFR, int(Ns/Nthin_compute))
     return Mstar1, SFR1
 
 
@@ -1480,12 +1469,26 @@ class MODELS: #is this used somewhere else?
         self.settings = models_settings
         self.mc = mc_settings
 
-    def DICTS(self, filters, Modelsdict):
+    def DICTS(self, filters, Modelsdict, data=None):
         """
         Helps transporting the dictionary content
-        corresponding to the redshift of the source
+        corresponding to the redshift of the source.
+        With the data of the source, the models are also kept only in the bands
+        of the likelihood (dictkey_arrays_fit, used by parspace.ln_probab), since
+        the bands without data of a source do not change its posterior.
         """
         self.dict_modelfluxes = Modelsdict#[z_key]
         self.dictkey_arrays = dicts.dictkey_arrays(self.dict_modelfluxes)
         self.dictkey_arrays_4plot = dicts.dictkey_arrays_4plot(self.dict_modelfluxes)
+        self.fit_bands = None
+
+        if data is not None and len(data.nus) == len(Modelsdict.fo.central_nu_array):
+            valid = parspace.likelihood_bands(data.nus, data.fluxes, data.z, self)
+            ## GALAXYred_Calzetti extrapolates the reddening below 0.12 um with the bands nearest to 0.12 and 0.125 um
+            wl = (2.998 * 1e8 / 10**(Modelsdict.fo.central_nu_array + np.log10(1+Modelsdict.z)) * 1e6)[::-1]
+            anchors = [len(wl)-1 - np.abs(wl - 0.12).argmin(), len(wl)-1 - np.abs(wl - 0.125).argmin()]
+
+            self.fit_bands = np.union1d(valid, anchors)
+            self.fit_valid = np.searchsorted(self.fit_bands, valid)
+            self.dictkey_arrays_fit = dicts.dictkey_arrays(self.dict_modelfluxes, self.fit_bands)
 
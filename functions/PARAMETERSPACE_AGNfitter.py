@@ -138,16 +138,24 @@ def ln_likelihood(x, y, ysigma, z, ymodel, models):
 
     ## output:
     - (-1 * ln(likelihood))"""
+    x_valid = likelihood_bands(x, y, z, models)
+    resid = (y[x_valid] - ymodel[x_valid])/ysigma[x_valid]
+    return -0.5 * np.dot(resid, resid)
+
+
+def likelihood_bands(x, y, z, models):
+
+    """Indices of the bands used in the likelihood (ln_likelihood).
+    They only depend on the data, and MODELS.DICTS keeps the models 
+    of a source in these bands for ln_probab."""
+
     #x_valid:
     #only frequencies with existing data (no detections nor limits F = -99)        
     #Consider only data free of IGM absorption. Lyz = 15.38 restframe  
     if models.settings['XRAYS'] == 'Prior':                                  #Ignore X-rays data in the likelihood (already taken into account in prior)      
-        x_valid = np.arange(len(x))[(x< np.log10(10**(15.38)/(1+z))) & (y>-99.e-23)]
+        return np.arange(len(x))[(x< np.log10(10**(15.38)/(1+z))) & (y>-99.e-23)]
     else:                                                                    #Ignore only UV data because of IGM absorption  
-        x_valid = np.arange(len(x))[(x< np.log10(10**(15.38)/(1+z))) | (x > np.log10(10**(16.685)/(1+z))) & (y>-99.e-23)]
-
-    resid = [(y[i] - ymodel[i])/ysigma[i] for i in x_valid]
-    return -0.5 * np.dot(resid, resid)
+        return np.arange(len(x))[(x< np.log10(10**(15.38)/(1+z))) | (x > np.log10(10**(16.685)/(1+z))) & (y>-99.e-23)]
 
 
 def ln_probab(pars, data, models, P):
@@ -164,12 +172,23 @@ def ln_probab(pars, data, models, P):
     ## dependencies:
     - MCMC_AGNfitter.py"""
 
-    y_model, bands  = ymodel(data.nus, data.z, data.dlum, models, P, *pars)
+    if models.fit_bands is None:
+        y_model, bands  = ymodel(data.nus, data.z, data.dlum, models, P, *pars)
+        lnp = ln_prior(data, models, P, *pars)
+
+        if np.isfinite(lnp): 
+            posterior = lnp + ln_likelihood(data.nus, data.fluxes, data.fluxerrs, data.z, y_model, models) 
+            return posterior
+        return -np.inf
+
+    ## models only in the bands of the likelihood (MODELS.DICTS)
+    y_model, bands  = ymodel(data.nus, data.z, data.dlum, models, P, *pars, fit=True)
     lnp = ln_prior(data, models, P, *pars)
 
     if np.isfinite(lnp): 
-        posterior = lnp + ln_likelihood(data.nus, data.fluxes, data.fluxerrs, data.z, y_model, models) 
-        return posterior
+        x_valid = models.fit_bands[models.fit_valid]
+        resid = (data.fluxes[x_valid] - y_model[models.fit_valid])/data.fluxerrs[x_valid]
+        return lnp - 0.5 * np.dot(resid, resid)
     return -np.inf
 
 
@@ -177,11 +196,12 @@ def ln_probab(pars, data, models, P):
 CONSTRUCT TOTAL MODEL 
 ------------------------------------"""
 
-def ymodel(data_nus, z, dlum, models, P, *par):
+def ymodel(data_nus, z, dlum, models, P, *par, fit=False):
 
     """Constructs the total model from parameter values.
 
     ## inputs: data_nus, z, dictkey_arrays, dict_modelfluxes, *par
+    - fit: only in the bands models.fit_bands (MODELS.DICTS), for ln_probab
 
     ## output:
     - total model
@@ -197,6 +217,7 @@ def ymodel(data_nus, z, dlum, models, P, *par):
 
     par = par[0:len(par)]
     gal_obj,sb_obj,tor_obj, bbb_obj, agnrad_obj = models.dictkey_arrays
+    gal_fit,sb_fit,tor_fit, bbb_fit, agnrad_fit = models.dictkey_arrays_fit if fit else models.dictkey_arrays
 
     if models.settings['RADIO'] == True:
         if models.settings['BBB']=='R06' or models.settings['BBB']=='THB21':
@@ -205,9 +226,9 @@ def ymodel(data_nus, z, dlum, models, P, *par):
             GA, SB, TO, RAD = par[-4:]
         if (agnrad_obj.pars_modelkeys != ['-99.9']).all() :             #If there is a radio model with fitting parameters
             agnrad_obj.pick_nD(par[P['idxs'][4]:P['idxs'][5]])
-            _, agnrad_Fnu= agnrad_obj.get_fluxes(agnrad_obj.matched_parkeys)
+            _, agnrad_Fnu= agnrad_fit.get_fluxes_of(agnrad_obj)
         else:           #If the model have fix parameters, there aren't included in the exploration of parameters space and there is an unique SED template
-            all_agnrad_nus, agnrad_Fnu = agnrad_obj.get_fluxes('-99.9')
+            all_agnrad_nus, agnrad_Fnu = agnrad_fit.get_fluxes('-99.9')
     else:
         if models.settings['BBB']=='R06' or models.settings['BBB']=='THB21':
             GA, SB, TO, BB = par[-4:]
@@ -220,10 +241,10 @@ def ymodel(data_nus, z, dlum, models, P, *par):
     bbb_obj.pick_nD(par[P['idxs'][3]:P['idxs'][4]])
 
     try: 
-        bands, gal_Fnu=  gal_obj.get_fluxes(gal_obj.matched_parkeys)
-        _, sb_Fnu= sb_obj.get_fluxes(sb_obj.matched_parkeys)
-        _, bbb_Fnu = bbb_obj.get_fluxes(bbb_obj.matched_parkeys)
-        _, tor_Fnu= tor_obj.get_fluxes(tor_obj.matched_parkeys)
+        bands, gal_Fnu=  gal_fit.get_fluxes_of(gal_obj)
+        _, sb_Fnu= sb_fit.get_fluxes_of(sb_obj)
+        _, bbb_Fnu = bbb_fit.get_fluxes_of(bbb_obj)
+        _, tor_Fnu= tor_fit.get_fluxes_of(tor_obj)
 
     except ValueError:
          print ('Error: Dictionary does not contain some values')
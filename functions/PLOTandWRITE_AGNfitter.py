@@ -16,29 +16,33 @@ This script includes:
 - class CHAIN
 - class FLUXESARRAYS
 - functions SED_plotting_settings, SED_colors
+- functions interpolate_rows, resample_templates
 
 """
 #PYTHON IMPORTS
 import matplotlib.pyplot as plt
 from matplotlib import rc, ticker
 import matplotlib.ticker
-import os
+import sys,os
 import math 
 import numpy as np
 from . import corner #Author: Dan Foreman-Mackey (danfm@nyu.edu)
 import scipy
 from astropy import units as u
 import pandas as pd 
+from collections import OrderedDict
 
 
 #AGNfitter IMPORTS
 from . import MODEL_AGNfitter as model
 from . import PARAMETERSPACE_AGNfitter as parspace
+from . import SAMPLERS_AGNfitter as samplers
+from . import WARMSTART_AGNfitter as warmstart
 import pickle
 
 
 
-def main(data, models, P, out, models_settings, mc_settings):
+def main(data, models, P, out, models_settings, mc_settings, new_chains=True):
 
     """
     Main function of PLOTandWRITE_AGNfitter. Output depends of settings in RUN_AGNfitter.
@@ -47,24 +51,21 @@ def main(data, models, P, out, models_settings, mc_settings):
     - data object
     - dictionary P (parameter space settings)
     - dictionary out (output settings)
+    - new_chains: the chains were just produced, and the source is added to the warm-start library.
+      False when the output of chains saved before is written again.
     
     """
-    if mc_settings['sampling_algorithm'] == 'emcee':
-        chain_burnin = CHAIN(data.output_folder+str(data.name)+ '/samples_burn1-2-3.sav', data.output_folder+str(data.name)+ '/samples_burn1-2-3.sav', out, mc_settings)
-        chain_mcmc = CHAIN(data.output_folder+str(data.name)+ '/samples_mcmc.sav', data.output_folder+str(data.name)+ '/samples_mcmc.sav', out, mc_settings)
-        chain_mcmc.props()
-        print( '_________________________________')
-        print( 'Properties of the sampling results:')
-        print( '- Mean acceptance fraction', chain_mcmc.mean_accept)
-        print( '- Mean autocorrelation time', chain_mcmc.mean_autocorr)
-
-    elif mc_settings['sampling_algorithm'] == 'ultranest':
-        chain_mcmc = CHAIN(data.output_folder+str(data.name)+ '/ultranest/chains/weighted_post.txt', data.output_folder+str(data.name)+ '/ultranest/chains/run.txt',  out, mc_settings) #equal_weighted_post.txt
-    else:
-        print('Unknown algorithm, please select one of the available: ultranest or emcee')
+    sampler = samplers.get_sampler(mc_settings)
+    outputfilename, runfile = sampler.chain_files(data.output_folder+str(data.name))
+    chain_mcmc = CHAIN(outputfilename, runfile, out, mc_settings, P['names'])
+    chain_mcmc.props()
+    sampler.report(chain_mcmc.posterior)
 
     output = OUTPUT(chain_mcmc, data, models, P, models_settings, mc_settings)
 
+    if mc_settings.get('warm_start', False) and new_chains:
+        warmstart.add_source(data, P, chain_mcmc.flatchain, mc_settings, weights=chain_mcmc.weights)
+
     if out['plot_posteriortriangle'] :
         fig = output.plot_PDFtriangle('10pars', P['names'])
         fig.savefig(data.output_folder+str(data.name)+'/PDFtriangle_10pars.' + out['plot_format'])
@@ -125,8 +126,7 @@ class OUTPUT:
     def __init__(self, chain_obj, data_obj, model_obj, P, models_settings, mc_settings):
 
         self.chain = chain_obj
-        if mc_settings['sampling_algorithm'] == 'emcee':
-            self.chain.props()
+        self.chain.props()
    
         self.out = chain_obj.out
         self.data = data_obj
@@ -151,29 +151,24 @@ class OUTPUT:
 
     def write_parameters_outputvalues(self, P):        
 
-        Mstar, SFR_opt = model.stellar_info_array(self.chain.flatchain, self.data, self.models, self.out['realizations2int'], self.mc_settings)
+        Mstar, SFR_opt = model.stellar_info_array(self.chain.flatchain, self.data, self.models, self.out['realizations2int'])
         column_names = np.transpose(np.array(["P025","P16","P50","P84","P975"], dtype='|S3'))
         chain_pars = np.column_stack((self.chain.flatchain_sorted, Mstar, SFR_opt))              
 
         SFR_IR = model.sfr_IR(self.int_lums[0]) #check that ['intlum_names'][0] is always L_IR(8-100)               
 
         chain_others =np.column_stack((self.int_lums.T, SFR_IR))        
-        if self.mc_settings['sampling_algorithm'] == 'ultranest':
-            outputvalues = np.column_stack((np.transpose(list(map(lambda v: (v[0],v[1],v[2],v[3],v[4]), zip(*np.percentile(chain_pars, [2.5,16, 50, 84,97.5], axis=0))))), np.transpose(list(map(lambda v: (v[0],v[1],v[2],v[3],v[4]), zip(*np.percentile(chain_others, [2.5,16, 50, 84,97.5], axis=0))))),
-                                        np.transpose(np.percentile(self.chain.lnprob_flat, [2.5,16, 50, 84,97.5], axis=0)),
-                                        np.transpose(np.percentile(self.chain.logz_flat, [2.5,16, 50, 84,97.5], axis=0)) )) 
-            outputvalues_header= ' '.join([ i for i in np.hstack((P['names'], 'logMstar', 'SFR_opt', self.out['intlum_names'], 'SFR_IR', 'log_like', 'logz'))] ) 
-
-        elif self.mc_settings['sampling_algorithm'] == 'emcee':
-            outputvalues = np.column_stack((np.transpose(list(map(lambda v: (v[0],v[1],v[2],v[3],v[4]), zip(*np.percentile(chain_pars, [2.5,16, 50, 84,97.5], axis=0))))), np.transpose(list(map(lambda v: (v[0],v[1],v[2],v[3],v[4]), zip(*np.percentile(chain_others, [2.5,16, 50, 84,97.5], axis=0))))),
-                                        np.transpose(np.percentile(self.chain.lnprob_flat, [2.5,16, 50, 84,97.5], axis=0)) ))  
-
-            outputvalues_header= ' '.join([ i for i in np.hstack((P['names'], 'logMstar', 'SFR_opt', self.out['intlum_names'], 'SFR_IR', '-ln_like'))] )
+        outputvalues = np.column_stack((np.transpose(list(map(lambda v: (v[0],v[1],v[2],v[3],v[4]), zip(*np.percentile(chain_pars, [2.5,16, 50, 84,97.5], axis=0))))), np.transpose(list(map(lambda v: (v[0],v[1],v[2],v[3],v[4]), zip(*np.percentile(chain_others, [2.5,16, 50, 84,97.5], axis=0))))),
+                                        np.transpose(np.percentile(self.chain.lnprob_flat, [2.5,16, 50, 84,97.5], axis=0)) )) 
+        outputvalues_header= ' '.join([ i for i in np.hstack((P['names'], 'logMstar', 'SFR_opt', self.out['intlum_names'], 'SFR_IR', self.chain.lnprob_label))] ) 
+        if self.chain.logz_flat is not None:
+            outputvalues = np.column_stack((outputvalues, np.transpose(np.percentile(self.chain.logz_flat, [2.5,16, 50, 84,97.5], axis=0))))
+            outputvalues_header += ' logz'
 
         return outputvalues, outputvalues_header
 
     def save_posteriors(self, P):   
-        Mstar, SFR_opt = model.stellar_info_array(self.chain.flatchain, self.data, self.models, self.out['realizations2int'], self.mc_settings)
+        Mstar, SFR_opt = model.stellar_info_array(self.chain.flatchain, self.data, self.models, self.out['realizations2int'])
         column_names = np.transpose(np.array(["P025","P16","P50","P84","P975"], dtype='|S3'))
         chain_pars = np.column_stack((self.chain.flatchain, Mstar, SFR_opt))      
         
@@ -182,25 +177,14 @@ class OUTPUT:
             SFR_IR = model.sfr_IR(self.int_lums[0]) #check that ['intlum_names'][0] is always L_IR(8-100)        
 
             chain_others =np.column_stack((self.int_lums.T, SFR_IR))
-            if self.mc_settings['sampling_algorithm'] == 'ultranest':
-                outputvalues = np.column_stack((np.transpose(list(map(lambda v: (v[0],v[1],v[2],v[3],v[4]), zip(*np.percentile(chain_pars, [2.5,16, 50, 84,97.5], axis=0))))), np.transpose(list(map(lambda v: (v[0],v[1],v[2],v[3],v[4]), zip(*np.percentile(chain_others, [2.5,16, 50, 84,97.5], axis=0))))), np.transpose(np.percentile(self.chain.lnprob_flat, [2.5,16, 50, 84,97.5], axis=0)), 
-                                            np.transpose(np.percentile(self.chain.logz_flat, [2.5,16, 50, 84,97.5], axis=0)) ))  
-   
-                outputvalues_header= ' '.join([ i for i in np.hstack((P['names'], 'logMstar', 'SFR_opt', self.out['intlum_names'], 'SFR_IR', 'log_like', 'logz'))] )
-            elif self.mc_settings['sampling_algorithm'] == 'emcee':
-                outputvalues = np.column_stack((np.transpose(list(map(lambda v: (v[0],v[1],v[2],v[3],v[4]), zip(*np.percentile(chain_pars, [2.5,16, 50, 84,97.5], axis=0))))), np.transpose(list(map(lambda v: (v[0],v[1],v[2],v[3],v[4]), zip(*np.percentile(chain_others, [2.5,16, 50, 84,97.5], axis=0))))), np.transpose(np.percentile(self.chain.lnprob_flat, [2.5,16, 50, 84,97.5], axis=0)) ))  
-   
-                outputvalues_header= ' '.join([ i for i in np.hstack((P['names'], 'logMstar', 'SFR_opt', self.out['intlum_names'], 'SFR_IR', '-ln_like'))] )
 
             if self.out['save_posteriors']:  
                 nsample, npar = self.chain.flatchain.shape
-                if self.mc_settings['sampling_algorithm'] == 'ultranest':
-                    posteriors = np.column_stack((chain_pars[np.random.choice(nsample, (self.out['realizations2int']))], chain_others, self.chain.lnprob_flat.iloc[np.random.choice(nsample, (self.out['realizations2int']))],
-self.chain.logz_flat.iloc[np.random.choice(nsample, (self.out['realizations2int']))])) 
-                    posteriors_header= ' '.join([ i for i in np.hstack((P['names'], 'logMstar', 'SFR_opt', self.out['intlum_names'], 'SFR_IR', 'log_like', 'logz'))] )
-                elif self.mc_settings['sampling_algorithm'] == 'emcee':
-                    posteriors = np.column_stack((chain_pars[np.random.choice(nsample, (self.out['realizations2int'])),:], chain_others, self.chain.lnprob_flat[np.random.choice(nsample, (self.out['realizations2int']))] )) 
-                    posteriors_header= ' '.join([ i for i in np.hstack((P['names'], 'logMstar', 'SFR_opt', self.out['intlum_names'], 'SFR_IR', '-ln_like'))] )
+                posteriors = np.column_stack((chain_pars[np.random.choice(nsample, (self.out['realizations2int'])),:], chain_others, self.chain.lnprob_flat[np.random.choice(nsample, (self.out['realizations2int']))] )) 
+                posteriors_header= ' '.join([ i for i in np.hstack((P['names'], 'logMstar', 'SFR_opt', self.out['intlum_names'], 'SFR_IR', self.chain.lnprob_label))] )
+                if self.chain.logz_flat is not None:
+                    posteriors = np.column_stack((posteriors, self.chain.logz_flat[np.random.choice(nsample, (self.out['realizations2int']))]))
+                    posteriors_header += ' logz'
                 
                 return posteriors,posteriors_header
         else:
@@ -405,10 +389,7 @@ self.chain.logz_flat.iloc[np.random.choice(nsample, (self.out['realizations2int'
 
         ax1.text(0.04, 0.8, r'id='+str(self.data.name)+r', z ='+ str(self.z), ha='left', transform=ax1.transAxes, fontsize = 19 )
         if plot_residuals:
-            if self.mc_settings['sampling_algorithm'] == 'ultranest':
-                ax1.text(0.96, 0.8, 'max log-likelihood = {ml:.1f}'.format(ml=np.max(self.chain.lnprob_flat)), ha='right', transform=ax1.transAxes, fontsize = 19 )
-            elif self.mc_settings['sampling_algorithm'] == 'emcee':
-                ax1.text(0.96, 0.8, 'max ln-likelihood = {ml:.1f}'.format(ml=np.max(self.chain.lnprob_flat)), ha='right', transform=ax1.transAxes, fontsize = 19 )
+            ax1.text(0.96, 0.8, 'max log-likelihood = {ml:.1f}'.format(ml=np.max(self.chain.lnprob_flat)), ha='right', transform=ax1.transAxes, fontsize = 19 )
         print(' => SEDs of '+ str(Nrealizations)+' different realization were plotted.')
 
         return fig, save_SEDs, save_residuals
@@ -425,75 +406,46 @@ class CHAIN:
     ##input: 
     - name of file, where chain was saved
     - dictionary of ouput setting: out
+    - names of the fitted parameters (P['names'])
 
     ##bugs: 
 
     """     
 
-    def __init__(self, outputfilename, runfile, out, mc_settings):
+    def __init__(self, outputfilename, runfile, out, mc_settings, names):
             self.outputfilename = outputfilename
             self.runfile = runfile
             self.out = out
             self.mc_settings = mc_settings
+            self.names = names
+            self.posterior = None
 
     def props(self):
-        if os.path.lexists(self.outputfilename):
-            f = open(self.outputfilename, 'rb')
-
-            if self.mc_settings['sampling_algorithm'] == 'ultranest':
-                samples = pd.read_csv(f, sep = ' ')
-                f.close()
-                f2 = open(self.runfile, 'rb')
-                runfile = pd.read_csv(f2, sep = ' ')
-                f2.close()
-
-                cumsum = np.cumsum(np.array(samples['weight']))
-                mask = cumsum > 1e-4
-                size_mask = int(np.sum(mask) - (np.sum(mask) % 100))     
-
-                self.lnprob = samples.iloc[-size_mask:]
-                self.chain = samples.iloc[-size_mask:, 2:]
-                self.logz = runfile.iloc[-size_mask:]
-
-                self.lnprob_flat = self.lnprob['logl'] 
-                self.logz_flat = self.logz['logz']
-
-                #sort parameter vector for likelihood
-                idx_sorted = np.argsort(np.array(-self.lnprob_flat), axis=0)
-                lnprob_sorted = self.lnprob.sort_values(by = ['logl'], ascending=False)['logl']
-                self.lnprob_max = lnprob_sorted.iloc[0]
-                self.flatchain = self.chain
-                chain_length = int(len(self.flatchain))
-
-                self.flatchain_sorted = self.flatchain.iloc[idx_sorted]
-                self.best_fit_pars = self.flatchain.iloc[idx_sorted[0]].values
+        """ Reads the chains once into the POSTERIOR of the backend (SAMPLERS_AGNfitter.py), the same for all backends."""
+        if self.posterior is None and os.path.lexists(self.outputfilename):
+            self.posterior = samplers.get_sampler(self.mc_settings).read((self.outputfilename, self.runfile), self.out, self.names)
 
-            elif self.mc_settings['sampling_algorithm'] == 'emcee':
-                samples = pd.read_pickle(f)
-                f.close()
-                self.chain = samples['chain']
-                nwalkers, nsamples, npar = samples['chain'].shape
+        elif self.posterior is None:
 
-                Ns, Nt = self.out['Nsample'], self.out['Nthinning'] 
-                self.lnprob = samples['lnprob']
-                self.lnprob_flat = samples['lnprob'][:,int(nsamples/2):int(nsamples):Nt].ravel() #[:,0:Ns*Nt:Nt]
-
-                isort = (- self.lnprob_flat).argsort() #sort parameter vector for likelihood
-                lnprob_sorted = np.reshape(self.lnprob_flat[isort],(-1,1))
-                self.lnprob_max = lnprob_sorted[0]
-
-                self.flatchain = samples['chain'][:,int(nsamples/2):int(nsamples):Nt,:].reshape(-1, npar) #[:,0:Ns*Nt:Nt,:]
-                chain_length = int(len(self.flatchain))
-
-                self.flatchain_sorted = self.flatchain[isort]
-                self.best_fit_pars = self.flatchain[isort[0]]
+            'Error: The sampling has not been perfomed yet, or the chains were not saved properly.'
+            return
 
-                self.mean_accept =  samples['accept'].mean()
-                self.mean_autocorr = samples['acor'].mean()
+        posterior = self.posterior
+        self.flatchain = posterior.samples
+        self.weights = posterior.weights
+        self.lnprob_flat = posterior.lnprob
+        self.logz_flat = posterior.logz
+        self.lnprob_label = posterior.lnprob_label
 
-        else:
+        isort = (- self.lnprob_flat).argsort() #sort parameter vector for likelihood
+        self.lnprob_max = self.lnprob_flat[isort[0]]
+        self.flatchain_sorted = self.flatchain[isort]
+        self.best_fit_pars = self.flatchain[isort[0]]
 
-            'Error: The sampling has not been perfomed yet, or the chains were not saved properly.'
+        ## walkers x steps of emcee, for plot_trace
+        if 'chain' in posterior.info:
+            self.chain = posterior.info['chain']
+            self.lnprob = posterior.info['lnprob']
 
     def plot_trace(self, P, nwplot=50):
 
@@ -539,6 +491,43 @@ class CHAIN:
 """=========================================================="""
 
 
+## Luminosities of out['intlum_models']: name: (components summed, components of the total for AGN fractions, or None)
+INTLUM_MODELS = OrderedDict([
+    ('sb', (['sb'], None)),
+    ('bbb', (['bbb'], None)),
+    ('Lx0.5-2keV', (['bbb'], None)),
+    ('Lx2-8keV', (['bbb'], None)),
+    ('bbbdered', (['bbbdered'], None)),
+    ('gal', (['gal'], None)),
+    ('tor', (['tor'], None)),
+    ('agn_rad', (['agn_rad'], None)),
+    ('tor+bbb', (['tor', 'bbb'], None)),
+    ('gal+bbb', (['gal', 'bbb'], None)),
+    ('AGNfrac_IR', (['tor'], ['tor', 'sb'])),
+    ('AGNfracTO', (['tor'], ['tor', 'sb', 'gal'])),
+    ('AGNfracGA', (['gal'], ['tor', 'sb', 'gal'])),
+    ('AGNfracSB', (['sb'], ['tor', 'sb', 'gal'])),
+    ('AGNfrac_opt', (['bbb'], ['gal', 'bbb'])),
+    ('AGNfrac_rad', (['agn_rad'], ['tor', 'sb', 'agn_rad'])),
+    ('AGNfrac', (['agn_rad'], ['tor', 'sb', 'agn_rad'])),
+    ('AGNfrac1-10GHz', (['agn_rad'], ['sb', 'agn_rad'])),
+    ('AGNfrac10-30GHz', (['agn_rad'], ['sb', 'agn_rad'])),
+    ('AGNfrac50-200GHz', (['agn_rad'], ['sb', 'agn_rad'])),
+    ('AGNfrac400-1600GHz', (['agn_rad', 'tor'], ['sb', 'agn_rad', 'tor'])),
+    ('AGNfrac187-75mu', (['agn_rad', 'tor'], ['sb', 'agn_rad', 'tor', 'gal'])),
+    ('AGNfrac75-20mu', (['tor'], ['sb', 'tor', 'gal', 'bbb'])),
+    ('AGNfrac20-8mu', (['tor'], ['sb', 'tor', 'gal', 'bbb'])),
+    ('AGNfrac8-4mu', (['tor'], ['sb', 'tor', 'gal', 'bbb'])),
+    ('AGNfrac4-2mu', (['tor', 'bbb'], ['sb', 'tor', 'gal', 'bbb'])),
+    ('AGNfrac2-1mu', (['tor', 'bbb'], ['sb', 'tor', 'gal', 'bbb'])),
+    ('AGNfrac1-0.5mu', (['tor', 'bbb'], ['sb', 'tor', 'gal', 'bbb'])),
+    ('AGNfrac0.5-0.3mu', (['bbb'], ['tor', 'gal', 'bbb'])),
+    ('AGNfrac0.3-0.06mu', (['bbb'], ['tor', 'gal', 'bbb']))])
+
+## Luminosities defined differently for monochromatic ranges
+INTLUM_MODELS_MONOCHROMATIC = dict(AGNfrac = (['tor'], ['tor', 'sb', 'gal']))
+
+
 class FLUXES_ARRAYS:
 
     """
@@ -570,15 +559,6 @@ class FLUXES_ARRAYS:
         """
         self.chain_obj.props()
 
-        SBFnu_list = []
-        BBFnu_list = []
-        GAFnu_list= []
-        TOFnu_list = []
-        TOTALFnu_list = []
-        BBFnu_deredd_list = []
-        if self.output_type == 'plot':
-            filtered_modelpoints_list = []
-
         gal_obj,sb_obj,tor_obj, bbb_obj, agnrad_obj = models.dictkey_arrays_4plot
 
         # Take the  4 dictionaries for plotting. Dicts are described in DICTIONARIES_AGNfitter.py
@@ -587,31 +567,22 @@ class FLUXES_ARRAYS:
         source = data.name
 
         if self.output_type == 'plot':
-            if self.mc['sampling_algorithm'] == 'ultranest':
-                par = self.chain_obj.flatchain.iloc[np.random.choice(nsample, (self.out['realizations2plot'])),:].copy()#.T 
-                par_best = self.chain_obj.best_fit_pars
-                par.loc[-1]=par_best
-            elif self.mc['sampling_algorithm'] == 'emcee':
-                par = self.chain_obj.flatchain[np.random.choice(nsample, (self.out['realizations2plot'])),:]#.T   
-                #par = self.chain_obj.flatchain[np.random.choice(np.arange(nsample-1000, nsample), (20*self.out['realizations2plot'])),:]#.T 200/1000 works    
-                par_best = self.chain_obj.best_fit_pars
-                par[-1]=par_best
+            par = self.chain_obj.flatchain[np.random.choice(nsample, (self.out['realizations2plot'])),:]#.T   
+            #par = self.chain_obj.flatchain[np.random.choice(np.arange(nsample-1000, nsample), (20*self.out['realizations2plot'])),:]#.T 200/1000 works    
+            par_best = self.chain_obj.best_fit_pars
+            par[-1]=par_best
   
             realization_nr=self.out['realizations2plot']
         
         elif self.output_type == 'int_lums':
-            if self.mc['sampling_algorithm'] == 'ultranest':
-                par = self.chain_obj.flatchain.iloc[np.random.choice(nsample, (self.out['realizations2int'])),:].copy()#.T
-                par_best = self.chain_obj.best_fit_pars
-                par.loc[-1] = par_best
-            elif self.mc['sampling_algorithm'] == 'emcee':
-                par = self.chain_obj.flatchain[np.random.choice(nsample, (self.out['realizations2int'])),:]#.T
-                par_best = self.chain_obj.best_fit_pars
-                par[-1]=par_best
+            par = self.chain_obj.flatchain[np.random.choice(nsample, (self.out['realizations2int'])),:]#.T
+            par_best = self.chain_obj.best_fit_pars
+            par[-1]=par_best
             realization_nr=self.out['realizations2int']
         
         elif self.output_type == 'best_fit':
             par = self.chain_obj.best_fit_pars
+            realization_nr=1
 
         if self.models_settings['BBB'] =='D12_S' or self.models_settings['BBB'] =='D12_K' or self.models_settings['XRAYS'] != False:
             ### extend SED to X-rays if there are models with Xrays or Xray priors were applied
@@ -621,169 +592,144 @@ class FLUXES_ARRAYS:
 
         if self.models_settings['RADIO']==True:
             ## extend SED to radio
-            RADFnu_list = []
             lognu_min = 9
         else:
             lognu_min = 10.5
 
         self.all_nus_rest = np.arange(lognu_min, lognu_max, 0.001) 
 
-        for g in range(realization_nr):
-            ## Pick dictionary key-values, nearest to the MCMC- parameter values
-            if self.mc['sampling_algorithm'] == 'ultranest':
-                gal_obj.pick_nD(par.iloc[g][self.P['idxs'][0]:self.P['idxs'][1]]) 
-                sb_obj.pick_nD(par.iloc[g][self.P['idxs'][1]:self.P['idxs'][2]])
-                tor_obj.pick_nD(par.iloc[g][self.P['idxs'][2]:self.P['idxs'][3]]) 
-                bbb_obj.pick_nD(par.iloc[g][self.P['idxs'][3]:self.P['idxs'][4]])
-
-                if models.settings['BBB']=='R06' or models.settings['BBB']=='THB21': 
-                    if models.settings['RADIO'] == True:
-                        GA, SB, TO, BB, RAD = par.iloc[g][-5:]
-                    else:
-                        GA, SB, TO, BB = par.iloc[g][-4:]   
-                else:
-                    if models.settings['RADIO'] == True:
-                        GA, SB, TO, RAD = par.iloc[g][-4:]
-                    elif models.settings['RADIO'] == False:
-                        GA, SB, TO = par.iloc[g][-3:]
-                    BB = 0.
-  
-            elif self.mc['sampling_algorithm'] == 'emcee':
-                gal_obj.pick_nD(par[g][self.P['idxs'][0]:self.P['idxs'][1]]) 
-                sb_obj.pick_nD(par[g][self.P['idxs'][1]:self.P['idxs'][2]])  
-                tor_obj.pick_nD(par[g][self.P['idxs'][2]:self.P['idxs'][3]])
-                bbb_obj.pick_nD(par[g][self.P['idxs'][3]:self.P['idxs'][4]])
-
-                if models.settings['BBB']=='R06' or models.settings['BBB']=='THB21': 
-                    if models.settings['RADIO'] == True:
-                        GA, SB, TO, BB, RAD = par[g][-5:]
-                    else:
-                        GA, SB, TO, BB = par[g][-4:]   
-                else:
-                    if models.settings['RADIO'] == True:
-                        GA, SB, TO, RAD = par[g][-4:]
-                    elif models.settings['RADIO'] == False:
-                        GA, SB, TO = par[g][-3:]
-                    BB = 0.
+        par = np.atleast_2d(par)
 
-            all_gal_nus, gal_Fnus = gal_obj.get_fluxes(gal_obj.matched_parkeys)
-            all_sb_nus, sb_Fnus= sb_obj.get_fluxes(sb_obj.matched_parkeys) 
-            all_tor_nus, tor_Fnus= tor_obj.get_fluxes(tor_obj.matched_parkeys)
-            all_bbb_nus, bbb_Fnus = bbb_obj.get_fluxes(bbb_obj.matched_parkeys)
+        ## Pick dictionary key-values, nearest to the MCMC- parameter values, and the templates of every realization.
+        ## The templates are resampled onto all_nus_rest all at once (resample_templates), each distinct template only once.
+        templates = dict((c, []) for c in ['GA', 'SB', 'TO', 'BB', 'BBdered', 'RAD'])
+        norms = dict((c, []) for c in ['GA', 'SB', 'TO', 'BB', 'RAD'])
+        filtered_modelpoints_list = []
+        cache = dict()
 
-            #Produce model fluxes at all_nus_rest for plotting, through interpolation
+        def get_fluxes(c, obj, matched_parkeys):
+            ## templates of the same parameters (grid keys and values of free parameters) are computed once
+            key = (c, matched_parkeys)
+            if key not in cache:
+                cache[key] = obj.get_fluxes(matched_parkeys)
+            return key, cache[key]
 
-            GAinterp = scipy.interpolate.interp1d(all_gal_nus, np.log10(gal_Fnus.flatten()),  kind = 'linear', bounds_error=False, fill_value=-100.)
-            all_gal_Fnus = 10**GAinterp(self.all_nus_rest)
+        for g in range(realization_nr):
+            gal_obj.pick_nD(par[g][self.P['idxs'][0]:self.P['idxs'][1]]) 
+            sb_obj.pick_nD(par[g][self.P['idxs'][1]:self.P['idxs'][2]])  
+            tor_obj.pick_nD(par[g][self.P['idxs'][2]:self.P['idxs'][3]])
+            bbb_obj.pick_nD(par[g][self.P['idxs'][3]:self.P['idxs'][4]])
+
+            if models.settings['BBB']=='R06' or models.settings['BBB']=='THB21': 
+                if models.settings['RADIO'] == True:
+                    GA, SB, TO, BB, RAD = par[g][-5:]
+                else:
+                    GA, SB, TO, BB = par[g][-4:]   
+            else:
+                if models.settings['RADIO'] == True:
+                    GA, SB, TO, RAD = par[g][-4:]
+                elif models.settings['RADIO'] == False:
+                    GA, SB, TO = par[g][-3:]
+                BB = 0.
 
-            if models.settings['RADIO'] == True:
+            templates['GA'].append(get_fluxes('GA', gal_obj, gal_obj.matched_parkeys))
+            templates['SB'].append(get_fluxes('SB', sb_obj, sb_obj.matched_parkeys))
+            templates['TO'].append(get_fluxes('TO', tor_obj, tor_obj.matched_parkeys))
+            templates['BB'].append(get_fluxes('BB', bbb_obj, bbb_obj.matched_parkeys))
 
+            if models.settings['RADIO'] == True:
                 if (agnrad_obj.pars_modelkeys != ['-99.9']).all() :    #If there is a radio model with fitting parameters
-                    if self.mc['sampling_algorithm'] == 'ultranest':
-                        agnrad_obj.pick_nD(par.iloc[g][self.P['idxs'][4]:self.P['idxs'][5]])
-                    elif self.mc['sampling_algorithm'] == 'emcee':
-                        agnrad_obj.pick_nD(par[g][self.P['idxs'][4]:self.P['idxs'][5]])
-                    all_agnrad_nus, agnrad_Fnus = agnrad_obj.get_fluxes(agnrad_obj.matched_parkeys)
+                    agnrad_obj.pick_nD(par[g][self.P['idxs'][4]:self.P['idxs'][5]])
+                    templates['RAD'].append(get_fluxes('RAD', agnrad_obj, agnrad_obj.matched_parkeys))
                 else:                                                                #If there is a radio model with fix parameters
-                    all_agnrad_nus, agnrad_Fnus = agnrad_obj.get_fluxes('-99.9')
-
-                RADinterp = scipy.interpolate.interp1d(all_agnrad_nus, np.log10(agnrad_Fnus), bounds_error=False, fill_value=-100)
-                all_agnrad_Fnus = 10**RADinterp(self.all_nus_rest)
-                all_agnrad_Fnus[self.all_nus_rest>=17.5]= 0
-                RADFnu =   all_agnrad_Fnus * 10**float(RAD)
-                RADFnu_list.append(RADFnu)
-
-            SBinterp = scipy.interpolate.interp1d(all_sb_nus, np.log10(sb_Fnus.flatten()), bounds_error=False, fill_value=-100)
-            all_sb_Fnus = 10**SBinterp(self.all_nus_rest)
-
-            #If the UV-Xray correlation was applied, interpolate in a separately the emission of accretion disk and Xrays
-            if models.settings['BBB'] !='KD18' and models.settings['XRAYS']==True:
-                BBinterp1 = scipy.interpolate.interp1d(all_bbb_nus[all_bbb_nus < 16.685], np.log10(bbb_Fnus.flatten()[all_bbb_nus < 16.685]), bounds_error=False, fill_value=-100) ##
-                BBinterp2 = scipy.interpolate.interp1d(all_bbb_nus[all_bbb_nus >= 16.685], np.log10(bbb_Fnus.flatten()[all_bbb_nus >= 16.685]),  bounds_error=False, fill_value=-100) 
-                all_bbb_Fnus = np.concatenate((10**BBinterp1(self.all_nus_rest[ self.all_nus_rest < 16.685]), 10**BBinterp2(self.all_nus_rest[ self.all_nus_rest >= 16.685])))
-            else:
-                BBinterp = scipy.interpolate.interp1d(all_bbb_nus, np.log10(bbb_Fnus.flatten()), bounds_error=False, fill_value=-100)
-                all_bbb_Fnus = 10**BBinterp(self.all_nus_rest)
+                    templates['RAD'].append(get_fluxes('RAD', agnrad_obj, '-99.9'))
+                norms['RAD'].append(10**float(RAD))
 
             ### Plot dereddened
             if (models.settings['BBB']=='R06' or models.settings['BBB']=='THB21') and models.settings['XRAYS'] != True: 
-                all_bbb_nus, bbb_Fnus_deredd = MD.BBBFdict_4plot['0.0']
-                BBderedinterp = scipy.interpolate.interp1d(all_bbb_nus, np.log10(bbb_Fnus_deredd.flatten()), bounds_error=False, fill_value=-100)
-                all_bbb_Fnus_deredd = 10**BBderedinterp(self.all_nus_rest)
-
+                templates['BBdered'].append((('BBdered', '0.0'), MD.BBBFdict_4plot['0.0']))
             elif models.settings['BBB']=='SN12' and models.settings['XRAYS'] != True: 
-                all_bbb_nus, bbb_Fnus_deredd = MD.BBBFdict[tuple(np.append(bbb_obj.matched_parkeys[:-1], 0.0))] 
-                BBderedinterp = scipy.interpolate.interp1d(all_bbb_nus, np.log10(bbb_Fnus_deredd.flatten()), bounds_error=False, fill_value=-100)
-                all_bbb_Fnus_deredd = 10**BBderedinterp(self.all_nus_rest)
-
+                key = tuple(np.append(bbb_obj.matched_parkeys[:-1], 0.0))
+                templates['BBdered'].append((('BBdered', key), MD.BBBFdict[key]))
             elif models.settings['XRAYS'] == True: 
                 EBVbbb_pos = bbb_obj.par_names.index('EBVbbb')
                 params = bbb_obj.matched_parkeys_grid
                 params[EBVbbb_pos] = str(0.0)
-                all_bbb_nus, bbb_Fnus_deredd = MD.BBBFdict_4plot[tuple(params)]                    #Intrinsic fluxes without reddening
-                BBinterp1 = scipy.interpolate.interp1d(all_bbb_nus[all_bbb_nus < 16.685], np.log10(bbb_Fnus_deredd.flatten()[all_bbb_nus < 16.685]), bounds_error=False, fill_value=-100) ##
-                BBinterp2 = scipy.interpolate.interp1d(all_bbb_nus[all_bbb_nus >= 16.685], np.log10(bbb_Fnus_deredd.flatten()[all_bbb_nus >= 16.685]),  bounds_error=False, fill_value=-100) 
-                all_bbb_Fnus_deredd = np.concatenate((10**BBinterp1(self.all_nus_rest[ self.all_nus_rest < 16.685]), 10**BBinterp2(self.all_nus_rest[ self.all_nus_rest >= 16.685])))
+                templates['BBdered'].append((('BBdered', tuple(params)), MD.BBBFdict_4plot[tuple(params)]))          #Intrinsic fluxes without reddening
             else:
-                all_bbb_Fnus_deredd = all_bbb_Fnus
-
-            TOinterp = scipy.interpolate.interp1d(all_tor_nus, np.log10(tor_Fnus.flatten()),  kind = 'linear', bounds_error=False, fill_value=-100) #quadratic
-            all_tor_Fnus = 10**TOinterp(self.all_nus_rest)   
-            all_tor_Fnus[self.all_nus_rest>16]= 0
-            all_tor_Fnus[self.all_nus_rest<11.7]= 0
+                templates['BBdered'].append(templates['BB'][-1])
 
             if self.output_type == 'plot':
-                if self.mc['sampling_algorithm'] == 'ultranest':
-                    par2= par.iloc[g]
-                elif self.mc['sampling_algorithm'] == 'emcee':
-                    par2= par[g]
-                filtered_modelpoints, _ = parspace.ymodel(data.nus,data.z, data.dlum, models, self.P, *par2)
+                filtered_modelpoints, _ = parspace.ymodel(data.nus,data.z, data.dlum, models, self.P, *par[g])
+                filtered_modelpoints_list.append(filtered_modelpoints)
+
             #Using the costumized normalization 
-            SBFnu =   all_sb_Fnus *10**float(SB) 
-            if (models.settings['BBB']=='R06' or models.settings['BBB']=='THB21'): 
-                BBFnu = all_bbb_Fnus * 10**float(BB) 
-                BBFnu_deredd = all_bbb_Fnus_deredd * 10**float(BB)
-            else:
-                BBFnu = (all_bbb_Fnus /(4*math.pi*data.dlum**2)) * 10**float(BB) 
-                BBFnu_deredd = (all_bbb_Fnus_deredd /(4*math.pi*data.dlum**2)) * 10**float(BB) 
+            norms['GA'].append(10**float(GA))
+            norms['SB'].append(10**float(SB))
+            norms['TO'].append(10**float(TO))
+            norms['BB'].append(10**float(BB))
+
+        #Produce model fluxes at all_nus_rest for plotting, through interpolation
+        ## self.templates[component] = (fluxes of the distinct templates, template of every realization, normalizations)
+        self.templates = dict()
+        logFnu, index = resample_templates(self.all_nus_rest, templates['GA'])
+        self.templates['gal'] = (10**logFnu, index, np.array(norms['GA']))
+        logFnu, index = resample_templates(self.all_nus_rest, templates['SB'])
+        self.templates['sb'] = (10**logFnu, index, np.array(norms['SB']))
+
+        logFnu, index = resample_templates(self.all_nus_rest, templates['TO'])
+        all_tor_Fnus = 10**logFnu
+        all_tor_Fnus[:, self.all_nus_rest>16]= 0
+        all_tor_Fnus[:, self.all_nus_rest<11.7]= 0
+        self.templates['tor'] = (all_tor_Fnus, index, np.array(norms['TO']))
+
+        #If the UV-Xray correlation was applied, interpolate in a separately the emission of accretion disk and Xrays
+        if models.settings['BBB'] !='KD18' and models.settings['XRAYS']==True:
+            logFnu, index = resample_templates(self.all_nus_rest, templates['BB'], split=16.685)
+        else:
+            logFnu, index = resample_templates(self.all_nus_rest, templates['BB'])
+        all_bbb_Fnus = 10**logFnu
+        if not (models.settings['BBB']=='R06' or models.settings['BBB']=='THB21'): 
+            all_bbb_Fnus = all_bbb_Fnus /(4*math.pi*data.dlum**2)
+        self.templates['bbb'] = (all_bbb_Fnus, index, np.array(norms['BB']))
+
+        if models.settings['XRAYS'] == True or (models.settings['BBB']=='R06' or models.settings['BBB']=='THB21') or models.settings['BBB']=='SN12':
+            logFnu, index = resample_templates(self.all_nus_rest, templates['BBdered'], split=16.685 if models.settings['XRAYS'] == True else None)
+            all_bbb_Fnus_deredd = 10**logFnu
+            if not (models.settings['BBB']=='R06' or models.settings['BBB']=='THB21'): 
+                all_bbb_Fnus_deredd = all_bbb_Fnus_deredd /(4*math.pi*data.dlum**2)
+            self.templates['bbbdered'] = (all_bbb_Fnus_deredd, index, np.array(norms['BB']))
+        else:
+            self.templates['bbbdered'] = self.templates['bbb']
 
+        if models.settings['RADIO'] == True:
+            logFnu, index = resample_templates(self.all_nus_rest, templates['RAD'])
+            all_agnrad_Fnus = 10**logFnu
+            all_agnrad_Fnus[:, self.all_nus_rest>=17.5]= 0
+            self.templates['agn_rad'] = (all_agnrad_Fnus, index, np.array(norms['RAD']))
 
-            GAFnu =   all_gal_Fnus * 10**float(GA) 
-            TOFnu =   all_tor_Fnus * 10**float(TO)
+        SBFnu_array = self.component_fluxes('sb')
+        BBFnu_array = self.component_fluxes('bbb')
+        BBFnu_array_deredd = self.component_fluxes('bbbdered')
+        GAFnu_array = self.component_fluxes('gal')
+        TOFnu_array = self.component_fluxes('tor')
 
-            TOTALFnu =  SBFnu + BBFnu + GAFnu + TOFnu
+        TOTALFnu_array =  SBFnu_array + BBFnu_array + GAFnu_array + TOFnu_array
 
-            if models.settings['RADIO'] == True:
-                TOTALFnu +=  RADFnu
-            
-            #Append to the list for all realizations
-            SBFnu_list.append(SBFnu)
-            BBFnu_list.append(BBFnu)
-            GAFnu_list.append(GAFnu)
-            TOFnu_list.append(TOFnu)
-            TOTALFnu_list.append(TOTALFnu)
-            BBFnu_deredd_list.append(BBFnu_deredd)
-            #Only if SED plotting: do the same with the  modelled flux values at each data point 
-            if self.output_type == 'plot':
-                filtered_modelpoints_list.append(filtered_modelpoints)
-              
-        #Convert lists into Numpy arrays
-        SBFnu_array = np.array(SBFnu_list)
-        BBFnu_array = np.array(BBFnu_list)
-        GAFnu_array = np.array(GAFnu_list)
-        TOFnu_array = np.array(TOFnu_list)
-        TOTALFnu_array = np.array(TOTALFnu_list)
-        BBFnu_array_deredd = np.array(BBFnu_deredd_list)   
+        if models.settings['RADIO'] == True:
+            RADFnu_array = self.component_fluxes('agn_rad')
+            TOTALFnu_array +=  RADFnu_array
 
         #Put them all together to transport
         if models.settings['RADIO'] == True:
-            RADFnu_array = np.array(RADFnu_list)
             FLUXES4plotting = (SBFnu_array, BBFnu_array, GAFnu_array, TOFnu_array, RADFnu_array, TOTALFnu_array,BBFnu_array_deredd)
         elif models.settings['RADIO'] == False:
             FLUXES4plotting = (SBFnu_array, BBFnu_array, GAFnu_array, TOFnu_array, TOTALFnu_array,BBFnu_array_deredd)
 
         #Convert Fluxes to nuLnu
         self.nuLnus4plotting = self.FLUXES2nuLnu_4plotting(self.all_nus_rest, FLUXES4plotting, data.z)
+        self.nuLnu_factor = (4. * math.pi * model.z2Dlum(data.z)**2.) * (10**self.all_nus_rest /(1+data.z))
+        self.band_integrals = dict()
 
         #Only if SED plotting:
         if self.output_type == 'plot':
@@ -794,7 +740,7 @@ class FLUXES_ARRAYS:
         #Only if calculating integrated luminosities:    
         if self.output_type == 'int_lums':
             #Convert Fluxes to nuLnu
-            self.int_lums= np.log10(self.integrated_luminosities(self.out ,self.all_nus_rest, self.nuLnus4plotting))
+            self.int_lums= np.log10(self.integrated_luminosities(self.out ,self.all_nus_rest))
             #self.int_lums = int_lums[:,:-1]  # all except last one which is best fit
             self.int_lums_best = self.int_lums[:,-1]  # last one, not yet working
 
@@ -821,145 +767,77 @@ class FLUXES_ARRAYS:
             return SBnuLnu, BBnuLnu, GAnuLnu, TOnuLnu, TOTALnuLnu, BBnuLnu_deredd
 
 
-    def integrated_luminosities(self,out ,all_nus_rest, nuLnus4plotting):
+    def component_fluxes(self, component):
+        """ Fluxes of a component ('sb', 'bbb', 'bbbdered', 'gal', 'tor', 'agn_rad') for every realization."""
+        Fnu, index, norm = self.templates[component]
+        return Fnu[index] * norm[:, None]
+
+
+    def band_luminosities(self, component, freqrange, all_nus_rest):
+
+        """
+        Luminosity of a component in a frequency range, for every realization.
+        The luminosity is linear in the normalization of the component, so the range is
+        integrated once per distinct template and scaled by the normalization of every realization.
+        The integrals are kept, so that other luminosities of the same ranges are not integrated again.
+
+        ##input: 
+        - component: 'sb', 'bbb', 'bbbdered', 'gal', 'tor' or 'agn_rad'
+        - freqrange: [nu_min, nu_max] in Hz (wavelength range converted); nu_min == nu_max for monochromatic nuLnu
+        - all_nus_rest
+        ##output:
+        - array of luminosities, one per realization (zeros if the component was not fitted)
+        """
+        if component not in self.templates:
+            return np.zeros(len(self.templates['gal'][1]))
+
+        Fnu, index, norm = self.templates[component]
+        key = (component, freqrange[0], freqrange[1])
+        if key not in self.band_integrals:
+            if freqrange[0] == freqrange[1]:        ### monochromatic luminosities
+                i  = (np.abs(all_nus_rest - np.log10(freqrange[0]))).argmin()
+                self.band_integrals[key] = Fnu[:, i] * self.nuLnu_factor[i]
+            else:
+                i  = ((all_nus_rest >= np.log10(freqrange[1])) & (all_nus_rest<= np.log10(freqrange[0])))
+                all_nus_rest_int = 10**(all_nus_rest[i])
+                self.band_integrals[key] = scipy.integrate.trapezoid(Fnu[:, i] * self.nuLnu_factor[i] / all_nus_rest_int, x=all_nus_rest_int)
+
+        return self.band_integrals[key][index] * norm
+
+
+    def integrated_luminosities(self,out ,all_nus_rest):
 
         """
         Calculates the integrated luminosities for 
         all model templates chosen by the user in out['intlum_models'], 
         within the integration ranges given by out['intlum_freqranges'].
+        Luminosities and AGN fractions are sums of the component luminosities given in INTLUM_MODELS,
+        so that new ranges can be calculated after the fit, with a dictionary out of new ranges only.
 
         ##input: 
-        - settings dictionary out[]
+        - settings dictionary out[] (or any dictionary with the keys intlum_models, intlum_freqranges and intlum_freqranges_unit)
         - all_nus_rest
-        - nuLnus4plotting: nu*luminosities for the four models corresponding
-                            to each element of the total chain
+        ##output:
+        - array of luminosities (and 10**AGN fractions), one row per element of out['intlum_models']
         """
-        if len(nuLnus4plotting) == 7:      #If the AGN radio component was included
-            SBnuLnu, BBnuLnu, GAnuLnu, TOnuLnu, RADnuLnu, TOTALnuLnu, BBnuLnu_deredd =nuLnus4plotting
-        elif len(nuLnus4plotting) == 6:
-            SBnuLnu, BBnuLnu, GAnuLnu, TOnuLnu, TOTALnuLnu, BBnuLnu_deredd =nuLnus4plotting
-
-        out['intlum_freqranges'] = (out['intlum_freqranges']*out['intlum_freqranges_unit']).to(u.Hz, equivalencies=u.spectral())
+        freqranges = (out['intlum_freqranges']*out['intlum_freqranges_unit']).to(u.Hz, equivalencies=u.spectral()).value
         int_lums = []
-        for m in range(len(out['intlum_models'])):
-
-            if out['intlum_models'][m] == 'sb':    
-                nuLnu= SBnuLnu
-            elif (out['intlum_models'][m] == 'bbb') or (out['intlum_models'][m] == 'Lx0.5-2keV') or (out['intlum_models'][m] == 'Lx2-8keV'):    
-                nuLnu= BBnuLnu
-            elif out['intlum_models'][m] == 'bbbdered':    
-                nuLnu=BBnuLnu_deredd
-            elif out['intlum_models'][m] == 'gal':    
-                nuLnu=GAnuLnu
-            elif out['intlum_models'][m] == 'tor':    
-                nuLnu=TOnuLnu
-            elif out['intlum_models'][m] == 'agn_rad':    
-                nuLnu=RADnuLnu
-            elif (out['intlum_models'][m] == 'AGNfrac_IR') or (out['intlum_models'][m] =='tor+bbb') or (out['intlum_models'][m] == 'AGNfracTO') or (out['intlum_models'][m] == 'AGNfracGA') or (out['intlum_models'][m] == 'AGNfracSB') or (out['intlum_models'][m] == 'AGNfrac_opt') or (out['intlum_models'][m] =='gal+bbb') or (out['intlum_models'][m] == 'AGNfrac_rad') or (out['intlum_models'][m].find('AGNfrac') == 0):    
-                nuLnuto=TOnuLnu
-                nuLnusb=SBnuLnu
-                nuLnuga=GAnuLnu
-                nuLnubb=BBnuLnu #_deredd  #BBnuLnu
-
-                if (out['intlum_models'][m] == 'AGNfrac_rad') or (out['intlum_models'][m] == 'AGNfrac1-10GHz') or (out['intlum_models'][m] == 'AGNfrac10-30GHz') or (out['intlum_models'][m] == 'AGNfrac50-200GHz'):
-                    nuLnurad=RADnuLnu  #In the cases in which the AGNfrac accounts for radio fluxes
-                
-                # In these cases, the AGNfraction and the AGN luminosity values are calculated and saved at the same time
-                if out['intlum_freqranges'][m][0] ==out['intlum_freqranges'][m][1]: ### AGNfraction or AGN luminosity for monochromatic luminosities
-                    index  = (np.abs(all_nus_rest - np.log10(out['intlum_freqranges'][m][0].value))).argmin()
-                    Lnuto = nuLnuto[:,index].ravel() 
-                    Lnusb = nuLnusb[:,index].ravel()
-                    Lnuga = nuLnuga[:,index].ravel()
-                    Lnubb = nuLnubb[:,index].ravel()
-
-                    if out['intlum_models'][m] == 'AGNfrac':
-                        AGNfrac = (Lnuto)/(Lnuto+Lnusb+Lnuga)
-                        int_lums.append(10**AGNfrac)
-                    elif out['intlum_models'][m] == 'tor+bbb':
-                        int_lums.append(Lnuto+Lnubb)
-                    elif out['intlum_models'][m] == 'AGNfrac_rad':
-                        Lnurad = nuLnurad[:,index].ravel()
-                        AGNfrac = Lnurad/(Lnuto+Lnusb+Lnurad)
-                        int_lums.append(10**AGNfrac)
-
-                else:                                                       ### AGNfraction or AGN luminosity for luminosities in a band
-                    index  = ((all_nus_rest >= np.log10(out['intlum_freqranges'][m][1].value)) & (all_nus_rest<= np.log10(out['intlum_freqranges'][m][0].value)))            
-                    all_nus_rest_int = 10**(all_nus_rest[index])
-                    Lnuto = nuLnuto[:,index] / all_nus_rest_int
-                    Lnusb = nuLnusb[:,index] / all_nus_rest_int
-                    Lnuga = nuLnuga[:,index] / all_nus_rest_int
-                    if (out['intlum_models'][m] == 'AGNfrac_rad') or (out['intlum_models'][m] == 'AGNfrac1-10GHz') or (out['intlum_models'][m] == 'AGNfrac10-30GHz') or (out['intlum_models'][m] == 'AGNfrac50-200GHz'):
-                        Lnurad = nuLnurad[:,index] / all_nus_rest_int
-                        Lnurad_int = scipy.integrate.trapezoid(Lnurad, x=all_nus_rest_int)
-                    Lnubb = nuLnubb[:,index] / all_nus_rest_int
-                    Lnuto_int = scipy.integrate.trapezoid(Lnuto, x=all_nus_rest_int)
-                    Lnusb_int = scipy.integrate.trapezoid(Lnusb, x=all_nus_rest_int)
-                    Lnuga_int = scipy.integrate.trapezoid(Lnuga, x=all_nus_rest_int)
-                    Lnubb_int = scipy.integrate.trapezoid(Lnubb, x=all_nus_rest_int)
-
-                    if out['intlum_models'][m] == 'AGNfrac_IR':                
-                        AGNfrac = (Lnuto_int)/(Lnuto_int+Lnusb_int) 
-                        int_lums.append(10**AGNfrac)
-                    elif out['intlum_models'][m] == 'AGNfracTO':                
-                        AGNfrac = (Lnuto_int)/(Lnuto_int+Lnusb_int+Lnuga_int)
-                        int_lums.append(10**AGNfrac)
-                    elif out['intlum_models'][m] == 'AGNfracGA':                
-                        AGNfrac = (Lnuga_int)/(Lnuto_int+Lnusb_int+Lnuga_int)
-                        int_lums.append(10**AGNfrac)
-                    elif out['intlum_models'][m] == 'AGNfracSB':                
-                        AGNfrac = (Lnusb_int)/(Lnuto_int+Lnusb_int+Lnuga_int)
-                        int_lums.append(10**AGNfrac)
-                    elif out['intlum_models'][m] == 'AGNfrac_opt':                
-
-                        #AGNfrac = Lnuga_int/Lnubb_int
-                        AGNfrac = Lnubb_int/(Lnuga_int+Lnubb_int)
-
-                        int_lums.append(10**AGNfrac)
-                    elif (out['intlum_models'][m] == 'AGNfrac_rad'):
-                        AGNfrac = Lnurad_int/(Lnuto_int+Lnusb_int+Lnurad_int)
-                        int_lums.append(10**AGNfrac)
-                    elif (out['intlum_models'][m] == 'AGNfrac'):
-                        AGNfrac = Lnurad_int/(Lnuto_int+Lnusb_int+Lnurad_int)
-                        int_lums.append(10**AGNfrac)
-                    elif out['intlum_models'][m] == 'gal+bbb':
-                        int_lums.append(Lnuga_int+Lnubb_int)
-                    elif out['intlum_models'][m] == 'tor+bbb':
-                        int_lums.append(Lnuto_int+Lnubb_int)
-                    elif (out['intlum_models'][m] == 'AGNfrac1-10GHz') or (out['intlum_models'][m] == 'AGNfrac10-30GHz') or (out['intlum_models'][m] == 'AGNfrac50-200GHz') :
-                        AGNfrac = Lnurad_int/(Lnusb_int+Lnurad_int)
-                        int_lums.append(10**AGNfrac)
-                    elif (out['intlum_models'][m] == 'AGNfrac400-1600GHz'):
-                        if self.models_settings['RADIO'] == False:
-                            Lnurad_int = 0
-                        AGNfrac = (Lnurad_int+Lnuto_int)/(Lnusb_int+Lnurad_int+Lnuto_int)
-                        int_lums.append(10**AGNfrac)
-                    elif (out['intlum_models'][m] == 'AGNfrac187-75mu'):
-                        if self.models_settings['RADIO'] == False:
-                            Lnurad_int = 0
-                        AGNfrac = (Lnurad_int+Lnuto_int)/(Lnusb_int+Lnurad_int+Lnuto_int+Lnuga_int)
-                        int_lums.append(10**AGNfrac)
-                    elif (out['intlum_models'][m] == 'AGNfrac75-20mu') or (out['intlum_models'][m] == 'AGNfrac20-8mu') or (out['intlum_models'][m] == 'AGNfrac8-4mu'):
-                        AGNfrac = (Lnuto_int)/(Lnusb_int+Lnuto_int+Lnuga_int+Lnubb_int)
-                        int_lums.append(10**AGNfrac)
-                    elif (out['intlum_models'][m] == 'AGNfrac4-2mu') or (out['intlum_models'][m] == 'AGNfrac2-1mu')  or (out['intlum_models'][m] == 'AGNfrac1-0.5mu'):
-                        AGNfrac = (Lnuto_int+Lnubb_int)/(Lnusb_int+Lnuto_int+Lnuga_int+Lnubb_int)
-                        int_lums.append(10**AGNfrac)
-                    elif (out['intlum_models'][m] == 'AGNfrac0.5-0.3mu') or (out['intlum_models'][m] == 'AGNfrac0.3-0.06mu'):
-                        AGNfrac = (Lnubb_int)/(Lnuto_int+Lnuga_int+Lnubb_int)
-                        int_lums.append(10**AGNfrac)
-			
-            #Once the nuLnu is defined, the luminosity is calculated and saved                
-            if (out['intlum_models'][m] != 'AGNfrac_IR') and (out['intlum_models'][m] !='tor+bbb') and (out['intlum_models'][m] != 'AGNfracTO') and (out['intlum_models'][m] != 'AGNfracGA') and (out['intlum_models'][m] != 'AGNfracSB') and (out['intlum_models'][m] != 'AGNfrac_opt') and  (out['intlum_models'][m] !='gal+bbb') and (out['intlum_models'][m] != 'AGNfrac_rad') and (out['intlum_models'][m].find('AGNfrac') == -1): 
-                if out['intlum_freqranges'][m][0] ==out['intlum_freqranges'][m][1]: ### monochromatic luminosities
-                    index  = (np.abs(all_nus_rest - np.log10(out['intlum_freqranges'][m][0].value))).argmin()   
-                    Lnu_mono = nuLnu[:,index].ravel()
-                    int_lums.append(Lnu_mono)
-                else:
-                    index  = ((all_nus_rest >= np.log10(out['intlum_freqranges'][m][1].value)) & (all_nus_rest<= np.log10(out['intlum_freqranges'][m][0].value)))            
-                    all_nus_rest_int = 10**(all_nus_rest[index])
-                    Lnu = nuLnu[:,index] / all_nus_rest_int
-                    Lnu_int = scipy.integrate.trapezoid(Lnu, x=all_nus_rest_int)
-                    int_lums.append(Lnu_int)
+        for m, name in enumerate(out['intlum_models']):
+
+            if freqranges[m][0] == freqranges[m][1] and name in INTLUM_MODELS_MONOCHROMATIC:
+                components, fraction_of = INTLUM_MODELS_MONOCHROMATIC[name]
+            elif name in INTLUM_MODELS:
+                components, fraction_of = INTLUM_MODELS[name]
+            else:
+                print ('Error PLOTandWRITE_AGNfitter.py: unknown luminosity '+str(name)+" in out['intlum_models'], use one of "+', '.join(INTLUM_MODELS))
+                sys.exit(1)
+
+            L = sum(self.band_luminosities(c, freqranges[m], all_nus_rest) for c in components)
+            if fraction_of is None:
+                int_lums.append(L)
+            else:
+                AGNfrac = L / sum(self.band_luminosities(c, freqranges[m], all_nus_rest) for c in fraction_of)
+                int_lums.append(10**AGNfrac)
 
         return np.array(int_lums)
 
@@ -1079,3 +957,77 @@ def SED_colors(combination = 'a'):
 
     return seagreen, darkblue, 'orange', lila, darkcyan, 'red'
 
+
+
+def interpolate_rows(x, Y, x_new, fill_value=-100.):
+
+    """
+    Linear interpolation of every row of Y (templates sampled at x) at x_new, all rows at once.
+    Gives the values of scipy.interpolate.interp1d(x, Y[i], bounds_error=False, fill_value=fill_value)(x_new),
+    which sorts x and interpolates with numpy.interp.
+
+    ##input:
+    - x: frequencies of the templates (1D)
+    - Y: templates, one per row (2D, len(x) columns)
+    - x_new: frequencies to interpolate at, sorted
+    ##output:
+    - array of len(Y) x len(x_new)
+    """
+    order = np.argsort(x, kind='mergesort')
+    x, Y = x[order], Y[:, order]
+
+    out = np.full((len(Y), len(x_new)), fill_value, dtype=float)
+    inside = (x_new >= x[0]) & (x_new <= x[-1])
+    xi = x_new[inside]
+    j = np.searchsorted(x, xi, 'right') - 1
+    k = np.minimum(j, len(x)-2)
+
+    ## as numpy.interp: exact at the points of x, and from the right point where the left one gives nan (infinite templates)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (Y[:, k+1] - Y[:, k]) / (x[k+1] - x[k])
+        res = slope*(xi - x[k]) + Y[:, k]
+        nan = np.isnan(res)
+        res[nan] = (slope*(xi - x[k+1]) + Y[:, k+1])[nan]
+        flat = np.isnan(res) & (Y[:, k] == Y[:, k+1])
+        res[flat] = Y[:, k][flat]
+    out[:, inside] = np.where(x[j] == xi, Y[:, j], res)
+    return out
+
+
+def resample_templates(x_new, templates, split=None):
+
+    """
+    Resamples the templates of many realizations onto the frequencies x_new, in log10(Fnu).
+    Every distinct template is interpolated once, and all templates on the same frequencies together.
+
+    ##input:
+    - x_new: frequencies to interpolate at, sorted
+    - templates: list of (key, (nus, Fnu)), one per realization; equal keys are equal templates
+    - split: frequency at which the templates are interpolated separately below and above
+             (the accretion disk and X-ray emission of BBB models with X-rays)
+    ##output:
+    - array of log10(Fnu) of the distinct templates, templates x len(x_new)
+    - index of the template of every realization (log10(Fnu)[index]: realizations x len(x_new))
+    """
+    index = dict()
+    unique = []
+    for key, (nus, Fnu) in templates:
+        if key not in index:
+            index[key] = len(unique)
+            unique.append((np.asarray(nus, dtype=float), np.log10(np.asarray(Fnu, dtype=float).flatten())))
+
+    grids = dict()
+    for i, (nus, _) in enumerate(unique):
+        grids.setdefault(nus.tobytes(), []).append(i)
+
+    logFnu = np.empty((len(unique), len(x_new)))
+    for ids in grids.values():
+        nus = unique[ids[0]][0]
+        Y = np.array([unique[i][1] for i in ids])
+        if split is None:
+            logFnu[ids] = interpolate_rows(nus, Y, x_new)
+        else:
+            for nus_part, new_part in [(nus < split, x_new < split), (nus >= split, x_new >= split)]:
+                logFnu[np.ix_(ids, new_part)] = interpolate_rows(nus[nus_part], Y[:, nus_part], x_new[new_part])
+
+    return logFnu, np.array([index[key] for key, _ in templates], dtype=int)
@@ -0,0 +1,120 @@
+"""%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+      RESOURCES_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+This script contains the resource planner of a run: it splits the cores given
+with option -c between
+- processes fitting different sources at the same time,
+- evaluator processes sharing the likelihood evaluations of one source
+  (emcee walkers and optimizer samples; UltraNest evaluates its slice-sampler
+  steps one at a time and gets no evaluators),
+- the threads of the numerical libraries (BLAS, OpenMP) in every process.
+
+By default every process starts as many BLAS threads as there are cores, so that
+N fits on N cores run N x N threads. The planner pins the number of threads with
+threadpoolctl (required): the environment variables (OMP_NUM_THREADS, ...) are only read
+when numpy is imported, so they are set for processes started later, but they cannot
+limit this process or the pool workers forked from it. Workers limit their threads
+in the pool initializers.
+
+This script includes:
+- function plan
+- function limit_threads
+- class EVALUATOR
+
+"""
+import os
+import numpy as np
+import multiprocessing as mp
+from . import PARAMETERSPACE_AGNfitter as parspace
+
+from threadpoolctl import threadpool_limits
+
+
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+MIN_POINTS_PER_EVALUATOR = 4        # likelihood evaluations per call and evaluator, below which the pool overhead dominates
+
+
+def plan(ncpu, nsources, ndim, mc):
+
+    """
+    Splits ncpu cores between sources, evaluators and threads.
+
+    ##input:
+    - ncpu: number of cores (option -c)
+    - nsources: number of sources (or batches, option -m) to fit
+    - ndim: typical number of parameters of the sources
+    - dictionary mc, of mcmc settings
+
+    ##output:
+    - dictionary with the number of processes (sources fitted at the same time),
+      evaluators per source and threads per process
+    """
+    processes = max(1, min(ncpu, nsources))
+    cores = max(1, ncpu // processes)
+
+    ## evaluator pools are forked from the process of the source, which must not be a pool worker itself
+    evaluators = 1
+    if processes == 1 and cores > 1 and 'fork' in mp.get_all_start_methods():
+        if mc['sampling_algorithm'] == 'emcee':
+            points = max(mc['Nwalkers'], 2*ndim)//2           # walkers moved together by the stretch move
+            evaluators = min(cores, max(1, points//MIN_POINTS_PER_EVALUATOR))
+        elif mc['sampling_algorithm'] == 'optimizer':
+            evaluators = min(cores, max(1, mc['optimizer_samples']//MIN_POINTS_PER_EVALUATOR))
+
+    threads = max(1, cores // evaluators)
+    return dict(processes=processes, evaluators=evaluators, threads=threads)
+
+
+def limit_threads(threads):
+
+    """
+    Limits the number of threads of the numerical libraries (already loaded) in this process,
+    and in the processes started from it. Called in every process, also in forked pool workers.
+    """
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(threads)
+    threadpool_limits(limits=threads)
+
+
+_SOURCE = dict()
+
+def _attach_source(data, models, P, threads):
+    _SOURCE.update(data=data, models=models, P=P)
+    limit_threads(threads)
+
+def _ln_probab_chunk(chunk):
+    return [parspace.ln_probab(tuple(p), _SOURCE['data'], _SOURCE['models'], _SOURCE['P']) for p in chunk]
+
+
+class EVALUATOR:
+
+    """
+    Class EVALUATOR
+
+    Pool of processes evaluating ln_probab of one source for many parameter vectors.
+    The processes are forked after the models of the source are loaded,
+    so that only the parameter vectors are sent to them.
+
+    ##input:
+    - object data of class DATA (DATA_AGNfitter.py)
+    - object models of class MODELS (MODEL_AGNfitter.py)
+    - dictionary P, of parameter settings (PARAMETERSPACE_AGNfitter.py)
+    - processes: number of evaluator processes
+    - threads: threads of the numerical libraries in every evaluator
+    """
+
+    def __init__(self, data, models, P, processes, threads=1):
+        self.processes = processes
+        self.pool = mp.get_context('fork').Pool(processes, initializer=_attach_source, initargs=(data, models, P, threads))
+
+    def __call__(self, coords):
+        """ ln_probab of every row of coords (Npoints x Npar)."""
+        chunks = np.array_split(np.atleast_2d(coords), min(self.processes, len(coords)))
+        return np.concatenate([np.asarray(c, dtype=float) for c in self.pool.map(_ln_probab_chunk, chunks)])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
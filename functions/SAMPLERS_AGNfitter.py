@@ -0,0 +1,197 @@
+"""%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+      SAMPLERS_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+This script contains the interface between AGNfitter and the sampling algorithms.
+Each backend knows how to run the fit of one source, where its chains are written,
+whether a source is already done and how its chains are read. The backend is chosen 
+with mc['sampling_algorithm'].
+
+Backends:
+- ultranest: nested sampling (UltraNest)
+- emcee: affine-invariant ensemble MCMC (emcee)
+- optimizer: MAP + Laplace approximation, fast quick-look fits
+
+Every backend reads its chains into the same container, a POSTERIOR: the samples 
+(numpy array of samples x parameters), their weights and the parameter names, with 
+the likelihood (and evidence) of every sample. The output functions (CHAIN, 
+PLOTandWRITE_AGNfitter.py) only use this container.
+
+To add a new backend, subclass SAMPLER, implement its abstract methods run() and read(),
+and add it to the dictionary SAMPLERS.
+
+This script includes:
+- class POSTERIOR
+- classes SAMPLER, ULTRANEST_SAMPLER, EMCEE_SAMPLER, OPTIMIZER_SAMPLER
+- function get_sampler
+
+"""
+import sys,os
+import abc
+import numpy as np
+import pandas as pd
+from . import MCMC_AGNfitter
+
+
+class POSTERIOR:
+
+    """
+    Class POSTERIOR
+
+    Posterior samples of the fit of a source, in the same form for every backend (SAMPLER.read()).
+
+    ##input:
+    - samples: array of the parameter values of the samples (Nsamples x Npar)
+    - weights: weights of the samples (ones for equally weighted samples)
+    - names: names of the parameters
+    - lnprob: log-likelihood of every sample (log-probability for emcee)
+    - logz: log-evidence at every sample, None if the backend gives no evidence
+    - lnprob_label: name of lnprob in the output files
+    - info: dictionary of other results of the backend, e.g. the chains of the walkers (emcee)
+    """
+
+    def __init__(self, samples, weights, names, lnprob, logz=None, lnprob_label='log_like', info=None):
+        self.samples = np.asarray(samples, dtype=float)
+        self.weights = np.asarray(weights, dtype=float)
+        self.names = list(names)
+        self.lnprob = np.asarray(lnprob, dtype=float)
+        self.logz = None if logz is None else np.asarray(logz, dtype=float)
+        self.lnprob_label = lnprob_label
+        self.info = info if info is not None else dict()
+
+
+class SAMPLER(abc.ABC):
+
+    """
+    Class SAMPLER
+
+    Base class of the sampler backends. Resuming an interrupted fit is left to 
+    the backends (UltraNest resumes from its log folder), it is not part of the interface.
+
+    ##input:
+    - dictionary mc, of mcmc settings (RUN_AGNfitter_multi.py)
+    """
+
+    name = None
+    chainfiles = (None, None)   # (chains, run information), relative to the folder of the source
+
+    def __init__(self, mc):
+        self.mc = mc
+
+    @abc.abstractmethod
+    def run(self, data, models, P):
+        """ Fit one source and save the chains."""
+
+    @abc.abstractmethod
+    def read(self, chainfiles, out, names):
+        """ 
+        Read the saved chains (chain_files()) into a POSTERIOR. names are the names of the fitted
+        parameters (P['names']), for chains which are saved without them.
+        """
+
+    def chain_files(self, sourcefolder):
+        """ Names of the files with the chains and the run information of a source."""
+        return sourcefolder+'/'+self.chainfiles[0], sourcefolder+'/'+self.chainfiles[1]
+
+    def is_done(self, sourcefolder):
+        """ True if the chains of the source have already been saved."""
+        return os.path.lexists(self.chain_files(sourcefolder)[0])
+
+    def report(self, posterior):
+        """ Print the properties of the sampling results."""
+        pass
+
+
+class ULTRANEST_SAMPLER(SAMPLER):
+
+    name = 'ultranest'
+    chainfiles = ('ultranest/chains/weighted_post.txt', 'ultranest/chains/run.txt')
+
+    def run(self, data, models, P):
+        MCMC_AGNfitter.run_ultranest(data, models, P, self.mc)
+
+    def read(self, chainfiles, out, names):
+        f = open(chainfiles[0], 'rb')
+        samples = pd.read_csv(f, sep = ' ')
+        f.close()
+        f2 = open(chainfiles[1], 'rb')
+        runfile = pd.read_csv(f2, sep = ' ')
+        f2.close()
+
+        if 'aux_logweight' in samples.columns:      # warm-started run (hot start): remove the proposal correction
+            samples['logl'] = samples['logl'] - samples['aux_logweight']
+            samples = samples.drop(columns='aux_logweight')
+
+        cumsum = np.cumsum(np.array(samples['weight']))
+        mask = cumsum > 1e-4
+        size_mask = int(np.sum(mask) - (np.sum(mask) % 100))
+
+        samples = samples.iloc[-size_mask:]
+        return POSTERIOR(samples.iloc[:, 2:].values, samples['weight'].values, samples.columns[2:], samples['logl'].values, 
+                         runfile.iloc[-size_mask:]['logz'].values)
+
+
+class EMCEE_SAMPLER(SAMPLER):
+
+    name = 'emcee'
+    chainfiles = ('samples_mcmc.sav', 'samples_mcmc.sav')
+
+    def run(self, data, models, P):
+        MCMC_AGNfitter.run_emcee(data, models, P, self.mc)
+
+    def read(self, chainfiles, out, names):
+        f = open(chainfiles[0], 'rb')
+        samples = pd.read_pickle(f)
+        f.close()
+        nwalkers, nsamples, npar = samples['chain'].shape
+
+        ## second half of the chains, thinned
+        Ns, Nt = out['Nsample'], out['Nthinning']
+        lnprob = samples['lnprob'][:,int(nsamples/2):int(nsamples):Nt].ravel() #[:,0:Ns*Nt:Nt]
+        flatchain = samples['chain'][:,int(nsamples/2):int(nsamples):Nt,:].reshape(-1, npar) #[:,0:Ns*Nt:Nt,:]
+
+        info = dict(chain=samples['chain'], lnprob=samples['lnprob'], mean_accept=samples['accept'].mean(), mean_autocorr=samples['acor'].mean())
+        return POSTERIOR(flatchain, np.ones(len(flatchain)), names, lnprob, lnprob_label='-ln_like', info=info)
+
+    def report(self, posterior):
+        print( '_________________________________')
+        print( 'Properties of the sampling results:')
+        print( '- Mean acceptance fraction', posterior.info['mean_accept'])
+        print( '- Mean autocorrelation time', posterior.info['mean_autocorr'])
+
+
+class OPTIMIZER_SAMPLER(SAMPLER):
+
+    name = 'optimizer'
+    chainfiles = ('optimizer/chains/equal_weighted_post.txt', 'optimizer/chains/run.txt')
+
+    def run(self, data, models, P):
+        MCMC_AGNfitter.run_optimizer(data, models, P, self.mc)
+
+    def read(self, chainfiles, out, names):
+        samples = pd.read_csv(chainfiles[0], sep = ' ')
+        runfile = pd.read_csv(chainfiles[1], sep = ' ')
+
+        info = dict(logl_map=runfile['logl_map'].iloc[0], ess=runfile['ess'].iloc[0])
+        return POSTERIOR(samples.iloc[:, 1:].values, np.ones(len(samples)), samples.columns[1:], samples['logl'].values,
+                         np.full(len(samples), runfile['logz'].iloc[0]), info=info)
+
+    def report(self, posterior):
+        print( '_________________________________')
+        print( 'Properties of the optimization results:')
+        print( '- MAP log-likelihood', posterior.info['logl_map'])
+        print( '- Effective sample size', posterior.info['ess'])
+
+
+SAMPLERS = {'ultranest': ULTRANEST_SAMPLER, 'emcee': EMCEE_SAMPLER, 'optimizer': OPTIMIZER_SAMPLER}
+
+
+def get_sampler(mc):
+    """
+    Returns the backend object for the sampling algorithm mc['sampling_algorithm'].
+    """
+    if mc['sampling_algorithm'] not in SAMPLERS:
+        sys.exit('Unknown algorithm '+str(mc['sampling_algorithm'])+', please select one of the available: '+', '.join(SAMPLERS.keys()))
+    return SAMPLERS[mc['sampling_algorithm']](mc)
@@ -0,0 +1,305 @@
+"""%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+      SCHEDULER_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+This script contains the work queue used to fit the sources of a catalog.
+
+Sources are handed to the processors in chunks of mc['sources_chunksize'] and
+collected in order of completion, so a slow source never holds back the others.
+Tasks only carry the catalog line of the source: large inputs, like the catalog,
+are given once to every processor with an initializer.
+Every source runs with a wall-time limit of mc['source_timeout'] seconds.
+Sources that fail or time out are tried again up to mc['source_retries'] times,
+and every failure is written as one line (JSON record) to the error log.
+The progress and throughput (sources per hour) are reported after each source.
+Sources can be given in groups (COSTS_AGNfitter.group_sources): the sources of
+a group are fitted one after the other by the same processor.
+Catalogs read in chunks (DATA_all.STREAM) are fitted by one pool for all chunks
+(run_stream): the next chunk is read while the current one is fitted, and its
+sources are queued behind those of the current chunk, so that the processors 
+do not wait at the chunk boundaries.
+
+This script includes:
+- class SourceTimeout
+- functions run_catalog, run_stream
+- functions run_source, run_group, write_failure
+
+"""
+import sys,os
+import time
+import json
+import queue
+import signal
+import threading
+import traceback
+import multiprocessing as mp
+
+
+class SourceTimeout(BaseException):
+    """ 
+    Raised when the fit of a source exceeds its wall-time limit.
+    Derived from BaseException, so that the bare excepts (and except Exception) 
+    in the fitting code do not catch it and go on with the fit.
+    """
+    pass
+
+
+def _alarm(signum, frame):
+    raise SourceTimeout('wall-time limit exceeded')
+
+
+def run_source(task):
+
+    """
+    Fit one source, with a wall-time limit, catching all errors.
+
+    ##input:
+    - task: (function, line, args, timeout, attempt). function(line, *args) fits the source in line,
+      timeout is the wall-time limit in seconds (0 for no limit).
+
+    ##output:
+    - record: dictionary with the line, status ('done', 'failed' or 'timeout'), attempt,
+      elapsed time and, for failures, the error and its traceback.
+    """
+    function, line, args, timeout, attempt = task
+    record = dict(line=int(line), attempt=attempt, status='done', pid=os.getpid())
+
+    limit = timeout > 0 and hasattr(signal, 'SIGALRM')
+    if limit:
+        previous = signal.signal(signal.SIGALRM, _alarm)
+        signal.alarm(int(timeout))
+
+    t0 = time.time()
+    try:
+        function(line, *args)
+    except SourceTimeout as e:
+        record.update(status='timeout', error='SourceTimeout: '+str(e), traceback=traceback.format_exc())
+    except Exception as e:
+        record.update(status='failed', error=type(e).__name__+': '+str(e), traceback=traceback.format_exc())
+    finally:
+        if limit:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous)
+    record['elapsed'] = time.time() - t0
+    return record
+
+
+def run_group(tasks):
+    """ Fit the sources of a group one after the other in this processor (run_source())."""
+    return [run_source(task) for task in tasks]
+
+
+def write_failure(logfile, record):
+    """ Append the record of a failed source to the error log (one JSON record per line)."""
+    record = dict(record, time=time.strftime('%Y-%m-%d %H:%M:%S'))
+    with open(logfile, 'a') as f:
+        f.write(json.dumps(record)+'\n')
+
+
+def run_catalog(function, lines, args, processors, mc, logfile, names=None, initializer=None, initargs=(), groups=None):
+
+    """
+    Fits the sources in lines with function(line, *args), on a number of processors.
+
+    ##input:
+    - function: fits one source, must be defined at the top level of a module (to be sent to the processors)
+    - lines: catalog lines of the sources
+    - args: tuple of the other arguments of function
+    - processors: number of processes (1 runs in this process)
+    - dictionary mc, of mcmc settings (RUN_AGNfitter_multi.py)
+    - logfile: file where the failures are recorded
+    - names: optional list of source names, indexed by line, for the failure records
+    - initializer, initargs: optional function called with initargs once in every processor
+      (also in this process if processors is 1), e.g. to attach the shared catalog
+    - groups: optional list of groups of the lines (COSTS_AGNfitter.group_sources), each fitted 
+      by one processor. Failed sources are tried again with the other failed sources of their group.
+
+    ##output:
+    - records: list of the records of the last attempt of each source (see run_source())
+    """
+    timeout = mc.get('source_timeout', 0)
+    retries = mc.get('source_retries', 0)
+    chunksize = mc.get('sources_chunksize', 1)
+
+    lines = list(lines)
+    if groups is None:
+        groups = [[line] for line in lines]
+    nsources = len(lines)
+    records = dict()
+    ndone, nfailed = 0, 0
+    t0 = time.time()
+
+    if processors > 1:
+        pool = mp.Pool(processes = processors, initializer = initializer, initargs = initargs)
+    else:
+        pool = None
+        if initializer is not None:
+            initializer(*initargs)
+    pending = groups
+    for attempt in range(retries+1):
+        if len(pending) == 0:
+            break
+        if attempt > 0:
+            print ( '> Retrying {0:d} sources (attempt {1:d} of {2:d})'.format(sum(len(g) for g in pending), attempt+1, retries+1))
+
+        tasks = [[(function, line, args, timeout, attempt+1) for line in group] for group in pending]
+        if pool is not None:
+            results = pool.imap_unordered(run_group, tasks, chunksize=chunksize)
+        else:
+            results = map(run_group, tasks)
+
+        failed = set()
+        for record in (record for group in results for record in group):
+            if names is not None:
+                record['name'] = str(names[record['line']])
+            records[record['line']] = record
+
+            if record['status'] == 'done':
+                ndone += 1
+            else:
+                write_failure(logfile, record)
+                print ( '*** Line {0:d} {1:s} ({2:s}), see {3:s}'.format(record['line'], record['status'], record['error'], logfile))
+                failed.add(record['line'])
+                if attempt == retries:
+                    nfailed += 1
+
+            hours = (time.time() - t0)/3600.
+            rate = ndone/hours if hours > 0 else 0.
+            left = nsources - ndone - nfailed
+            eta = '{0:.2g} h'.format(left/rate) if rate > 0 else '-'
+            print ( '- {0:d}/{1:d} sources done, {2:d} failed | {3:.1f} sources/hour | ETA {4:s}'.format(ndone, nsources, nfailed, rate, eta))
+        pending = [[line for line in group if line in failed] for group in pending]
+        pending = [group for group in pending if len(group) > 0]
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print ( '{0:d} sources done, {1:d} failed in {2:.2g} h'.format(ndone, nfailed, (time.time() - t0)/3600.))
+    return [records[line] for line in lines if line in records]
+
+
+def run_stream(function, chunks, processors, mc, logfile, initializer=None, initargs=()):
+
+    """
+    Fits the sources of a catalog read in chunks, on one pool of processors for all chunks.
+    The sources of a chunk are handed to the pool as soon as the chunk is read, behind 
+    the sources of the chunk being fitted. The next chunk is read in a thread while the 
+    current one is fitted, so that at most two chunks are held in memory (one more is 
+    being read once the oldest is done). Failed sources are tried again as in run_catalog().
+
+    ##input:
+    - function: fits one source, function(line, *args), defined at the top level of a module
+    - chunks: iterator of (lines, args, names, groups) of the chunks of the catalog: 
+      lines, the other arguments of function for the chunk, source names by line (or None),
+      and the groups of the lines (or None, see run_catalog())
+    - processors: number of processes (1 runs in this process)
+    - dictionary mc, of mcmc settings (RUN_AGNfitter_multi.py)
+    - logfile: file where the failures are recorded
+    - initializer, initargs: optional function called with initargs once in every processor
+
+    ##output:
+    - ndone, nfailed: number of sources done and failed
+    """
+    timeout = mc.get('source_timeout', 0)
+    retries = mc.get('source_retries', 0)
+    ndone, nfailed = 0, 0
+    t0 = time.time()
+
+    if processors > 1:
+        pool = mp.Pool(processes = processors, initializer = initializer, initargs = initargs)
+    else:
+        pool = None
+        if initializer is not None:
+            initializer(*initargs)
+
+    ## results of the pool, and chunks read by the thread, in order of arrival
+    events = queue.Queue()
+    chunks = iter(chunks)
+    active = dict()             # chunks with sources not finished: args, names and number of groups pending
+    reading = []                # thread reading the next chunk
+    exhausted = False
+
+    def read_chunk():
+        try:
+            events.put(('chunk', next(chunks, None)))
+        except BaseException as e:
+            events.put(('error', e))
+
+    def prefetch():
+        ## the next chunk is read while at most one other chunk is being fitted
+        if not exhausted and len(reading) == 0 and len(active) < 2:
+            reading.append(threading.Thread(target=read_chunk))
+            reading[0].start()
+
+    def submit(k, group, attempt):
+        tasks = [(function, line, active[k]['args'], timeout, attempt) for line in group]
+        active[k]['pending'] += 1
+        if pool is not None:
+            pool.apply_async(run_group, (tasks,), callback=lambda records: events.put(('records', k, attempt, records)), \
+                             error_callback=lambda e: events.put(('error', e)))
+        else:
+            events.put(('records', k, attempt, run_group(tasks)))
+
+    nchunks = 0
+    prefetch()
+    while not exhausted or len(active) > 0:
+        event = events.get()
+
+        if event[0] == 'error':
+            if pool is not None:
+                pool.terminate()
+            raise event[1]
+
+        elif event[0] == 'chunk':
+            reading.pop().join()
+            if event[1] is None:
+                exhausted = True
+                continue
+            lines, args, names, groups = event[1]
+            lines = list(lines)
+            if len(lines) == 0:
+                prefetch()
+                continue
+            k = nchunks
+            nchunks += 1
+            active[k] = dict(args=args, names=names, pending=0)
+            print ( '> Catalog lines {0:d} to {1:d} queued ({2:d} sources)'.format(int(min(lines)), int(max(lines)), len(lines)))
+            prefetch()
+            for group in (groups if groups is not None else [[line] for line in lines]):
+                submit(k, group, 1)
+
+        else:
+            _, k, attempt, records = event
+            failed = []
+            for record in records:
+                if active[k]['names'] is not None:
+                    record['name'] = str(active[k]['names'][record['line']])
+                if record['status'] == 'done':
+                    ndone += 1
+                else:
+                    write_failure(logfile, record)
+                    print ( '*** Line {0:d} {1:s} ({2:s}), see {3:s}'.format(record['line'], record['status'], record['error'], logfile))
+                    if attempt <= retries:
+                        failed.append(record['line'])
+                    else:
+                        nfailed += 1
+                hours = (time.time() - t0)/3600.
+                print ( '- {0:d} sources done, {1:d} failed | {2:.1f} sources/hour'.format(ndone, nfailed, ndone/hours if hours > 0 else 0.))
+            if len(failed) > 0:
+                print ( '> Retrying {0:d} sources (attempt {1:d} of {2:d})'.format(len(failed), attempt+1, retries+1))
+                submit(k, failed, attempt+1)
+
+            active[k]['pending'] -= 1
+            if active[k]['pending'] == 0:
+                del active[k]
+                prefetch()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print ( '{0:d} sources done, {1:d} failed in {2:.2g} h'.format(ndone, nfailed, (time.time() - t0)/3600.))
+    return ndone, nfailed
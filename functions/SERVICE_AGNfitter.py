@@ -0,0 +1,233 @@
+"""%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+      SERVICE_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+This script contains the fit service of AGNfitter (RUN_AGNfitter_multi.py --serve SOCKET):
+a long-running process which loads the settings, template libraries and filter sets
+once, and fits the sources sent to a local Unix socket.
+
+Requests and replies are JSON records, one per line. A request gives the photometry
+of one source, in the layout of the catalog of the settings:
+
+    {"id": "any id of the client", "settings": "SETTINGS_AGNfitter", "name": "src1", "z": 0.5,
+     "fluxes": [...], "fluxerrs": [...], "ndflag": [...], "freq/wl": [...]}
+
+- fluxes and fluxerrs (and ndflag, if cat['ndflag_bool']) in the order and unit of the catalog columns cat['flux_list'],
+- freq/wl only if the catalog does not use the central wavelengths of the filters (cat['use_central_wavelength']),
+- settings: name (without .py) of one of the settings files of the service, optional if there is only one.
+
+The service replies with one record per step: 'queued', 'fitting', and then 'done'
+with the percentiles of the parameters and the output files, or 'failed' with the error.
+The fits run one at a time, in the order the requests arrive.
+The output is written to cat['output_folder'] + 'SERVICE/' + name, replacing the
+output of earlier requests for the same source.
+
+This script includes:
+- functions request_catalog, fit_request
+- function serve
+- function submit
+
+"""
+import sys,os
+import re
+import json
+import time
+import shutil
+import socket
+import threading
+import traceback
+import socketserver
+import numpy as np
+from astropy.table import Table
+from . import MCMC_AGNfitter, PLOTandWRITE_AGNfitter
+from . import API_AGNfitter as api
+from .DATA_AGNfitter import DATA, DATA_all
+
+
+SERVICE_FOLDER = 'SERVICE/'
+PERCENTILES = [2.5, 16, 50, 84, 97.5]      # rows of parameter_outvalues (PLOTandWRITE_AGNfitter.py)
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_+\-][A-Za-z0-9_.+\-]*$')     # names of sources, which are also names of folders
+
+
+def request_catalog(request, cat, folder):
+
+    """
+    Writes the photometry of a request as a catalog with one source,
+    in the format of the catalog settings cat.
+
+    ##input:
+    - request: dictionary with the name, z and photometry of the source
+    - dictionary cat, of catalog settings
+    - folder where the catalog is written
+
+    ##output:
+    - copy of cat for the new catalog
+    """
+    name = str(request['name'])
+    if not NAME_PATTERN.match(name):
+        raise ValueError('the name of the source "'+name+'" must be one word of letters, digits and _.+-, not starting with .')
+
+    columns = {cat['name']: name, cat['redshift']: float(request['z'])}
+    fields = [('flux_list', 'fluxes'), ('fluxerr_list', 'fluxerrs')]
+    if cat['ndflag_bool'] == True:
+        fields.append(('ndflag_list', 'ndflag'))
+    if not cat['use_central_wavelength']:
+        fields.append(('freq/wl_list', 'freq/wl'))
+    for key, field in fields:
+        if field not in request:
+            raise KeyError('the request has no "'+field+'"')
+        if len(request[field]) != len(cat[key]):
+            raise ValueError('the request has {0:d} "{1:s}", the catalog {2:d}'.format(len(request[field]), field, len(cat[key])))
+        columns.update(zip(cat[key], [float(v) for v in request[field]]))
+
+    if cat['filetype'] == 'FITS':
+        filename = folder + name + '.fits'
+        Table(dict((c, [v]) for c, v in columns.items())).write(filename, overwrite=True)
+    else:
+        ## ASCII catalogs are read by column number, missing columns are filled with -99
+        filename = folder + name + '.txt'
+        row = [columns.get(i, -99.) for i in range(max(columns)+1)]
+        with open(filename, 'w') as f:
+            f.write(' '.join('col{0:d}'.format(i) for i in range(len(row))) + '\n')
+            f.write(' '.join(str(v) for v in row) + '\n')
+
+    return dict(cat, filename=filename, output_folder=folder)
+
+
+def fit_request(request, settings, reply):
+
+    """
+    Fits the source of a request and writes its output.
+
+    ##input:
+    - request: dictionary with the name, z and photometry of the source
+    - dictionary settings (API_AGNfitter.load_settings())
+    - reply: function sending a progress record to the client, reply(status=..., ...)
+
+    ##output:
+    - dictionary with the parameter percentiles, the output folder and files
+    """
+    folder = settings['cat']['output_folder'] + SERVICE_FOLDER
+    if not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    cat = request_catalog(request, settings['cat'], folder)
+    data_obj = DATA_all(cat, settings['filters'])
+    data_obj.PROPS()
+    data = DATA(data_obj, 0)
+
+    ## the output of earlier requests for the source is replaced;
+    ## the model dictionary is kept if the redshift did not change (API_AGNfitter.source_dictionary)
+    sourcefolder = folder + str(data.name)
+    if os.path.dirname(os.path.realpath(sourcefolder)) != os.path.realpath(folder):
+        raise ValueError('the output folder of the source "'+str(data.name)+'" is not in '+folder)
+    if os.path.isdir(sourcefolder):
+        for f in os.listdir(sourcefolder):
+            if not f.startswith('MODELSDICT_'):
+                path = os.path.join(sourcefolder, f)
+                shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+    settingsz = dict(settings, cat=cat)
+    models, P = api.source_models(data, settingsz)
+    reply(status='fitting', names=list(P['names']))
+
+    MCMC_AGNfitter.main(data, models, P, settings['mc'])
+    PLOTandWRITE_AGNfitter.main(data, models, P, settings['out'], settings['models'], settings['mc'])
+
+    results = dict(output_folder=sourcefolder, products=sorted(os.listdir(sourcefolder)))
+    outvalues = sourcefolder + '/parameter_outvalues_' + str(data.name) + '.txt'
+    if os.path.lexists(outvalues):
+        with open(outvalues) as f:
+            lines = [l for l in f.read().splitlines() if l.strip()]
+        names = lines[-len(PERCENTILES)-1].split()
+        values = np.array([l.split() for l in lines[-len(PERCENTILES):]], dtype=float)
+        results['percentiles'] = PERCENTILES
+        results['parameters'] = dict((n, list(values[:, i])) for i, n in enumerate(names))
+    return results
+
+
+def serve(address, settings):
+
+    """
+    Runs the fit service on the Unix socket address, until it is interrupted.
+
+    ##input:
+    - address: file name of the Unix socket
+    - settings: dictionary {settings id: settings dictionary (API_AGNfitter.load_settings())}
+    """
+    fitting = threading.Lock()
+
+    class HANDLER(socketserver.StreamRequestHandler):
+
+        def reply(self, **record):
+            try:
+                self.wfile.write((json.dumps(record, default=str) + '\n').encode())
+                self.wfile.flush()
+            except OSError:
+                pass            # the client has gone, the fit goes on
+
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    id = request.get('id', request.get('name'))
+                except (ValueError, AttributeError) as e:
+                    self.reply(status='failed', error='invalid request: '+str(e))
+                    continue
+
+                key = request.get('settings', list(settings)[0] if len(settings) == 1 else None)
+                if key not in settings:
+                    self.reply(id=id, status='failed', error='unknown settings '+str(key)+', the service has '+', '.join(settings))
+                    continue
+
+                self.reply(id=id, status='queued')
+                with fitting:
+                    t0 = time.time()
+                    try:
+                        results = fit_request(request, settings[key], lambda **record: self.reply(id=id, **record))
+                    except Exception as e:
+                        self.reply(id=id, status='failed', error=type(e).__name__+': '+str(e), traceback=traceback.format_exc())
+                    else:
+                        self.reply(id=id, status='done', elapsed=time.time() - t0, **results)
+
+    if os.path.exists(address):
+        os.remove(address)          # left by a service which was killed
+    server = socketserver.ThreadingUnixStreamServer(address, HANDLER)
+    server.daemon_threads = True
+
+    print ( '> AGNfitter service on ', address, ' with settings: ', ', '.join(settings))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(address)
+
+
+def submit(address, requests):
+
+    """
+    Sends requests to the fit service on the Unix socket address,
+    and yields the replies as they arrive, until every request is done or failed.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    with sock, sock.makefile('rwb') as f:
+        for request in requests:
+            f.write((json.dumps(request) + '\n').encode())
+        f.flush()
+
+        pending = len(requests)
+        while pending > 0:
+            line = f.readline()
+            if not line:
+                break
+            record = json.loads(line)
+            yield record
+            if record['status'] in ['done', 'failed']:
+                pending -= 1
@@ -0,0 +1,188 @@
+"""%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+      WARMSTART_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+This script contains the warm-start library: a local index of completed fits,
+used to initialize the fits of new sources from the posteriors of similar ones.
+
+Every completed fit is saved as one entry (one file per source) in the folder
+data.output_folder + mc['warm_start_library'], with
+- the redshift,
+- the filter coverage and normalized shape of the SED, sampled on a fixed grid of rest-frame frequencies,
+- a subsample of the posterior, resampled to equal weights.
+
+The nearest neighbours of a new source (same model parameters, similar z, coverage and SED shape)
+provide samples which seed the emcee walkers, or the auxiliary proposal of UltraNest (hot start).
+
+This script includes:
+- function sed_shape
+- functions add_source, load_library
+- function initial_samples
+
+"""
+import os
+import numpy as np
+import pickle
+
+
+SHAPE_GRID = np.arange(9., 19.01, 0.25)     # rest-frame log frequencies [Hz] of the SED shape
+MAX_GAP = 0.5                               # grid points further than this (dex) from a band are not covered
+MIN_COMMON = 4                              # minimum of common grid points to compare two SEDs
+NSAMPLES = 500                              # posterior samples saved per source
+NORM_PARS = ['GA', 'SB', 'TO', 'BB', 'RAD']  # normalization parameters, shifted with the flux level
+
+_LIBRARY = dict()
+
+
+def sed_shape(data):
+
+    """
+    Normalized SED shape of a source, on the rest-frame grid SHAPE_GRID.
+    Only detections are used. Grid points without a nearby band are NaN.
+
+    ##input:
+    - object data of class DATA (DATA_AGNfitter.py)
+
+    ##output:
+    - shape: log10(Fnu) minus the flux level, on SHAPE_GRID
+    - level: median log10(Fnu) of the covered grid points
+    """
+    det = (data.fluxes > 0) & (data.ndflag == 1)
+    shape = np.full(len(SHAPE_GRID), np.nan)
+    if np.sum(det) < 2:
+        return shape, np.nan
+
+    lognu_rest = data.nus[det] + np.log10(1+data.z)
+    logF = np.log10(data.fluxes[det])
+    isort = np.argsort(lognu_rest)
+    lognu_rest, logF = lognu_rest[isort], logF[isort]
+
+    gap = np.min(np.abs(SHAPE_GRID[:, None] - lognu_rest[None, :]), axis=1)
+    covered = (SHAPE_GRID >= lognu_rest[0]) & (SHAPE_GRID <= lognu_rest[-1]) & (gap <= MAX_GAP)
+    shape[covered] = np.interp(SHAPE_GRID[covered], lognu_rest, logF)
+
+    if not covered.any():
+        return shape, np.nan
+    level = np.median(shape[covered])
+    return shape - level, level
+
+
+def add_source(data, P, flatchain, mc, weights=None):
+
+    """
+    Add (or replace) the entry of a fitted source in the warm-start library.
+
+    ##input:
+    - object data of class DATA (DATA_AGNfitter.py)
+    - dictionary P, of parameter settings (PARAMETERSPACE_AGNfitter.py)
+    - flatchain: posterior samples (Nsamples x Npar)
+    - dictionary mc, of mcmc settings
+    - weights: weights of the samples (POSTERIOR.weights), None for equally weighted samples
+    """
+    folder = data.output_folder + mc['warm_start_library']
+    if not os.path.lexists(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    samples = np.asarray(flatchain, dtype=float)
+    weights = np.ones(len(samples)) if weights is None else np.asarray(weights, dtype=float)
+    if np.ptp(weights) > 0:
+        ## weighted samples (UltraNest) are resampled, so that the prior-dominated tail is left out
+        samples = samples[np.random.choice(len(samples), NSAMPLES, p=weights/weights.sum())]
+    elif len(samples) > NSAMPLES:
+        samples = samples[np.random.choice(len(samples), NSAMPLES, replace=False)]
+    shape, level = sed_shape(data)
+
+    entry = dict(name=str(data.name), z=float(data.z), shape=shape, level=level, names=list(P['names']), samples=samples)
+    filename = folder + str(data.name) + '.sav'
+    f = open(filename + '.tmp', 'wb')
+    pickle.dump(entry, f, protocol=2)
+    f.close()
+    os.replace(filename + '.tmp', filename)     # never leave a half-written entry for other processes
+
+
+def load_library(folder):
+
+    """
+    Returns the entries of the warm-start library in folder.
+    Entries are cached in memory, and only new or updated files are read again.
+    """
+    cache = _LIBRARY.setdefault(folder, dict())
+    if not os.path.lexists(folder):
+        return []
+
+    for filename in os.listdir(folder):
+        if not filename.endswith('.sav'):
+            continue
+        mtime = os.path.getmtime(folder + filename)
+        if filename not in cache or cache[filename][0] != mtime:
+            with open(folder + filename, 'rb') as f:
+                cache[filename] = (mtime, pickle.load(f))
+    return [entry for mtime, entry in cache.values()]
+
+
+def distance(shape, z, entry):
+
+    """
+    Distance between a source and a library entry. It sums the rms difference of the
+    SED shapes (dex), the fractional redshift difference and the fraction of
+    filter coverage that is not shared by both SEDs.
+    """
+    common = np.isfinite(shape) & np.isfinite(entry['shape'])
+    if np.sum(common) < MIN_COMMON:
+        return np.inf
+    union = np.isfinite(shape) | np.isfinite(entry['shape'])
+
+    shape_term = np.sqrt(np.mean((shape[common] - entry['shape'][common])**2))
+    z_term = abs(z - entry['z'])/(1 + z)
+    coverage_term = 1. - np.sum(common)/np.sum(union)
+    return shape_term + z_term + coverage_term
+
+
+def initial_samples(data, P, mc, nsamples):
+
+    """
+    Draws starting points for the fit of a source, from the posteriors of the
+    mc['warm_start_neighbours'] most similar sources in the warm-start library.
+    The normalization parameters are shifted by the difference of flux level,
+    and all samples are clipped to the limits of P.
+
+    ##input:
+    - object data of class DATA (DATA_AGNfitter.py)
+    - dictionary P, of parameter settings (PARAMETERSPACE_AGNfitter.py)
+    - dictionary mc, of mcmc settings
+    - nsamples: number of starting points
+
+    ##output:
+    - array (nsamples x Npar), or None if warm start is off or there are no similar sources
+    """
+    if not mc.get('warm_start', False):
+        return None
+
+    shape, level = sed_shape(data)
+    if not np.isfinite(level):
+        return None
+
+    candidates = [e for e in load_library(data.output_folder + mc['warm_start_library']) \
+                    if e['names'] == list(P['names']) and e['name'] != str(data.name) and np.isfinite(e['level'])]
+    dists = np.array([distance(shape, data.z, e) for e in candidates])
+    order = [i for i in np.argsort(dists) if np.isfinite(dists[i])][:mc['warm_start_neighbours']]
+    if len(order) == 0:
+        print( 'Warm start: no similar sources in the library, starting from the prior.')
+        return None
+
+    norm = np.array([name in NORM_PARS for name in P['names']])
+    pools = []
+    for i in order:
+        samples = candidates[i]['samples'].copy()
+        samples[:, norm] += level - candidates[i]['level']
+        pools.append(samples)
+    pool = np.vstack(pools)
+
+    p0 = pool[np.random.choice(len(pool), nsamples)]
+    width = np.array(P['max']) - np.array(P['min'])
+    p0 = p0 + (2*np.random.uniform(size=p0.shape) - 1)*0.00001*width    # repeated samples become distinct walkers
+    p0 = np.clip(p0, P['min'], P['max'])
+    print( 'Warm start from', [candidates[i]['name'] for i in order])
+    return p0
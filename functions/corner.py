@@ -216,7 +216,7 @@ def corner(xs, bins=20, range=None, weights=None, color="k",
     else:
         try:
             axes = np.array(fig.axes).reshape((K, K))
-        except:
+        except Exception:
             raise ValueError("Provided figure has {0} axes, but data has "
                              "dimensions K={1}".format(len(fig.axes), K))
 
@@ -580,7 +580,7 @@ def hist2d(x, y, bins=20, range=None, weights=None, levels=None, smooth=None,
     for i, v0 in enumerate(levels):
         try:
             V[i] = Hflat[sm <= v0][-1]
-        except:
+        except Exception:
             V[i] = Hflat[0]
     V.sort()
     m = np.diff(V) == 0
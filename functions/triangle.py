@@ -119,7 +119,7 @@ def corner(xs, weights=None, labels=None, extents=None, truths=None,
     else:
         try:
             axes = np.array(fig.axes).reshape((K, K))
-        except:
+        except Exception:
             raise ValueError("Provided figure has {0} axes, but data has "
                              "dimensions K={1}".format(len(fig.axes), K))
     lb = lbdim / dim
@@ -308,7 +308,7 @@ def hist2d(x, y, *args, **kwargs):
     for i, v0 in enumerate(V):
         try:
             V[i] = Hflat[sm <= v0][-1]
-        except:
+        except Exception:
             V[i] = Hflat[0]
 
     X1, Y1 = 0.5 * (X[1:] + X[:-1]), 0.5 * (Y[1:] + Y[:-1])
@@ -0,0 +1,4 @@
+import os, sys
+
+## the tests import the AGNfitter modules as RUN_AGNfitter_multi.py does, from the top folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
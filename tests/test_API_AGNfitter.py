@@ -0,0 +1,26 @@
+"""
+Tests of the Python interface (functions/API_AGNfitter.py).
+"""
+import time
+import types
+import signal
+import pytest
+
+api = pytest.importorskip('functions.API_AGNfitter')
+from functions import SCHEDULER_AGNfitter as scheduler
+from functions.MANIFEST_AGNfitter import MANIFEST, manifest_name
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGALRM'), reason='the wall-time limit needs SIGALRM')
+def test_timed_out_source_is_failed_in_manifest(tmp_path, monkeypatch):
+    settings = dict(cat=dict(output_folder=str(tmp_path / 'OUTPUT') + '/'), filters=dict(), models=dict(), mc=dict())
+    monkeypatch.setattr(api, 'DATA', lambda data_obj, line: types.SimpleNamespace(name='src%d' % line, catalog='catalog'))
+    monkeypatch.setattr(api, 'source_models', lambda data, settings, clobbermodel: time.sleep(10))
+
+    record = scheduler.run_source((api.fit_source, 3, (None, settings), 1, 1))
+
+    assert record['status'] == 'timeout'
+    row = MANIFEST(manifest_name(settings['cat'])).get(3)
+    assert row['state'] == 'failed'
+    assert row['error'].startswith('SourceTimeout')
+    assert MANIFEST(manifest_name(settings['cat'])).lines('failed') == [3]
@@ -0,0 +1,41 @@
+"""
+Tests of the fit service (functions/SERVICE_AGNfitter.py).
+"""
+import os
+import time
+import threading
+import pytest
+
+service = pytest.importorskip('functions.SERVICE_AGNfitter')
+
+
+def start_service(tmp_path):
+    address = str(tmp_path / 'agnfitter.sock')
+    settings = dict(SETTINGS_AGNfitter=dict(cat=dict(output_folder=str(tmp_path / 'OUTPUT') + '/')))
+    threading.Thread(target=service.serve, args=(address, settings), daemon=True).start()
+    for _ in range(100):
+        if os.path.exists(address):
+            break
+        time.sleep(0.05)
+    return address
+
+
+@pytest.mark.parametrize('name', ['..', '.', '../other', 'a b', ''])
+def test_request_with_path_name_is_rejected(tmp_path, name):
+    address = start_service(tmp_path)
+    other = tmp_path / 'OUTPUT' / 'src1'
+    other.mkdir(parents=True)
+    (other / 'parameter_outvalues_src1.txt').write_text('done')
+
+    replies = list(service.submit(address, [dict(id=1, name=name, z=0.5, fluxes=[], fluxerrs=[])]))
+
+    assert replies[-1]['status'] == 'failed'
+    assert 'name of the source' in replies[-1]['error']
+    assert (other / 'parameter_outvalues_src1.txt').exists()
+
+
+def test_request_catalog_accepts_catalog_names(tmp_path):
+    cat = dict(name=0, redshift=1, flux_list=[2], fluxerr_list=[3], ndflag_bool=False,
+               use_central_wavelength=True, filetype='ASCII')
+    newcat = service.request_catalog(dict(name='J1234+56.7_a-b', z=0.5, fluxes=[1.], fluxerrs=[0.1]), cat, str(tmp_path) + '/')
+    assert os.path.exists(newcat['filename'])